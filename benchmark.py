@@ -0,0 +1,182 @@
+"""TrainTicketMonitor 性能基准
+
+针对本地模拟的12306服务（fake_12306.py）运行，不访问真实的12306：
+
+    python benchmark.py                    # 默认参数
+    python benchmark.py --jobs 500 --duration 20 --latency 0.05 --json
+
+输出：
+  parse      每 1000 个车次的解析耗时
+  memory     每个监控任务占用的内存（加入引擎后、完成一次查询后）
+  polls      引擎每秒完成的查询数
+  detection  从座位变为有票到引擎发出事件的延迟 p50/p99
+"""
+import argparse
+import contextlib
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+import fake_12306
+import train_ticket_monitor as ttm
+
+# 基准用的线路：从站点表里取前若干个站两两组合
+ROUTE_STATIONS = 40
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(pct / 100.0 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def make_jobs(count, interval):
+    """生成 count 个查询键各不相同的监控任务"""
+    names = list(ttm.get_station_index().name_to_code)[:ROUTE_STATIONS]
+    pairs = [(a, b) for a in names for b in names if a != b]
+    jobs = []
+    for i in range(count):
+        from_station, to_station = pairs[i % len(pairs)]
+        train_date = f"2030-01-{1 + i // len(pairs):02d}"
+        jobs.append(ttm.WatchJob(from_station, to_station, train_date, interval=interval, name=f"job{i}"))
+    return jobs
+
+
+def bench_parse(trains=1000, repeat=50):
+    """解析 1000 个车次所需时间（毫秒）"""
+    railway = fake_12306.FakeRailway(trains_per_route=trains)
+    rows = railway.render_rows('BJP', 'SHH', '2030-01-01')
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        ttm.parse_ticket_result(rows)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {'ms_per_1000_trains': best * 1000.0 * 1000 / trains}
+
+
+def bench_memory(jobs=1000):
+    """每个监控任务在引擎中占用的字节数：刚加入时，以及保存了一次查询快照后"""
+    rows = fake_12306.FakeRailway(trains_per_route=20).render_rows('BJP', 'SHH', '2030-01-01')
+    monitor = ttm.TrainTicketMonitor()
+    engine = ttm.MonitorEngine(monitor, max_workers=4, on_events=lambda *args: None)
+    job_list = make_jobs(jobs, 60)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for job in job_list:
+        engine.add_job(job)
+    added = tracemalloc.take_snapshot()
+    for job in job_list:
+        # 每个任务各自的一份查询结果，模拟线路互不相同的情况
+        engine.poll_job(job, ttm.parse_ticket_result(rows))
+    polled = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    def diff(a, b):
+        return sum(stat.size_diff for stat in b.compare_to(a, 'filename'))
+    return {
+        'bytes_per_job': diff(before, added) / jobs,
+        'bytes_per_job_with_snapshot': diff(before, polled) / jobs,
+    }
+
+
+def bench_engine(jobs=200, duration=10.0, interval=1.0, workers=16, latency=0.0, volatility=0.05,
+                 error_rate=0.0, html_rate=0.0, broken_paths=()):
+    """让引擎对模拟服务运行 duration 秒，统计查询吞吐和检测延迟"""
+    railway = fake_12306.FakeRailway(trains_per_route=20, volatility=volatility)
+    latencies = []
+    lock = threading.Lock()
+
+    def on_events(job, events, tickets):
+        now = time.time()
+        for event in events:
+            if event.kind != ttm.EVENT_AVAILABLE:
+                continue
+            ticket = event.ticket
+            flipped = railway.became_available.get(
+                (ticket.from_station, ticket.to_station, job.train_date, ticket.train_code, event.seat_type))
+            if flipped is not None:
+                with lock:
+                    latencies.append(now - flipped)
+
+    with fake_12306.Fake12306Server(railway=railway, latency=latency, error_rate=error_rate,
+                                    html_rate=html_rate, broken_paths=broken_paths, broken_delay=0.2) as server:
+        monitor = ttm.TrainTicketMonitor()
+        monitor.base_url = server.base_url
+        monitor.rate_limiter = None
+        monitor.left_ticket_url_cache = ttm.EndpointCache()
+        monitor.endpoint_router = ttm.EndpointRouter()
+        engine = ttm.MonitorEngine(monitor, max_workers=workers, on_events=on_events, max_backoff=interval * 4)
+        for job in make_jobs(jobs, interval):
+            engine.add_job(job)
+
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            timer = threading.Timer(duration, engine.stop)
+            timer.start()
+            start = time.time()
+            engine.run()
+            elapsed = time.time() - start
+            timer.cancel()
+        requests = dict(server.requests)
+
+    fetches = engine.coalescer.fetches
+    return {
+        'jobs': jobs,
+        'workers': workers,
+        'duration': elapsed,
+        'polls_per_sec': fetches / elapsed,
+        'upstream_requests': requests,
+        'detections': len(latencies),
+        'detection_p50': percentile(latencies, 50),
+        'detection_p99': percentile(latencies, 99),
+        'routes': monitor.endpoint_router.format_status(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='TrainTicketMonitor 性能基准')
+    parser.add_argument('--jobs', type=int, default=200, help='监控任务数')
+    parser.add_argument('--duration', type=float, default=10.0, help='引擎运行秒数')
+    parser.add_argument('--interval', type=float, default=1.0, help='每个任务的查询间隔（秒）')
+    parser.add_argument('--workers', type=int, default=16, help='最大并发查询数')
+    parser.add_argument('--latency', type=float, default=0.0, help='模拟服务每个请求的平均延迟（秒）')
+    parser.add_argument('--volatility', type=float, default=0.05, help='每个座位每秒切换有票/无票的概率')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='余票接口返回 502 的概率')
+    parser.add_argument('--html-rate', type=float, default=0.0, help='余票接口返回 HTML 的概率')
+    parser.add_argument('--broken', default='', help='模拟服务中总是返回 502 的接口，多个用逗号分隔，如 leftTicket/queryG')
+    parser.add_argument('--json', action='store_true', help='以 JSON 格式输出结果')
+    args = parser.parse_args(argv)
+
+    results = {
+        'parse': bench_parse(),
+        'memory': bench_memory(),
+        'engine': bench_engine(args.jobs, args.duration, args.interval, args.workers, args.latency,
+                               args.volatility, args.error_rate, args.html_rate,
+                               [p for p in args.broken.split(',') if p]),
+    }
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        return 0
+
+    engine = results['engine']
+    print(f"解析:     {results['parse']['ms_per_1000_trains']:.2f} ms / 1000 车次")
+    print(f"内存:     {results['memory']['bytes_per_job']:.0f} B / 任务，"
+          f"含一次查询快照 {results['memory']['bytes_per_job_with_snapshot']:.0f} B / 任务")
+    print(f"吞吐:     {engine['polls_per_sec']:.1f} 次查询 / 秒（{engine['jobs']} 个任务，{engine['workers']} 并发，"
+          f"{engine['duration']:.1f} 秒）")
+    if engine['detections']:
+        print(f"检测延迟: p50 {engine['detection_p50'] * 1000:.0f} ms，p99 {engine['detection_p99'] * 1000:.0f} ms"
+              f"（{engine['detections']} 次）")
+    else:
+        print("检测延迟: 运行期间没有座位变为有票")
+    print(f"上游请求: {engine['upstream_requests']}")
+    print(f"查询路线:\n{engine['routes']}")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
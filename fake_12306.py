@@ -0,0 +1,365 @@
+"""本地模拟的12306服务，用于在不访问 kyfw.12306.cn 的情况下测试和做性能基准
+
+提供 leftTicket/init 页面（含 CLeftTicketUrl）、query/queryZ/queryA 等余票查询接口、queryTicketPrice 票价接口和 station_name.js，
+可以注入延迟、错误状态和"返回 HTML 而不是 JSON"的情况；余票数据可以回放录制的响应，也可以按随机规则生成。
+
+    python fake_12306.py --port 8306 --volatility 0.05
+    monitor.base_url = "http://127.0.0.1:8306/otn"
+"""
+import argparse
+import hashlib
+import http.server
+import json
+import math
+import os
+import random
+import re
+import socketserver
+import threading
+import time
+import urllib.parse
+
+import train_ticket_monitor as ttm
+
+INIT_HTML = """<!DOCTYPE html>
+<html><head><title>车票查询 | 客运服务 | 铁路客户服务中心</title>
+<script type="text/javascript">
+var CLeftTicketUrl = '{left_ticket_path}';
+var isSaleTime = true;
+</script></head><body></body></html>"""
+
+LOGIN_HTML = """<!DOCTYPE html>
+<html><head><title>登录 | 铁路客户服务中心</title></head>
+<body><div>请登录</div><input name="登录名"></body></html>"""
+
+# 模拟车次的车型前缀，以及该车型有哪些座位
+TRAIN_KINDS = (
+    ('G', ('商务座', '一等座', '二等座', '无座')),
+    ('D', ('一等座', '二等座', '无座')),
+    ('K', ('软卧', '硬卧', '硬座', '无座')),
+    ('Z', ('高级软卧', '软卧', '硬卧', '硬座')),
+)
+
+# 模拟票价：各座位相对二等座的倍数
+PRICE_RATIOS = {'商务座': 3.2, '一等座': 1.6, '二等座': 1.0, '无座': 1.0, '高级软卧': 2.6, '软卧': 1.8,
+                '动卧': 1.9, '硬卧': 1.1, '软座': 0.8, '硬座': 0.5}
+
+
+class FakeTrain:
+    """模拟的一个车次及其各座位余票数量（None 表示没有该座位）"""
+    __slots__ = ('train_no', 'train_code', 'departure_time', 'arrival_time', 'duration', 'counts')
+
+    def __init__(self, train_no, train_code, departure_minutes, duration_minutes, counts):
+        self.train_no = train_no
+        self.train_code = train_code
+        self.departure_time = f"{departure_minutes // 60 % 24:02d}:{departure_minutes % 60:02d}"
+        arrival = departure_minutes + duration_minutes
+        self.arrival_time = f"{arrival // 60 % 24:02d}:{arrival % 60:02d}"
+        self.duration = f"{duration_minutes // 60:02d}:{duration_minutes % 60:02d}"
+        self.counts = counts
+
+    def render(self, from_code, to_code, train_date):
+        """按 leftTicket 接口的格式生成一行以 | 分隔的车次数据"""
+        fields = [''] * 57
+        fields[0] = 'fakeSecretStr' + self.train_no
+        fields[1] = '预订'
+        fields[2] = self.train_no
+        fields[3] = self.train_code
+        fields[4] = fields[6] = from_code
+        fields[5] = fields[7] = to_code
+        fields[8] = self.departure_time
+        fields[9] = self.arrival_time
+        fields[10] = self.duration
+        fields[11] = 'Y'
+        fields[12] = 'fakeYpInfo' + self.train_no
+        fields[13] = train_date.replace('-', '')
+        fields[14] = '3'
+        fields[15] = 'P2'
+        fields[16] = '01'
+        fields[17] = '05'
+        fields[18] = '1'
+        fields[19] = '0'
+        for (seat_type, index), count in zip(ttm.SEAT_FIELDS, self.counts):
+            if count is None:
+                continue
+            if count >= ttm.TICKETS_PLENTY:
+                fields[index] = '有'
+            elif count:
+                fields[index] = str(count)
+            else:
+                fields[index] = '无'
+        fields[34] = 'O0M090'
+        fields[35] = 'OM9'
+        return '|'.join(fields)
+
+
+class FakeRailway:
+    """生成并维护各线路的模拟车次和余票
+
+    每条线路的车次由线路和日期决定（同样的参数总是生成同样的车次）。volatility 为每个座位每秒
+    发生"有票/无票"切换的概率，状态在每次查询时按流逝的时间推进；最近一次变为有票的时间记录在
+    became_available 中，可用来计算检测延迟。
+    """
+
+    def __init__(self, trains_per_route=20, volatility=0.0, seed=0):
+        self.trains_per_route = trains_per_route
+        self.volatility = volatility
+        self.seed = seed
+        self.became_available = {}  # (from_code, to_code, date, train_code, seat_type) -> 时间
+        self._routes = {}  # (from_code, to_code, date) -> [上次推进时间, [FakeTrain]]
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _create_trains(self, key):
+        rng = random.Random(f"{self.seed}|{'|'.join(key)}")
+        trains = []
+        for i in range(self.trains_per_route):
+            prefix, seat_types = TRAIN_KINDS[rng.randrange(len(TRAIN_KINDS))]
+            number = rng.randrange(1, 9999)
+            counts = [None] * len(ttm.SEAT_TYPES)
+            for seat_type in seat_types:
+                counts[ttm.SEAT_TYPES.index(seat_type)] = rng.choice((0, 0, 0, 3, 12, ttm.TICKETS_PLENTY))
+            trains.append(FakeTrain(f"{24 + i:02d}0000{prefix}{number:04d}0", f"{prefix}{number}",
+                                    rng.randrange(5 * 60, 23 * 60), rng.randrange(30, 12 * 60), counts))
+        trains.sort(key=lambda t: t.departure_time)
+        return trains
+
+    def trains(self, from_code, to_code, train_date):
+        """某线路某天的车次，按流逝时间推进余票状态后返回"""
+        key = (from_code, to_code, train_date)
+        now = time.time()
+        with self._lock:
+            route = self._routes.get(key)
+            if route is None:
+                route = self._routes[key] = [now, self._create_trains(key)]
+            elif self.volatility:
+                self._advance(key, route, now)
+            return route[1]
+
+    def _advance(self, key, route, now):
+        elapsed = now - route[0]
+        route[0] = now
+        flip = 1 - math.exp(-self.volatility * elapsed)
+        for train in route[1]:
+            for i, count in enumerate(train.counts):
+                if count is None or self._rng.random() >= flip:
+                    continue
+                if count:
+                    train.counts[i] = 0
+                else:
+                    train.counts[i] = self._rng.choice((1, 2, 5, 12, ttm.TICKETS_PLENTY))
+                    # 切换发生在上次推进到现在之间的某个时刻
+                    self.became_available[key + (train.train_code, ttm.SEAT_TYPES[i])] = now - self._rng.random() * elapsed
+
+    def render_rows(self, from_code, to_code, train_date):
+        return [train.render(from_code, to_code, train_date) for train in self.trains(from_code, to_code, train_date)]
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        fake = self.server.fake
+        url = urllib.parse.urlsplit(self.path)
+        path = url.path[len('/otn/'):] if url.path.startswith('/otn/') else url.path.lstrip('/')
+        fake.count(path)
+        if fake.latency:
+            time.sleep(fake.latency * (0.5 + fake.rng.random()))
+
+        if path == 'leftTicket/init':
+            self._send(200, fake.replayed('init.html') or INIT_HTML.format(left_ticket_path=fake.left_ticket_path), 'text/html')
+        elif path == 'leftTicket/queryTicketPrice':
+            self._send(200, fake.price_body(urllib.parse.parse_qs(url.query)), 'application/json')
+        elif path.startswith('leftTicket/query'):
+            if path in fake.broken_paths:
+                time.sleep(fake.broken_delay)
+                self._send(502, '<html><body>502 Bad Gateway</body></html>', 'text/html')
+            elif fake.rng.random() < fake.error_rate:
+                self._send(502, '<html><body>502 Bad Gateway</body></html>', 'text/html')
+            elif fake.rng.random() < fake.html_rate:
+                self._send(200, LOGIN_HTML, 'text/html')
+            else:
+                params = urllib.parse.parse_qs(url.query)
+                self._send(200, fake.replayed('query.json') or fake.left_ticket_body(params), 'application/json')
+        elif path == 'resources/js/framework/station_name.js':
+            body = fake.replayed('station_name.js') or fake.station_js()
+            etag = '"{}"'.format(hashlib.md5(body.encode('utf-8')).hexdigest())
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            else:
+                self._send(200, body, 'application/javascript', {'ETag': etag})
+        else:
+            self._send(404, 'not found', 'text/plain')
+
+    def _send(self, status, body, content_type, headers=None):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', f'{content_type};charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class Fake12306Server:
+    """在本地端口上运行的模拟12306服务
+
+    latency 为每个请求的平均附加延迟（秒），error_rate / html_rate 为余票接口返回 502 或登录页 HTML 的概率。
+    replay_dir 中如有 init.html、query.json、station_name.js，对应接口直接回放这些文件的内容。
+    broken_paths 中的接口（如 leftTicket/queryG）总是在 broken_delay 秒后返回 502，模拟某个接口整体故障。
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, railway=None, latency=0.0, error_rate=0.0, html_rate=0.0,
+                 replay_dir=None, left_ticket_path='leftTicket/queryG', broken_paths=(), broken_delay=0.0):
+        self.railway = railway or FakeRailway()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.html_rate = html_rate
+        self.left_ticket_path = left_ticket_path
+        self.broken_paths = set(broken_paths)
+        self.broken_delay = broken_delay
+        self.requests = {}  # 路径 -> 请求次数
+        self.rng = random.Random()
+        self._replay = {}
+        if replay_dir:
+            for name in ('init.html', 'query.json', 'station_name.js'):
+                path = os.path.join(replay_dir, name)
+                if os.path.exists(path):
+                    with open(path, 'r', encoding='utf-8') as f:
+                        self._replay[name] = f.read()
+        self._station_js = None
+        self._lock = threading.Lock()
+        self._httpd = _ThreadingHTTPServer((host, port), _Handler)
+        self._httpd.fake = self
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/otn"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='fake-12306', daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        """在当前线程运行服务，直到 Ctrl+C"""
+        try:
+            self._httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._httpd.server_close()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def count(self, path):
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def replayed(self, name):
+        return self._replay.get(name)
+
+    def left_ticket_body(self, params):
+        def param(name):
+            return params.get(name, [''])[0]
+        rows = self.railway.render_rows(param('leftTicketDTO.from_station'), param('leftTicketDTO.to_station'),
+                                        param('leftTicketDTO.train_date'))
+        return json.dumps({
+            'httpstatus': 200,
+            'data': {'result': rows, 'flag': '1', 'level': '10', 'sametlc': 'N', 'map': {}},
+            'messages': '',
+            'status': True,
+        }, ensure_ascii=False)
+
+    def price_body(self, params):
+        """按 queryTicketPrice 的格式返回票价：同一车次的票价固定，各座位按二等座票价的倍数计算"""
+        train_no = params.get('train_no', [''])[0]
+        base = 100 + int(hashlib.md5(train_no.encode('utf-8')).hexdigest()[:4], 16) % 500
+        data = {'train_no': train_no, 'OT': []}
+        for seat_type, ratio in PRICE_RATIOS.items():
+            data[ttm.PRICE_FIELDS[seat_type]] = f"¥{base * ratio:.1f}"
+        return json.dumps({'httpstatus': 200, 'data': data, 'messages': [], 'status': True}, ensure_ascii=False)
+
+    def station_js(self):
+        """按 station_name.js 的格式输出本地站点表"""
+        if self._station_js is None:
+            index = ttm.load_station_index() or ttm.StationIndex(ttm.FALLBACK_STATION_CODES)
+            parts = []
+            for i, (name, code) in enumerate(index.name_to_code.items()):
+                full, abbr = index.station_pinyin.get(name, ['', ''])
+                parts.append(f"@{abbr}|{name}|{code}|{full}|{abbr}|{i}")
+            self._station_js = f"var station_names ='{''.join(parts)}';"
+        return self._station_js
+
+
+def record_responses(monitor, from_station, to_station, train_date, out_dir):
+    """从真实的12306录制 init 页面、余票查询和站点表响应，保存为 replay_dir 可用的文件"""
+    os.makedirs(out_dir, exist_ok=True)
+    from_code = monitor.get_station_code(from_station)
+    to_code = monitor.get_station_code(to_station)
+    init_url = (f"{monitor.base_url}/leftTicket/init?linktypeid=dc&fs={from_station},{from_code}"
+                f"&ts={to_station},{to_code}&date={train_date}&flag=N,N,Y")
+    init = monitor.http_get(init_url, 'page')
+    match = re.search(r"var CLeftTicketUrl = '([^']+)'", init.text)
+    ticket_path = match.group(1) if match else 'leftTicket/query'
+    query = monitor.http_get(
+        f"{monitor.base_url}/{ticket_path}?leftTicketDTO.train_date={train_date}&leftTicketDTO.from_station={from_code}"
+        f"&leftTicketDTO.to_station={to_code}&purpose_codes=ADULT", 'xhr')
+    stations = monitor.http_get(f"{monitor.base_url}/resources/js/framework/station_name.js", 'default')
+    for name, response in (('init.html', init), ('query.json', query), ('station_name.js', stations)):
+        with open(os.path.join(out_dir, name), 'w', encoding='utf-8') as f:
+            f.write(response.text)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='本地模拟的12306服务')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8306)
+    parser.add_argument('--trains', type=int, default=20, help='每条线路的车次数')
+    parser.add_argument('--volatility', type=float, default=0.0, help='每个座位每秒切换有票/无票的概率')
+    parser.add_argument('--latency', type=float, default=0.0, help='每个请求的平均附加延迟（秒）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='余票接口返回 502 的概率')
+    parser.add_argument('--html-rate', type=float, default=0.0, help='余票接口返回登录页 HTML 的概率')
+    parser.add_argument('--replay-dir', help='回放录制响应的目录')
+    parser.add_argument('--broken', default='', help='总是返回 502 的余票接口，多个用逗号分隔，如 leftTicket/queryG')
+    parser.add_argument('--record', nargs=3, metavar=('FROM', 'TO', 'DATE'), help='从真实12306录制响应到 --replay-dir')
+    args = parser.parse_args(argv)
+
+    if args.record:
+        if not args.replay_dir:
+            parser.error('--record 需要同时指定 --replay-dir')
+        record_responses(ttm.TrainTicketMonitor(), *args.record, args.replay_dir)
+        print(f"已录制到: {args.replay_dir}")
+        return 0
+
+    server = Fake12306Server(args.host, args.port, FakeRailway(args.trains, args.volatility), latency=args.latency,
+                             error_rate=args.error_rate, html_rate=args.html_rate, replay_dir=args.replay_dir,
+                             broken_paths=[p for p in args.broken.split(',') if p])
+    print(f"模拟12306服务已启动: {server.base_url}")
+    server.serve_forever()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
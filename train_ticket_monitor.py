@@ -3,500 +3,4123 @@ import time
 import json
 import datetime
 import platform
-from prettytable import PrettyTable
 import os
-import yaml  # 需要安装 pyyaml 库
 import random
 import urllib3
 import argparse
+import re
+import urllib.parse
+import hashlib
+import bisect
+import threading
+import heapq
+import concurrent.futures
+import queue
+import sys
+import signal
+import zlib
+import collections
+import types
+import tempfile
+import contextlib
+import unicodedata
+import email.utils
 
 # 根据操作系统选择提醒方式
 system = platform.system()
-if system == 'Windows':
-    import winsound
-elif system == 'Darwin':  # macOS
-    import os
-    def play_alert():
-        os.system('afplay /System/Library/Sounds/Ping.aiff')
-    
-    def show_notification(title, message):
-        """在 macOS 上显示通知"""
-        os_command = f'''
-        osascript -e 'display notification "{message}" with title "{title}"'
-        '''
-        os.system(os_command)
-else:  # Linux 或其他系统
-    import os
-    def play_alert():
-        os.system('echo -e "\a"')  # 使用终端响铃
-    
-    def show_notification(title, message):
-        """尝试在 Linux 上显示通知（如果安装了 notify-send）"""
-        os.system(f'notify-send "{title}" "{message}"')
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-class TrainTicketMonitor:
+STATION_CODES_FILE = 'station_codes.json'
+STATION_PINYIN_FILE = 'station_pinyin.json'
+STATION_CITY_FILE = 'station_cities.json'  # 站名 -> 所属城市（station_name.js 中有城市字段时才生成）
+STATION_META_FILE = 'station_meta.json'  # 站点表的 ETag / Last-Modified，用于条件请求
+BASE_URL = "https://kyfw.12306.cn/otn"
+STATION_NAME_JS_URL = f"{BASE_URL}/resources/js/framework/station_name.js"
+
+# 无法获取站点代码表时使用的内置简化站点代码表
+FALLBACK_STATION_CODES = {
+    '北京': 'BJP', '上海': 'SHH', '广州': 'GZQ', '深圳': 'SZQ',
+    '杭州': 'HZH', '南京': 'NJH', '武汉': 'WHN', '西安': 'XAY',
+    '成都': 'CDW', '重庆': 'CQW', '天津': 'TJP', '长沙': 'CSQ',
+    '郑州': 'ZZF', '济南': 'JNK', '青岛': 'QDK', '大连': 'DLT',
+    '沈阳': 'SYT', '哈尔滨': 'HBB', '长春': 'CCT',
+    '太子城': 'TZC', '清河': 'QIP'
+}
+
+
+def iter_station_js(chunks):
+    """流式解析 station_name.js：逐块读入，每解析出一个站点就产出 (站名, 代码, 全拼, 简拼, 城市)
+
+    文件格式为 var station_names ='@bjb|北京北|VAP|beijingbei|bjb|0|0357|北京|||@...';
+    较早的格式没有城市字段，此时城市为 None。
+    """
+    buffer = ''
+    started = False
+    for chunk in chunks:
+        if not chunk:
+            continue
+        buffer += chunk
+        if not started:
+            if '=' not in buffer:
+                continue
+            buffer = buffer.split('=', 1)[1].lstrip(" '")
+            started = True
+        records = buffer.split('@')
+        buffer = records.pop()  # 最后一段可能不完整，留到下一块
+        for record in records:
+            parts = record.split('|')
+            if len(parts) >= 5:
+                yield parts[1], parts[2], parts[3], parts[4], (parts[7] if len(parts) > 7 else None) or None
+    parts = buffer.strip("';\n ").split('|')
+    if started and len(parts) >= 5:
+        yield parts[1], parts[2], parts[3], parts[4], (parts[7] if len(parts) > 7 else None) or None
+
+
+def derive_station_cities(names):
+    """站点表没有城市字段时按站名推断所属城市
+
+    站名以另一个站名开头、且多出的部分是方位字（北京西）或两个字的地名（北京朝阳、上海虹桥）时，
+    归入较短站名所在的城市。只是近似，个别站点可能归错（如乌兰浩特）。
+    """
+    names = set(names)
+    cities = {}
+    for name in names:
+        for n in range(len(name) - 1, 1, -1):
+            prefix, rest = name[:n], name[n:]
+            if prefix in names and (rest in ('东', '西', '南', '北') or len(rest) == 2):
+                cities[name] = prefix
+                break
+    return cities
+
+
+class StationIndex:
+    """站点索引：站名与代码双向查询，支持前缀和拼音模糊匹配，以及按城市分组"""
+
+    def __init__(self, station_codes, station_pinyin=None, station_cities=None):
+        self.name_to_code = dict(station_codes)
+        self.code_to_name = {code: name for name, code in self.name_to_code.items()}
+        self.station_pinyin = station_pinyin or {}
+        # 站名 -> 城市；城市 -> 该城市所有站名（城市同名的车站排在最前）
+        self.station_city = dict(station_cities) if station_cities else derive_station_cities(self.name_to_code)
+        self.city_stations = {}
+        for name in sorted(self.name_to_code, key=lambda name: (len(name), name)):
+            city = self.station_city.get(name, name)
+            self.city_stations.setdefault(city, []).append(name)
+        # 排好序的键列表，用二分查找做前缀匹配
+        self._names = sorted(self.name_to_code)
+        # 没有拼音的站点（只有站点代码表、没有 station_pinyin.json 时）退而用电报码匹配，
+        # 电报码多取自站名拼音首字母（北京 BJP、上海 SHH），能覆盖大部分主要车站
+        self._pinyin_keys = sorted(
+            (key.lower(), name)
+            for name, code in self.name_to_code.items()
+            for key in ([key for key in self.station_pinyin.get(name, ()) if key] or [code])
+        )
+
+    def __len__(self):
+        return len(self.name_to_code)
+
+    def __contains__(self, station_name):
+        return station_name in self.name_to_code
+
+    def get_code(self, station_name):
+        """站名 -> 代码"""
+        return self.name_to_code.get(station_name)
+
+    def get_name(self, station_code):
+        """代码 -> 站名，未知代码原样返回"""
+        return self.code_to_name.get(station_code, station_code)
+
+    def expand_city(self, station_name):
+        """站名所在城市的所有车站（如 北京 -> 北京、北京南、北京西……），不是城市时只返回它自己"""
+        city = self.station_city.get(station_name, station_name)
+        stations = self.city_stations.get(city)
+        if not stations or station_name not in stations:
+            return [station_name]
+        return list(stations)
+
+    def search(self, keyword, limit=20):
+        """按站名前缀或拼音（全拼/简拼）前缀模糊查找站名，完全匹配的排在最前"""
+        keyword = keyword.strip()
+        if not keyword:
+            return []
+        matches = []
+        if all(ord(c) < 128 for c in keyword):
+            keys, keyword = self._pinyin_keys, keyword.lower()
+            start = bisect.bisect_left(keys, (keyword, ''))
+            for key, name in keys[start:]:
+                if not key.startswith(keyword):
+                    break
+                if name not in matches:
+                    matches.append(name)
+        else:
+            start = bisect.bisect_left(self._names, keyword)
+            for name in self._names[start:]:
+                if not name.startswith(keyword):
+                    break
+                matches.append(name)
+        matches.sort(key=lambda name: (name != keyword, len(name), name))
+        return matches[:limit]
+
+
+_station_index = None
+_station_index_lock = threading.Lock()
+
+
+def load_station_index(codes_file=STATION_CODES_FILE, pinyin_file=STATION_PINYIN_FILE, city_file=STATION_CITY_FILE):
+    """从本地缓存文件加载站点索引，文件不存在或无效时返回 None"""
+    try:
+        with open(codes_file, 'r', encoding='utf-8') as f:
+            station_codes = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    try:
+        with open(pinyin_file, 'r', encoding='utf-8') as f:
+            station_pinyin = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        station_pinyin = None
+    try:
+        with open(city_file, 'r', encoding='utf-8') as f:
+            station_cities = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        station_cities = None
+    return StationIndex(station_codes, station_pinyin, station_cities)
+
+
+def write_json_atomic(path, data, **kwargs):
+    """先写同目录下的临时文件再改名替换，读者不会看到写了一半的文件"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, **kwargs)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def fetch_station_index(session, headers=None, url=STATION_NAME_JS_URL, validators=None):
+    """从12306下载站点代码表，写入本地缓存并返回站点索引
+
+    validators 为上次响应的 {'etag': ..., 'last_modified': ...}，会作为条件请求头发送；
+    服务器返回 304（站点表没有变化）时返回 None。
+    """
+    print("正在从12306获取站点代码表...")
+    request_headers = dict(headers or HEADER_PROFILES['default'])
+    if validators:
+        if validators.get('etag'):
+            request_headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            request_headers['If-Modified-Since'] = validators['last_modified']
+    # 流式下载不经过 http_get，请求数和耗时（含读完响应体）在这里记录
+    endpoint = endpoint_label(url)
+    start = time.perf_counter()
+    status = 'error'
+    try:
+        with session.get(url, headers=request_headers, stream=True, timeout=default_transport.timeout) as response:
+            status = str(response.status_code)
+            if response.status_code == 304:
+                print("站点代码表没有变化")
+                write_json_atomic(STATION_META_FILE, dict(validators, checked_at=time.time()))
+                return None
+            response.raise_for_status()
+            if not response.encoding or response.encoding.lower() == 'iso-8859-1':
+                response.encoding = 'utf-8'
+            station_codes = {}
+            station_pinyin = {}
+            station_cities = {}
+            for name, code, full, abbr, city in iter_station_js(response.iter_content(chunk_size=16384, decode_unicode=True)):
+                station_codes[name] = code  # 站名:代码
+                station_pinyin[name] = [full, abbr]  # 站名:[全拼, 简拼]
+                if city:
+                    station_cities[name] = city
+            meta = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'checked_at': time.time(),
+            }
+    finally:
+        REQUESTS.labels(endpoint, status).add()
+        REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - start)
+    if not station_codes:
+        raise ValueError("站点代码表为空")
+
+    # 保存到本地缓存
+    write_json_atomic(STATION_CODES_FILE, station_codes, indent=2)
+    write_json_atomic(STATION_PINYIN_FILE, station_pinyin)
+    if station_cities:
+        write_json_atomic(STATION_CITY_FILE, station_cities)
+    write_json_atomic(STATION_META_FILE, meta)
+    return StationIndex(station_codes, station_pinyin, station_cities or None)
+
+
+def load_station_meta():
+    try:
+        with open(STATION_META_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def get_station_index(session=None, headers=None, url=STATION_NAME_JS_URL):
+    """获取进程内共享的站点索引，只在首次调用时加载一次；本地没有缓存时从 url 下载"""
+    global _station_index
+    if _station_index is not None:
+        return _station_index
+    with _station_index_lock:
+        if _station_index is None:
+            index = load_station_index()
+            if (index is None or not index.station_pinyin) and session is not None:
+                # 如果本地缓存不存在或无效，则从12306获取；只有站点代码、没有拼音时也重新获取一次，
+                # station_name.js 中带有全拼和简拼，拼音搜索靠它
+                try:
+                    index = fetch_station_index(session, headers, url) or index
+                except Exception as e:
+                    print(f"获取站点代码表失败: {e}")
+            if index is None:
+                # 如果无法从12306获取，则使用内置的简化站点代码表
+                index = StationIndex(FALLBACK_STATION_CODES)
+            _station_index = index
+    return _station_index
+
+
+class StationRefresher:
+    """后台刷新站点代码表
+
+    每隔 interval 秒用条件请求（ETag / If-Modified-Since）检查一次 station_name.js，有变化才下载；
+    新表在流式解析、原子写入文件后直接替换进程内的 _station_index，查询站点时不需要加锁。
+    遇到站点表里没有的站名时也会触发刷新，但 min_retry 秒内最多一次。
+    """
+
+    def __init__(self, interval=86400, min_retry=600):
+        self.interval = interval
+        self.min_retry = min_retry
+        self._lock = threading.Lock()
+        self._last_attempt = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self, session, url=STATION_NAME_JS_URL, headers=None):
+        """检查并刷新站点表，有更新时返回 True；同一时间只有一个线程在刷新"""
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            self._last_attempt = time.time()
+            has_local = _station_index is not None and os.path.exists(STATION_CODES_FILE)
+            index = fetch_station_index(session, headers, url, load_station_meta() if has_local else None)
+        except Exception as e:
+            print(f"刷新站点代码表失败: {e}")
+            return False
+        finally:
+            self._lock.release()
+        if index is None:
+            return False
+        swap_station_index(index)
+        print(f"站点代码表已更新: {len(index)} 个站点")
+        return True
+
+    def lookup_missing(self, station_name, session, url=STATION_NAME_JS_URL, headers=None):
+        """站名不在当前站点表中时刷新一次（min_retry 秒内最多一次），返回刷新后的代码"""
+        if time.time() - self._last_attempt < self.min_retry:
+            return None
+        print(f"站点表中没有 {station_name}，尝试更新站点代码表")
+        self.refresh(session, url, headers)
+        return get_station_index().get_code(station_name)
+
+    def start(self, session, url=STATION_NAME_JS_URL, headers=None):
+        """启动后台刷新线程"""
+        if self._thread is None and self.interval:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(session, url, headers),
+                                            name='station-refresh', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(5)
+            self._thread = None
+
+    def _run(self, session, url, headers):
+        checked_at = load_station_meta().get('checked_at', 0)
+        delay = max(0.0, checked_at + self.interval - time.time())
+        while not self._stop.wait(delay):
+            self.refresh(session, url, headers)
+            delay = self.interval
+
+
+def swap_station_index(index):
+    """用新的站点索引替换进程内共享的索引（引用赋值是原子的，读者无需加锁）"""
+    global _station_index
+    _station_index = index
+
+
+station_refresher = StationRefresher()
+
+
+# 座位类型及其在 leftTicket 结果中的字段位置
+SEAT_FIELDS = (
+    ('商务座', 32),
+    ('一等座', 31),
+    ('二等座', 30),
+    ('高级软卧', 21),
+    ('软卧', 23),
+    ('动卧', 33),
+    ('硬卧', 28),
+    ('软座', 24),
+    ('硬座', 29),
+    ('无座', 26),
+)
+SEAT_TYPES = tuple(name for name, _ in SEAT_FIELDS)
+SEAT_BITS = {name: 1 << i for i, name in enumerate(SEAT_TYPES)}
+DEFAULT_SEAT_TYPES = ('二等座', '一等座', '商务座', '硬卧', '软卧', '硬座')
+# "有" 表示余票充足，具体数量未知
+TICKETS_PLENTY = 99
+
+
+def seat_mask(seat_types=None):
+    """把座位类型列表转换为位掩码，未指定时使用默认座位类型"""
+    mask = 0
+    for seat_type in seat_types or DEFAULT_SEAT_TYPES:
+        mask |= SEAT_BITS.get(seat_type, 0)
+    return mask
+
+
+def decode_seat_count(text):
+    """把余票字段转换为数量："有" 为 TICKETS_PLENTY，"无"/"--"/空/"*" 为 0"""
+    if text == '有':
+        return TICKETS_PLENTY
+    if text.isdigit():
+        return int(text)
+    return 0
+
+
+class TrainTicket:
+    """一个车次的余票信息"""
+    __slots__ = ('train_no', 'train_code', 'from_station', 'to_station', 'departure_time',
+                 'arrival_time', 'duration', 'yp_info', 'from_station_no', 'to_station_no',
+                 'seat_type_codes', 'seat_texts', 'seat_counts', 'available_mask')
+
+    def __init__(self, fields):
+        self.train_no = fields[2]  # 列车编号
+        self.train_code = fields[3]  # 车次
+        self.from_station = fields[6]  # 出发站代码
+        self.to_station = fields[7]  # 到达站代码
+        self.departure_time = fields[8]  # 出发时间
+        self.arrival_time = fields[9]  # 到达时间
+        self.duration = fields[10]  # 历时
+        # 查询票价需要的字段：票价信息、出发/到达站在本车次中的序号、座位类型代码（如 "OM9"）
+        self.yp_info = fields[12]
+        self.from_station_no = fields[16]
+        self.to_station_no = fields[17]
+        self.seat_type_codes = fields[35] if len(fields) > 35 else ''
+        # 按 SEAT_TYPES 顺序保存原始文本和数量
+        self.seat_texts = tuple(fields[i] or '--' for _, i in SEAT_FIELDS)
+        self.seat_counts = tuple(decode_seat_count(text) for text in self.seat_texts)
+        mask = 0
+        for i, count in enumerate(self.seat_counts):
+            if count:
+                mask |= 1 << i
+        self.available_mask = mask
+
+    def seat_text(self, seat_type):
+        """某座位类型的余票文本，如 "有"/"无"/"5"/"--" """
+        return self.seat_texts[SEAT_TYPES.index(seat_type)] if seat_type in SEAT_BITS else '--'
+
+    def seat_count(self, seat_type):
+        """某座位类型的余票数量"""
+        return self.seat_counts[SEAT_TYPES.index(seat_type)] if seat_type in SEAT_BITS else 0
+
+    def available_seats(self, mask=None):
+        """有票的座位类型列表，可用掩码限定范围"""
+        bits = self.available_mask if mask is None else self.available_mask & mask
+        return [name for i, name in enumerate(SEAT_TYPES) if bits >> i & 1]
+
+    def __repr__(self):
+        return f"TrainTicket({self.train_code!r}, {self.departure_time!r})"
+
+
+def parse_ticket_result(result, train_codes=None):
+    """解析 leftTicket 接口 data.result 中的车次数据"""
+    tickets = []
+    for ticket_info in result:
+        ticket_data = ticket_info.split('|')
+        if len(ticket_data) < 34:  # 确保数据完整
+            continue
+        # 如果指定了车次，只返回指定车次的信息
+        if train_codes and ticket_data[3] not in train_codes:
+            continue
+        tickets.append(TrainTicket(ticket_data))
+    return tickets
+
+
+class _InflightCall:
+    """正在进行的一次调用：后来的线程等待 event，再共享 result 或 error（单飞合并用）"""
+    __slots__ = ('event', 'result', 'error')
+
     def __init__(self):
-        self.session = requests.Session()
-        self.headers = {
-            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class EndpointCache:
+    """查询接口路径缓存
+
+    保存从 leftTicket/init 页面发现的 CLeftTicketUrl（带过期时间），供所有线路共享。
+    过期后由 load() 重新发现，并发的多个线程只有一个去加载 init 页面。
+    """
+
+    def __init__(self, ttl=1800):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._url = None
+        self._expires_at = 0.0
+        self._inflight = None  # 正在进行的重新发现（_InflightCall）
+
+    def get(self):
+        """返回未过期的接口路径，没有时返回 None"""
+        with self._lock:
+            if self._url and time.time() < self._expires_at:
+                CACHE_LOOKUPS.labels('left_ticket_url', 'hit').add()
+                return self._url
+        CACHE_LOOKUPS.labels('left_ticket_url', 'miss').add()
+        return None
+
+    def set(self, url):
+        with self._lock:
+            self._url = url
+            self._expires_at = time.time() + self.ttl
+
+    def load(self, discover):
+        """调用 discover() 重新发现接口路径并缓存，返回路径（发现失败时为 None）
+
+        与 QueryCoalescer.fetch 相同的合并方式：同时只有一个线程调用 discover，其余等待并共享结果（包括异常）；
+        等到锁时其他线程已经加载好的，直接返回缓存。
+        """
+        with self._lock:
+            if self._url and time.time() < self._expires_at:
+                return self._url
+            call = self._inflight
+            leader = call is None
+            if leader:
+                call = self._inflight = _InflightCall()
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = discover()
+            if call.result:
+                self.set(call.result)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight = None
+            call.event.set()
+
+    def invalidate(self):
+        """接口返回 HTML、非JSON或错误状态时调用，下次重新发现"""
+        with self._lock:
+            self._url = None
+            self._expires_at = 0.0
+
+
+# 备用查询接口，12306 会不定期切换
+LEFT_TICKET_PATHS = ('leftTicket/query', 'leftTicket/queryZ', 'leftTicket/queryA')
+left_ticket_url_cache = EndpointCache()
+
+
+class QueryError(Exception):
+    """查询失败；throttled 表示疑似被12306限流（返回 403/429 或 HTML 页面）"""
+
+    def __init__(self, message, throttled=False):
+        super().__init__(message)
+        self.throttled = throttled
+
+
+def is_throttled_response(response):
+    """判断响应是否像是被限流或被重定向到了网页"""
+    # 只看内容开头的字节，不解码整个响应（leftTicket 的响应可能很大）
+    return response.status_code in (403, 429) or b'<html' in response.content[:512].lower()
+
+
+class TokenBucket:
+    """令牌桶：平均每秒 rate 个请求，最多突发 burst 个"""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """取一个令牌，不够时等待；返回等待的秒数"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # 先预占令牌（可以为负），多个线程按到达顺序依次等待
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def try_acquire(self):
+        """不等待地取一个令牌，取不到返回 False"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class RateLimiter:
+    """按主机限速，每个主机一个令牌桶"""
+
+    def __init__(self, rate=1.0, burst=3):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        bucket = self._buckets.get(host)
+        if bucket is None:
+            with self._lock:
+                bucket = self._buckets.setdefault(host, TokenBucket(self.rate, self.burst))
+        return bucket.acquire()
+
+
+def backoff_delay(failures, base, max_delay=600):
+    """指数退避，带随机抖动，避免所有任务在同一时刻重试"""
+    delay = min(max_delay, base * 2 ** min(failures, 16))
+    return random.uniform(delay / 2, delay)
+
+
+class HotWindow:
+    """每天的高频轮询时段，如放票时间前后"""
+    __slots__ = ('start', 'end', 'interval')
+
+    def __init__(self, start, end, interval):
+        self.start = self._parse(start)
+        self.end = self._parse(end)
+        self.interval = interval
+
+    @staticmethod
+    def _parse(value):
+        # "HH:MM" 或 "HH:MM:SS" -> 当天的秒数
+        parts = [int(x) for x in str(value).split(':')]
+        return parts[0] * 3600 + parts[1] * 60 + (parts[2] if len(parts) > 2 else 0)
+
+    def contains(self, seconds):
+        if self.start <= self.end:
+            return self.start <= seconds < self.end
+        return seconds >= self.start or seconds < self.end  # 跨零点
+
+    def seconds_until_start(self, seconds):
+        return (self.start - seconds) % 86400
+
+
+def parse_hot_windows(entries):
+    """从配置解析高频时段列表，如 [{'start': '07:55', 'end': '08:10', 'interval': 3}]"""
+    return [HotWindow(e['start'], e['end'], e['interval']) for e in entries or []]
+
+
+def seconds_of_day(timestamp=None):
+    t = time.localtime(timestamp)
+    return t.tm_hour * 3600 + t.tm_min * 60 + t.tm_sec
+
+
+class _ThreadCells:
+    """按线程分片的计数单元：每个线程只写自己的那一格，写入不需要加锁，读取时求和"""
+    __slots__ = ('_cells',)
+
+    def __init__(self):
+        self._cells = {}
+
+    def add(self, amount=1):
+        tid = threading.get_ident()
+        cells = self._cells
+        cells[tid] = cells.get(tid, 0) + amount
+
+    def value(self):
+        return sum(list(self._cells.values()))
+
+
+class Counter:
+    """只增不减的计数器"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, _ThreadCells())
+        return child
+
+    def inc(self, amount=1):
+        self.labels().add(amount)
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for values, child in list(self._children.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, values)} {child.value()}")
+        return lines
+
+
+class _HistogramChild:
+    __slots__ = ('buckets', '_cells')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._cells = {}  # 线程 -> [各桶计数..., 总数, 总和]
+
+    def observe(self, value):
+        tid = threading.get_ident()
+        cell = self._cells.get(tid)
+        if cell is None:
+            cell = self._cells[tid] = [0] * (len(self.buckets) + 1) + [0.0]
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def snapshot(self):
+        totals = [0] * (len(self.buckets) + 1) + [0.0]
+        for cell in list(self._cells.values()):
+            for i, v in enumerate(cell):
+                totals[i] += v
+        return totals
+
+
+class Histogram:
+    """直方图，桶上界为 buckets（秒）"""
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, _HistogramChild(self.buckets))
+        return child
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for values, child in list(self._children.items()):
+            totals = child.snapshot()
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), totals):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                labels = _format_labels(self.labelnames + ('le',), values + (le,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{labels} {totals[-1]}")
+        return lines
+
+
+class Gauge:
+    """瞬时值，每个标签组合的值由回调函数在采集时给出（如队列长度）"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._functions = {}
+
+    def set_function(self, values, function):
+        self._functions[tuple(values)] = function
+
+    def remove(self, values):
+        self._functions.pop(tuple(values), None)
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        for values, function in list(self._functions.items()):
+            try:
+                value = function()
+            except Exception:
+                continue
+            lines.append(f"{self.name}{_format_labels(self.labelnames, values)} {value}")
+        return lines
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                     for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class MetricsRegistry:
+    """指标注册表，按 Prometheus 文本格式输出"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=Histogram.DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+REQUESTS = metrics.counter('ticket_monitor_requests_total', '发往12306的请求数', ('endpoint', 'status'))
+REQUEST_SECONDS = metrics.histogram('ticket_monitor_request_duration_seconds', '请求耗时', ('endpoint',))
+HTML_RESPONSES = metrics.counter('ticket_monitor_html_responses_total', '查询接口返回 HTML 页面的次数', ('endpoint',))
+LOGIN_REQUIRED = metrics.counter('ticket_monitor_login_required_total', '页面要求登录12306账号的次数')
+PARSE_FAILURES = metrics.counter('ticket_monitor_parse_failures_total', '响应无法解析（非JSON或结构不对）的次数')
+CACHE_LOOKUPS = metrics.counter('ticket_monitor_cache_lookups_total', '各缓存的命中/未命中次数', ('cache', 'result'))
+ALERTS = metrics.counter('ticket_monitor_alerts_total', '提醒数量', ('result',))
+ALERT_LATENCY = metrics.histogram('ticket_monitor_alert_latency_seconds', '从发现有票到提醒发送完成的耗时')
+QUEUE_DEPTH = metrics.gauge('ticket_monitor_queue_depth', '各队列当前长度', ('queue',))
+
+
+def endpoint_label(url):
+    """把请求 URL 归类为指标里的 endpoint 标签"""
+    path = urllib.parse.urlsplit(url).path
+    if path.endswith('/leftTicket/init'):
+        return 'web_init'
+    if path.endswith('station_name.js'):
+        return 'station_name_js'
+    return path.rsplit('/', 1)[-1] or path
+
+
+class MetricsServer:
+    """在本地端口上提供 /metrics"""
+
+    def __init__(self, registry=metrics, host='127.0.0.1', port=9306):
+        import http.server
+        import socketserver
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+            daemon_threads = True
+
+        self._httpd = Server((host, port), Handler)
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._httpd.server_address[:2]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='metrics', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+class _NullSpan:
+    """追踪关闭时使用的空 span，几乎没有开销"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ('tracer', 'name', 'args', 'start')
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.record(self.name, self.start, time.perf_counter() - self.start, self.args)
+        return False
+
+
+class Tracer:
+    """记录每次查询各阶段（限速等待、init 页面、HTTP 请求、JSON 解码、解析、显示等）的耗时
+
+    默认关闭，关闭时 span() 返回同一个空对象。开启后保存最近 max_events 个事件，可导出为
+    Chrome trace-event JSON（在 chrome://tracing 或 Perfetto 中打开），并对每个阶段保留最近 window 次耗时用于统计。
+    """
+
+    def __init__(self, enabled=False, max_events=200000, window=1000):
+        self.enabled = enabled
+        self.window = window
+        self._events = collections.deque(maxlen=max_events)
+        self._durations = {}  # 阶段 -> 最近 window 次耗时
+        self._epoch = time.perf_counter()
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def span(self, name, args=None):
+        """用法: with tracer.span('parse'): ..."""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, args)
+
+    def record(self, name, start, duration, args=None):
+        event = {
+            'name': name,
+            'cat': 'poll',
+            'ph': 'X',
+            'ts': (start - self._epoch) * 1e6,
+            'dur': duration * 1e6,
+            'pid': self._pid,
+            'tid': threading.get_ident(),
         }
-        self.proxies = None
-        
-    def set_proxy(self, proxy=None):
-        """设置代理"""
-        if proxy:
-            self.proxies = {
-                'http': proxy,
-                'https': proxy
+        if args:
+            event['args'] = args
+        with self._lock:
+            self._events.append(event)
+            durations = self._durations.get(name)
+            if durations is None:
+                durations = self._durations[name] = collections.deque(maxlen=self.window)
+            durations.append(duration)
+
+    def export_chrome_trace(self, path):
+        """导出为 Chrome trace-event JSON 文件"""
+        with self._lock:
+            events = list(self._events)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, ensure_ascii=False)
+        return len(events)
+
+    def summary(self):
+        """每个阶段最近 window 次的耗时统计（毫秒）"""
+        with self._lock:
+            snapshot = {name: sorted(durations) for name, durations in self._durations.items()}
+        result = {}
+        for name, durations in snapshot.items():
+            count = len(durations)
+            result[name] = {
+                'count': count,
+                'total_ms': sum(durations) * 1000,
+                'mean_ms': sum(durations) / count * 1000,
+                'p50_ms': durations[count // 2] * 1000,
+                'p99_ms': durations[min(count - 1, int(count * 0.99))] * 1000,
+                'max_ms': durations[-1] * 1000,
             }
-            print(f"已设置代理: {proxy}")
+        return result
+
+    def format_summary(self):
+        lines = [f"{'阶段':<16}{'次数':>8}{'平均ms':>10}{'p50ms':>10}{'p99ms':>10}{'最大ms':>10}"]
+        for name, stats in sorted(self.summary().items(), key=lambda item: -item[1]['total_ms']):
+            lines.append(f"{name:<16}{stats['count']:>8}{stats['mean_ms']:>10.2f}{stats['p50_ms']:>10.2f}"
+                         f"{stats['p99_ms']:>10.2f}{stats['max_ms']:>10.2f}")
+        return "\n".join(lines)
+
+
+# 全局追踪器，用 --trace 开启
+tracer = Tracer()
+
+
+# 所有监控器共享的默认限速器
+default_rate_limiter = RateLimiter()
+
+
+# 查询路线：WEB_ROUTE 为先加载 init 页面获取 CLeftTicketUrl 再查询，其余为直接请求备用接口
+WEB_ROUTE = 'web'
+QUERY_ROUTES = (WEB_ROUTE,) + LEFT_TICKET_PATHS
+
+CIRCUIT_CLOSED = 'closed'
+CIRCUIT_OPEN = 'open'
+CIRCUIT_HALF_OPEN = 'half_open'
+CIRCUIT_STATE_VALUES = {CIRCUIT_CLOSED: 0, CIRCUIT_HALF_OPEN: 1, CIRCUIT_OPEN: 2}
+
+ENDPOINT_STATE = metrics.gauge('ticket_monitor_endpoint_circuit_state', '查询路线熔断状态：0 正常，1 半开，2 熔断', ('route',))
+ENDPOINT_LATENCY = metrics.gauge('ticket_monitor_endpoint_latency_seconds', '查询路线成功请求耗时的滑动平均', ('route',))
+
+
+class EndpointHealth:
+    """一条查询路线的健康状况与熔断器
+
+    连续失败 failure_threshold 次后熔断；熔断 reset_timeout 秒后进入半开状态，
+    只放行一次探测请求，成功则恢复，失败则重新熔断。
+    """
+    __slots__ = ('name', 'failure_threshold', 'reset_timeout', 'alpha', 'state', 'failures',
+                 'latency', 'opened_at', 'probe_started_at', 'successes', 'total_failures')
+
+    def __init__(self, name, failure_threshold=3, reset_timeout=60, alpha=0.3):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.alpha = alpha
+        self.state = CIRCUIT_CLOSED
+        self.failures = 0         # 连续失败次数
+        self.latency = None       # 成功请求耗时的指数滑动平均
+        self.opened_at = 0.0
+        self.probe_started_at = None
+        self.successes = 0
+        self.total_failures = 0
+
+    def allow(self, now):
+        """本次查询能否使用这条路线；半开状态下只有第一个调用者拿到探测机会"""
+        if self.state == CIRCUIT_CLOSED:
+            return True
+        if self.state == CIRCUIT_OPEN:
+            if now - self.opened_at < self.reset_timeout:
+                return False
+            self.state = CIRCUIT_HALF_OPEN
+            self.probe_started_at = now
+            return True
+        # 半开：探测请求迟迟没有结果（比如被更快的路线抢先返回而没用上）时重新放行
+        if self.probe_started_at is None or now - self.probe_started_at >= self.reset_timeout:
+            self.probe_started_at = now
+            return True
+        return False
+
+    def record_success(self, latency):
+        self.successes += 1
+        self.failures = 0
+        self.state = CIRCUIT_CLOSED
+        self.probe_started_at = None
+        if self.latency is None:
+            self.latency = latency
         else:
-            self.proxies = None
-        
-    def query_tickets(self, from_station, to_station, train_date, train_codes=None):
-        """查询车票信息"""
-        # 首先尝试从网页爬取
-        tickets = self.query_tickets_from_web(from_station, to_station, train_date, train_codes)
-        if tickets:
-            return tickets
-        
-        # 如果网页爬取失败，尝试使用API
-        print("从网页爬取失败，尝试使用API...")
-        
-        # 获取站点代码
-        from_code = self.get_station_code(from_station)
-        to_code = self.get_station_code(to_station)
-        
-        if not from_code or not to_code:
-            print(f"无法找到站点代码: {from_station} 或 {to_station}")
-            return []
-            
-        # 构建查询URL - 使用最新的12306 API
-        # 12306的API可能会变化，这里使用最可能有效的端点
-        api_endpoints = [
-            f"https://kyfw.12306.cn/otn/leftTicket/query?leftTicketDTO.train_date={train_date}&leftTicketDTO.from_station={from_code}&leftTicketDTO.to_station={to_code}&purpose_codes=ADULT",
-            f"https://kyfw.12306.cn/otn/leftTicket/queryZ?leftTicketDTO.train_date={train_date}&leftTicketDTO.from_station={from_code}&leftTicketDTO.to_station={to_code}&purpose_codes=ADULT",
-            f"https://kyfw.12306.cn/otn/leftTicket/queryA?leftTicketDTO.train_date={train_date}&leftTicketDTO.from_station={from_code}&leftTicketDTO.to_station={to_code}&purpose_codes=ADULT"
-        ]
-        
-        # 添加更多请求头，模拟真实浏览器
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'Accept': '*/*',
-            'Accept-Language': 'zh-CN,zh;q=0.9,en;q=0.8',
-            'Referer': 'https://kyfw.12306.cn/otn/leftTicket/init',
-            'Connection': 'keep-alive',
-            'sec-ch-ua': '"Google Chrome";v="120", "Chromium";v="120", "Not-A.Brand";v="99"',
-            'sec-ch-ua-mobile': '?0',
-            'sec-ch-ua-platform': '"macOS"',
-            'Sec-Fetch-Dest': 'empty',
-            'Sec-Fetch-Mode': 'cors',
-            'Sec-Fetch-Site': 'same-origin',
-            'X-Requested-With': 'XMLHttpRequest',
+            self.latency += self.alpha * (latency - self.latency)
+
+    def record_failure(self, now):
+        self.total_failures += 1
+        self.failures += 1
+        if self.state == CIRCUIT_HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != CIRCUIT_OPEN:
+                print(f"查询路线 {self.name} 连续失败 {self.failures} 次，暂停使用 {self.reset_timeout} 秒")
+            self.state = CIRCUIT_OPEN
+            self.opened_at = now
+            self.probe_started_at = None
+
+
+class EndpointRouter:
+    """在各条查询路线之间选择：跳过熔断的路线，半开探测优先，其余按平均耗时从快到慢"""
+
+    def __init__(self, routes=QUERY_ROUTES, failure_threshold=3, reset_timeout=60, alpha=0.3):
+        self.routes = tuple(routes)
+        self._lock = threading.Lock()
+        self._health = {
+            name: EndpointHealth(name, failure_threshold, reset_timeout, alpha) for name in self.routes
         }
-        
-        # 添加随机延迟，避免被反爬
-        delay = random.uniform(1, 3)
-        print(f"随机延迟 {delay:.2f} 秒...")
-        time.sleep(delay)
-        
-        try:
-            # 尝试所有API端点
-            for endpoint_url in api_endpoints:
-                print(f"尝试API端点: {endpoint_url}")
-                
-                try:
-                    # 添加随机延迟，避免请求过于频繁
-                    time.sleep(random.uniform(0.5, 1.5))
-                    
-                    # 发送请求
-                    response = self.session.get(
-                        endpoint_url, 
-                        headers=headers, 
-                        timeout=15,
-                        proxies=self.proxies,
-                        verify=False  # 禁用SSL验证，可能有助于解决某些连接问题
-                    )
-                    response.raise_for_status()
-                    
-                    # 打印响应内容以便调试
-                    print(f"API响应状态码: {response.status_code}")
-                    
-                    # 检查响应是否为空
-                    if not response.text.strip():
-                        print("API返回空响应")
-                        continue
-                    
-                    # 尝试解析JSON
+
+    def register_metrics(self):
+        """把各路线状态登记到 /metrics（进程内只对实际使用的路由器登记）"""
+        for name, health in self._health.items():
+            ENDPOINT_STATE.set_function((name,), lambda h=health: CIRCUIT_STATE_VALUES[h.state])
+            ENDPOINT_LATENCY.set_function((name,), lambda h=health: h.latency or 0)
+        return self
+
+    def health(self, name):
+        return self._health[name]
+
+    def ordered(self, now=None):
+        """返回本次查询依次尝试的路线；全部熔断时返回空列表"""
+        now = time.time() if now is None else now
+        probes = []
+        healthy = []
+        with self._lock:
+            for index, name in enumerate(self.routes):
+                health = self._health[name]
+                if not health.allow(now):
+                    continue
+                if health.state == CIRCUIT_HALF_OPEN:
+                    probes.append(name)
+                else:
+                    # 测过耗时的路线按耗时排序，没测过的按声明顺序排在后面
+                    healthy.append((health.latency is None, health.latency or 0, index, name))
+        healthy.sort()
+        return probes + [item[-1] for item in healthy]
+
+    def record_success(self, name, latency):
+        with self._lock:
+            self._health[name].record_success(latency)
+
+    def record_failure(self, name, now=None):
+        with self._lock:
+            self._health[name].record_failure(time.time() if now is None else now)
+
+    def format_status(self):
+        lines = []
+        for name in self.routes:
+            health = self._health[name]
+            latency = f"{health.latency * 1000:.0f} ms" if health.latency is not None else "-"
+            lines.append(f"{name:<20} {health.state:<10} 平均耗时 {latency:>8}  成功 {health.successes}  失败 {health.total_failures}")
+        return "\n".join(lines)
+
+
+# 所有监控器共享的查询路线状态
+endpoint_router = EndpointRouter().register_metrics()
+
+
+PROXY_REQUESTS = metrics.counter('ticket_monitor_proxy_requests_total', '经各代理发出的请求数', ('proxy', 'result'))
+PROXY_STATE = metrics.gauge('ticket_monitor_proxy_in_flight', '各代理上正在进行的请求数，已剔除的代理为 -1', ('proxy',))
+
+
+class ProxyEndpoint:
+    """代理池中的一个代理：独立的 Session 连接池、令牌桶和健康统计"""
+
+    def __init__(self, url, rate=1.0, burst=3, pool_size=8, alpha=0.3, transport=None):
+        self.url = url
+        self.proxies = {'http': url, 'https': url}
+        self.session = (transport or default_transport).make_session(pool_size)
+        self.bucket = TokenBucket(rate, burst)
+        self.alpha = alpha
+        self.in_flight = 0
+        self.latency = None        # 成功请求耗时的指数滑动平均
+        self.failures = 0          # 连续失败次数
+        self.ejected_until = 0.0
+        self.successes = 0
+        self.total_failures = 0
+
+    def ejected(self, now):
+        return now < self.ejected_until
+
+    def score(self):
+        """越小越好：平均耗时，按连续失败次数加罚"""
+        return (self.latency or 0.0) * (1 + self.failures)
+
+    def __repr__(self):
+        return f"ProxyEndpoint({self.url!r})"
+
+
+class ProxyPool:
+    """代理池：按轮询（round_robin）或最少在途请求（least_loaded）选择代理
+
+    每个代理各自限速（rate/burst），当前代理没有令牌时换下一个有令牌的代理，都没有时在最合适的代理上等待。
+    连续失败 max_failures 次的代理被剔除 eject_time 秒，之后重新加入；重新加入后再失败一次立即再次剔除。
+    所有代理都被剔除时仍使用最早恢复的那个，不会让查询完全停下。
+    """
+
+    STRATEGIES = ('round_robin', 'least_loaded')
+
+    def __init__(self, proxies, strategy='round_robin', rate=1.0, burst=3, max_failures=3, eject_time=120,
+                 pool_size=8, alpha=0.3, transport=None):
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"未知的代理选择策略: {strategy}")
+        self.strategy = strategy
+        self.max_failures = max_failures
+        self.eject_time = eject_time
+        self.endpoints = [ProxyEndpoint(url, rate, burst, pool_size, alpha, transport) for url in proxies]
+        if not self.endpoints:
+            raise ValueError("代理池为空")
+        self._lock = threading.Lock()
+        self._next = 0
+        for endpoint in self.endpoints:
+            PROXY_STATE.set_function((endpoint.url,),
+                                     lambda e=endpoint: -1 if e.ejected(time.time()) else e.in_flight)
+
+    @classmethod
+    def from_config(cls, config, pool_size=8):
+        """从配置创建：proxies 为代理列表，file 为每行一个代理的文件（# 开头为注释），其余为构造参数"""
+        options = dict(config)
+        proxies = list(options.pop('proxies', None) or [])
+        path = options.pop('file', None)
+        if path:
+            proxies.extend(load_proxy_file(path))
+        options.setdefault('pool_size', pool_size)
+        return cls(proxies, **options)
+
+    def _candidates(self, now):
+        # 调用方需持有 self._lock
+        healthy = [e for e in self.endpoints if not e.ejected(now)]
+        if not healthy:
+            return [min(self.endpoints, key=lambda e: e.ejected_until)]
+        if self.strategy == 'least_loaded':
+            return sorted(healthy, key=lambda e: (e.in_flight, e.score()))
+        start = self._next % len(self.endpoints)
+        self._next += 1
+        ordered = self.endpoints[start:] + self.endpoints[:start]
+        return [e for e in ordered if not e.ejected(now)]
+
+    def acquire(self):
+        """选出本次请求使用的代理并占用它的一个令牌"""
+        with self._lock:
+            candidates = self._candidates(time.time())
+            for endpoint in candidates:
+                if endpoint.bucket.try_acquire():
+                    endpoint.in_flight += 1
+                    return endpoint
+            endpoint = candidates[0]
+            endpoint.in_flight += 1
+        endpoint.bucket.acquire()
+        return endpoint
+
+    def release(self, endpoint, ok, latency=None):
+        """请求结束后更新代理的健康统计"""
+        with self._lock:
+            endpoint.in_flight -= 1
+            if ok:
+                endpoint.successes += 1
+                endpoint.failures = 0
+                if latency is not None:
+                    if endpoint.latency is None:
+                        endpoint.latency = latency
+                    else:
+                        endpoint.latency += endpoint.alpha * (latency - endpoint.latency)
+                PROXY_REQUESTS.labels(endpoint.url, 'ok').add()
+                return
+            endpoint.total_failures += 1
+            endpoint.failures += 1
+            PROXY_REQUESTS.labels(endpoint.url, 'failed').add()
+            if endpoint.failures >= self.max_failures:
+                endpoint.ejected_until = time.time() + self.eject_time
+                # 重新加入后处于观察期：再失败一次就再次剔除
+                endpoint.failures = self.max_failures - 1
+                print(f"代理 {endpoint.url} 连续失败，暂停使用 {self.eject_time} 秒")
+
+    def format_status(self):
+        now = time.time()
+        lines = []
+        for e in self.endpoints:
+            state = f"剔除中（剩余 {e.ejected_until - now:.0f} 秒）" if e.ejected(now) else "可用"
+            latency = f"{e.latency * 1000:.0f} ms" if e.latency is not None else "-"
+            lines.append(f"{e.url:<30} {state:<12} 平均耗时 {latency:>8}  成功 {e.successes}  失败 {e.total_failures}")
+        return "\n".join(lines)
+
+
+def load_proxy_file(path):
+    """读取代理列表文件，每行一个代理地址，忽略空行和 # 注释"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+
+
+class Alert:
+    """一条有票提醒，items 为 (车次, 提醒文本) 列表"""
+    __slots__ = ('title', 'job_name', 'items', 'created_at')
+
+    def __init__(self, title, job_name, items, created_at=None):
+        self.title = title
+        self.job_name = job_name
+        self.items = items
+        self.created_at = created_at or time.time()
+
+    @property
+    def message(self):
+        return "\n".join(text for _, text in self.items)
+
+    def to_dict(self):
+        return {
+            'title': self.title,
+            'job': self.job_name,
+            'trains': [train_code for train_code, _ in self.items],
+            'message': self.message,
+            'created_at': self.created_at,
+        }
+
+
+class TerminalBellSink:
+    """响铃提醒（Windows 上用 winsound 蜂鸣，macOS 上播放系统提示音）"""
+
+    def __init__(self, times=5, spacing=0.5):
+        self.times = times
+        self.spacing = spacing
+
+    def send(self, alert):
+        import subprocess
+        for _ in range(self.times):
+            if system == 'Windows':
+                import winsound
+                winsound.Beep(1000, 500)
+            elif system == 'Darwin':
+                subprocess.run(['afplay', '/System/Library/Sounds/Ping.aiff'], check=False)
+            else:
+                sys.stdout.write('\a')  # 使用终端响铃
+                sys.stdout.flush()
+            time.sleep(self.spacing)
+
+
+class DesktopSink:
+    """系统通知：macOS 用 osascript，Linux 用 notify-send（如果安装了）"""
+
+    def send(self, alert):
+        import subprocess
+        if system == 'Darwin':
+            def quote(text):
+                return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+            script = f"display notification {quote(alert.message)} with title {quote(alert.title)}"
+            subprocess.run(['osascript', '-e', script], check=False)
+        elif system == 'Linux':
+            try:
+                subprocess.run(['notify-send', alert.title, alert.message], check=False)
+            except FileNotFoundError:
+                pass
+
+
+class JsonLinesSink:
+    """把提醒逐行追加写入 JSON Lines 文件"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, alert):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(alert.to_dict(), ensure_ascii=False) + "\n")
+
+
+class WebhookSink:
+    """以 JSON 格式 POST 提醒到 HTTP 接口"""
+
+    def __init__(self, url, timeout=5, headers=None):
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        if headers:
+            self.session.headers.update(headers)
+
+    def send(self, alert):
+        response = self.session.post(self.url, json=alert.to_dict(), timeout=self.timeout)
+        response.raise_for_status()
+
+
+class Notifier:
+    """后台提醒队列
+
+    notify() 只做去重和限流判断后放入队列，立即返回；提醒由独立线程依次发送到各个 sink，
+    某个 sink 出错或很慢都不会阻塞轮询。同一任务同一车次在 debounce 秒内只提醒一次，
+    全部提醒每分钟最多 max_per_minute 条。
+    """
+
+    def __init__(self, sinks, debounce=300, max_per_minute=30, queue_size=1000):
+        self.sinks = list(sinks)
+        self.debounce = debounce
+        self.sent = 0
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._rate = TokenBucket(max_per_minute / 60.0, max_per_minute)
+        self._last_alerted = {}  # (任务名, 车次) -> 上次提醒时间
+        self._lock = threading.Lock()
+        self._thread = None
+        QUEUE_DEPTH.set_function(('notifier',), self._queue.qsize)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='notifier', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=5):
+        """发送完队列中剩余的提醒后停止"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def notify(self, alert):
+        """提交提醒，不阻塞；被去重、限流或队列已满时返回 False"""
+        now = time.time()
+        with self._lock:
+            items = [item for item in alert.items
+                     if now - self._last_alerted.get((alert.job_name, item[0]), 0) >= self.debounce]
+            if not items:
+                ALERTS.labels('debounced').add()
+                return False
+            if not self._rate.try_acquire():
+                ALERTS.labels('rate_limited').add()
+                self.dropped += 1
+                print(f"提醒过于频繁，已丢弃: {alert.title}")
+                return False
+            for train_code, _ in items:
+                self._last_alerted[(alert.job_name, train_code)] = now
+            if len(self._last_alerted) > 4096:
+                self._last_alerted = {k: t for k, t in self._last_alerted.items() if now - t < self.debounce}
+        alert.items = items
+        try:
+            self._queue.put_nowait(alert)
+        except queue.Full:
+            ALERTS.labels('queue_full').add()
+            self.dropped += 1
+            print(f"提醒队列已满，已丢弃: {alert.title}")
+            return False
+        return True
+
+    def _run(self):
+        while True:
+            alert = self._queue.get()
+            if alert is None:
+                break
+            for sink in self.sinks:
+                try:
+                    sink.send(alert)
+                except Exception as e:
+                    print(f"提醒发送失败 ({type(sink).__name__}): {e}")
+            self.sent += 1
+            ALERTS.labels('sent').add()
+            ALERT_LATENCY.observe(time.time() - alert.created_at)
+
+
+def build_sinks(specs):
+    """根据配置创建提醒 sink，如 ['bell', 'desktop', {'type': 'jsonl', 'path': 'alerts.jsonl'}]"""
+    sinks = []
+    for spec in specs:
+        if isinstance(spec, str):
+            spec = {'type': spec}
+        options = dict(spec)
+        sink_type = options.pop('type')
+        if sink_type == 'bell':
+            sinks.append(TerminalBellSink(**options))
+        elif sink_type == 'desktop':
+            sinks.append(DesktopSink())
+        elif sink_type == 'jsonl':
+            sinks.append(JsonLinesSink(**options))
+        elif sink_type == 'webhook':
+            sinks.append(WebhookSink(**options))
+        else:
+            raise ValueError(f"未知的提醒方式: {sink_type}")
+    return sinks
+
+
+def build_notifier(notify_config=None):
+    """根据配置中的 notify 部分创建提醒队列（未启动）"""
+    notify_config = notify_config or {}
+    return Notifier(
+        build_sinks(notify_config.get('sinks', ['bell', 'desktop'])),
+        debounce=notify_config.get('debounce', 300),
+        max_per_minute=notify_config.get('max_per_minute', 30),
+    )
+
+
+# 压缩：gzip/deflate 由 urllib3 内置解码，br 需要安装 brotli 或 brotlicffi
+try:
+    import brotli  # noqa: F401
+    ACCEPT_ENCODING = 'gzip, deflate, br'
+except ImportError:
+    try:
+        import brotlicffi  # noqa: F401
+        ACCEPT_ENCODING = 'gzip, deflate, br'
+    except ImportError:
+        ACCEPT_ENCODING = 'gzip, deflate'
+
+USER_AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+
+_BROWSER_HEADERS = {
+    'User-Agent': USER_AGENT,
+    'Accept-Language': 'zh-CN,zh;q=0.9,en;q=0.8',
+    'Accept-Encoding': ACCEPT_ENCODING,
+    'Connection': 'keep-alive',
+    'sec-ch-ua': '"Google Chrome";v="120", "Chromium";v="120", "Not-A.Brand";v="99"',
+    'sec-ch-ua-mobile': '?0',
+    'sec-ch-ua-platform': '"macOS"',
+}
+
+# 预先构建、只读的请求头模板，请求时直接引用，不再每次拼字典
+HEADER_PROFILES = {
+    # 普通资源（如 station_name.js）
+    'default': types.MappingProxyType({
+        'User-Agent': USER_AGENT,
+        'Accept-Encoding': ACCEPT_ENCODING,
+    }),
+    # leftTicket/init 页面
+    'page': types.MappingProxyType(dict(_BROWSER_HEADERS, **{
+        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
+        'Referer': 'https://kyfw.12306.cn/otn/index/init',
+        'Upgrade-Insecure-Requests': '1',
+        'Sec-Fetch-Dest': 'document',
+        'Sec-Fetch-Mode': 'navigate',
+        'Sec-Fetch-Site': 'same-origin',
+        'Sec-Fetch-User': '?1',
+    })),
+    # 余票查询接口（页面内的 XHR 请求）
+    'xhr': types.MappingProxyType(dict(_BROWSER_HEADERS, **{
+        'Accept': '*/*',
+        'Referer': 'https://kyfw.12306.cn/otn/leftTicket/init',
+        'Sec-Fetch-Dest': 'empty',
+        'Sec-Fetch-Mode': 'cors',
+        'Sec-Fetch-Site': 'same-origin',
+        'X-Requested-With': 'XMLHttpRequest',
+    })),
+}
+
+HTTP_POOL = metrics.gauge('ticket_monitor_http_pool', '连接池统计：opened 为新建连接数，requests 为发出的请求数，两者之比反映连接复用程度', ('kind',))
+
+
+class Transport:
+    """HTTP 传输层：统一的 Session 配置、请求头模板、重试和超时
+
+    每个 Session 挂载按并发数设置大小的 HTTPAdapter，只在连接没有建立时按 backoff_factor 退避重试：
+    请求已经发出后的读超时和 5xx 不在适配器内重试，否则重试的请求会绕过 http_get 的限速和请求计数，
+    熔断探测也会变成多次请求；这些失败交给调用方的路线切换和退避处理。timeout 为 (连接超时, 读取超时)。
+    """
+
+    def __init__(self, pool_connections=4, pool_maxsize=8, retries=2, backoff_factor=0.3,
+                 connect_timeout=5, read_timeout=15, verify=False):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.timeout = (connect_timeout, read_timeout)
+        self.verify = verify  # 默认不验证证书，可能有助于解决某些连接问题
+        self._adapters = []
+
+    def retry_policy(self):
+        return urllib3.util.Retry(
+            total=self.retries,
+            connect=self.retries,
+            read=0,
+            status=0,
+            other=0,
+            status_forcelist=(),
+            allowed_methods=frozenset(['GET', 'HEAD']),
+            backoff_factor=self.backoff_factor,
+            raise_on_status=False,
+        )
+
+    def mount(self, session, pool_maxsize=None):
+        """给 session 挂载连接池大小为 pool_maxsize 的适配器（替换原有的）"""
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=pool_maxsize or self.pool_maxsize,
+            max_retries=self.retry_policy(),
+        )
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        self._adapters.append(adapter)
+        return adapter
+
+    def make_session(self, pool_maxsize=None):
+        session = requests.Session()
+        self.mount(session, pool_maxsize)
+        return session
+
+    def get(self, session, url, profile='xhr', proxies=None, timeout=None):
+        return session.get(
+            url,
+            headers=HEADER_PROFILES[profile],
+            timeout=timeout or self.timeout,
+            proxies=proxies,
+            verify=self.verify,
+        )
+
+    def pool_stats(self):
+        """所有适配器连接池的 (新建连接数, 请求数)，连接池被回收后其计数不再计入"""
+        opened = sent = 0
+        for adapter in list(self._adapters):
+            managers = [adapter.poolmanager] + list(adapter.proxy_manager.values())
+            for manager in managers:
+                for key in list(manager.pools.keys()):
+                    pool = manager.pools.get(key)
+                    if pool is not None:
+                        opened += pool.num_connections
+                        sent += pool.num_requests
+        return opened, sent
+
+    def register_metrics(self):
+        HTTP_POOL.set_function(('opened',), lambda: self.pool_stats()[0])
+        HTTP_POOL.set_function(('requests',), lambda: self.pool_stats()[1])
+        return self
+
+
+# 所有监控器共享的默认传输层配置
+default_transport = Transport().register_metrics()
+
+
+class TrainTicketMonitor:
+    def __init__(self, transport=None):
+        self.transport = transport or default_transport
+        self.session = self.transport.make_session()
+        self.headers = HEADER_PROFILES['default']
+        self.proxies = None
+        self.base_url = BASE_URL
+        self.left_ticket_url_cache = left_ticket_url_cache
+        self.endpoint_router = endpoint_router
+        self.rate_limiter = default_rate_limiter
+        self.proxy_pool = None
+        self.station_refresher = station_refresher
+        # 查询键 -> (响应内容摘要, 解析结果)，响应内容没变时跳过解析
+        self.response_snapshots = {}
+        
+    def set_proxy(self, proxy=None):
+        """设置代理"""
+        if proxy:
+            self.proxies = {
+                'http': proxy,
+                'https': proxy
+            }
+            print(f"已设置代理: {proxy}")
+        else:
+            self.proxies = None
+    
+    def set_proxy_pool(self, pool):
+        """使用代理池发送请求（每个代理独立限速，不再使用按主机的 rate_limiter）"""
+        self.proxy_pool = pool
+        if pool is not None:
+            print(f"已启用代理池: {len(pool.endpoints)} 个代理，策略 {pool.strategy}")
+        
+    def http_get(self, url, profile='xhr', timeout=None):
+        """按 HEADER_PROFILES 中的请求头模板发送 GET 请求，发送前按主机限速；启用代理池时按代理限速"""
+        proxy = None
+        with tracer.span('rate_limit'):
+            if self.proxy_pool is not None:
+                proxy = self.proxy_pool.acquire()
+            elif self.rate_limiter is not None:
+                self.rate_limiter.acquire(url)
+        session = proxy.session if proxy else self.session
+        endpoint = endpoint_label(url)
+        start = time.perf_counter()
+        status = 'error'
+        ok = False
+        try:
+            with tracer.span('http', {'url': url}):
+                response = self.transport.get(session, url, profile, proxy.proxies if proxy else self.proxies, timeout)
+            status = str(response.status_code)
+            # 成功与否只用于给代理打分，没有代理池时不必检查响应内容
+            ok = proxy is not None and response.status_code < 500 and not is_throttled_response(response)
+            return response
+        finally:
+            elapsed = time.perf_counter() - start
+            REQUESTS.labels(endpoint, status).add()
+            REQUEST_SECONDS.labels(endpoint).observe(elapsed)
+            if proxy is not None:
+                self.proxy_pool.release(proxy, ok, elapsed)
+        
+    @staticmethod
+    def response_digest(response):
+        """响应原始内容的摘要"""
+        return hashlib.blake2b(response.content, digest_size=16).digest()
+        
+    def query_tickets(self, from_station, to_station, train_date, train_codes=None, purpose_code='ADULT', strict=False):
+        """查询车票信息
+
+        按 endpoint_router 给出的顺序尝试各条查询路线，熔断中的路线直接跳过。
+        查询失败时返回空列表；strict 为 True 时改为抛出 QueryError，便于调度器区分"没有车次"和"查询失败"。
+        """
+        # 获取站点代码
+        from_code = self.get_station_code(from_station)
+        to_code = self.get_station_code(to_station)
+        
+        if not from_code or not to_code:
+            print(f"无法找到站点代码: {from_station} 或 {to_station}")
+            if strict:
+                raise QueryError(f"无法找到站点代码: {from_station} 或 {to_station}")
+            return []
+        
+        routes = self.endpoint_router.ordered()
+        if not routes:
+            print("所有查询路线都在熔断中，跳过本次查询")
+            if strict:
+                raise QueryError("所有查询路线都在熔断中")
+            return []
+        
+        throttled = False
+        for route in routes:
+            start = time.perf_counter()
+            try:
+                if route == WEB_ROUTE:
+                    tickets = self.query_tickets_from_web(from_station, to_station, train_date, train_codes, purpose_code, strict=True)
+                else:
+                    tickets = self.query_left_ticket_path(route, from_code, to_code, train_date, train_codes, purpose_code)
+            except QueryError as e:
+                throttled = throttled or e.throttled
+                self.endpoint_router.record_failure(route)
+                print(f"查询路线 {route} 失败: {e}")
+                continue
+            self.endpoint_router.record_success(route, time.perf_counter() - start)
+            return tickets
+        
+        print("所有查询路线都失败，无法获取车票信息")
+        if strict:
+            raise QueryError("所有查询路线都失败，无法获取车票信息", throttled=throttled)
+        return []
+    
+    def query_left_ticket_path(self, path, from_code, to_code, train_date, train_codes=None, purpose_code='ADULT'):
+        """直接请求某个备用查询接口（如 leftTicket/queryZ），失败时抛出 QueryError"""
+        endpoint_url = f"{self.base_url}/{path}?leftTicketDTO.train_date={train_date}&leftTicketDTO.from_station={from_code}&leftTicketDTO.to_station={to_code}&purpose_codes={purpose_code}"
+        snapshot_key = (from_code, to_code, str(train_date), purpose_code, tuple(train_codes) if train_codes else None)
+        
+        print(f"尝试API端点: {endpoint_url}")
+        try:
+            response = self.http_get(endpoint_url, 'xhr')
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            response = getattr(e, 'response', None)
+            raise QueryError(f"请求异常: {e}", throttled=response is not None and is_throttled_response(response)) from e
+        
+        # 检查响应是否为空
+        if not response.text.strip():
+            raise QueryError("API返回空响应")
+        
+        # 响应内容与上次完全相同时直接复用上次的解析结果
+        digest = self.response_digest(response)
+        cached = self.response_snapshots.get(snapshot_key)
+        if cached and cached[0] == digest:
+            CACHE_LOOKUPS.labels('response_body', 'hit').add()
+            return cached[1]
+        CACHE_LOOKUPS.labels('response_body', 'miss').add()
+        
+        # 尝试解析JSON
+        try:
+            with tracer.span('json_decode'):
+                data = response.json()
+        except ValueError as e:
+            PARSE_FAILURES.inc()
+            # 如果响应包含HTML，可能是重定向到登录页面
+            if '<html' in response.text.lower():
+                HTML_RESPONSES.labels(endpoint_label(endpoint_url)).add()
+                raise QueryError("API返回了HTML页面，可能需要登录", throttled=True) from e
+            raise QueryError("响应不是有效的JSON格式") from e
+        
+        # 检查API返回的数据结构
+        if not isinstance(data, dict) or not isinstance(data.get('data'), dict) or 'result' not in data['data']:
+            PARSE_FAILURES.inc()
+            message = data.get('messages') or data.get('message') if isinstance(data, dict) else None
+            raise QueryError(f"返回数据格式不正确: {message}" if message else "返回数据格式不正确")
+        
+        with tracer.span('parse'):
+            tickets = parse_ticket_result(data['data']['result'], train_codes)
+        self.response_snapshots[snapshot_key] = (digest, tickets)
+        if not tickets:
+            print("没有找到符合条件的车次")
+        return tickets
+    
+    def station_index(self):
+        """进程内共享的站点索引，首次使用时从本地缓存或 base_url 下的 station_name.js 加载"""
+        return get_station_index(self.session, self.headers, self.station_name_js_url)
+
+    def get_station_code(self, station_name):
+        """获取站点代码"""
+        code = self.station_index().get_code(station_name)
+        if code:
+            return code
+        # 站点表可能过期了，刷新一次（有时间窗口限制）再查
+        code = self.station_refresher.lookup_missing(station_name, self.session, self.station_name_js_url, self.headers)
+        if code:
+            return code
+        # 站点表里没有时，退回内置的简化站点代码表
+        return FALLBACK_STATION_CODES.get(station_name)
+
+    @property
+    def station_name_js_url(self):
+        return f"{self.base_url}/resources/js/framework/station_name.js"
+
+    def get_station_name(self, station_code):
+        """根据站点代码获取站名"""
+        return self.station_index().get_name(station_code)
+
+    def search_stations(self, keyword, limit=20):
+        """按站名前缀或拼音模糊查找站名，如 "北京" -> 北京/北京南/北京西..."""
+        return self.station_index().search(keyword, limit)
+    
+    def has_available_tickets(self, ticket_info, seat_types=None):
+        """检查是否有可用票"""
+        return bool(ticket_info.available_mask & seat_mask(seat_types))
+    
+    def monitor_tickets(self, from_station, to_station, train_date, train_codes, seat_types=None, interval=60, notifier=None,
+                        hot_windows=None, max_backoff=600):
+        """监控车票，有票时提醒（按 Ctrl+C 停止）
+
+        查询间隔与多任务引擎相同：hot_windows 时段内按时段的间隔，连续失败时指数退避（最长 max_backoff 秒）。
+        """
+        print(f"开始监控 {from_station} 到 {to_station} 在 {train_date} 的车票")
+        print(f"监控车次: {', '.join(train_codes) if train_codes else '所有车次'}")
+        print(f"监控座位类型: {', '.join(seat_types) if seat_types else '所有座位类型'}")
+        print(f"检查间隔: {interval}秒")
+        print("=" * 50)
+        
+        job = WatchJob(from_station, to_station, train_date, train_codes, seat_types, interval, hot_windows=hot_windows)
+        snapshots = SnapshotStore()
+        failures = 0
+        if notifier is None:
+            notifier = Notifier([TerminalBellSink(), DesktopSink()])
+        notifier.start()
+        
+        try:
+            while True:
+                current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                print(f"\n[{current_time}] 正在查询...")
+                
+                try:
+                    tickets = self.query_tickets(from_station, to_station, train_date, train_codes, strict=True)
+                    failures = 0
+                except QueryError as e:
+                    # 查询失败时保留上次的快照，避免恢复后把所有车次当作新出现的再提醒一遍
+                    tickets = None
+                    failures += 2 if e.throttled else 1
+                
+                if tickets:
+                    events = snapshots.update(job, tickets)
+                    if not events:
+                        print("余票没有变化")
+                    else:
+                        self.display_tickets(tickets)
+                    
+                    # 只提醒刚变为有票的车次，提醒在后台发送，不影响继续监控
+                    alert = build_alert(job, events)
+                    if alert:
+                        print("\n发现有票！")
+                        print(alert.message)
+                        notifier.notify(alert)
+                elif tickets is None:
+                    print("查询失败")
+                else:
+                    print("没有查询到符合条件的车次")
+                
+                delay = backoff_delay(failures, job.next_delay(), max_backoff) if failures else job.next_delay()
+                print(f"等待 {delay:.0f} 秒后重新查询...")
+                time.sleep(delay)
+        except KeyboardInterrupt:
+            print("停止监控")
+        finally:
+            notifier.stop()
+    
+    def display_tickets(self, tickets):
+        """显示车票信息"""
+        with tracer.span('display'):
+            self._display_tickets(tickets)
+
+    def _display_tickets(self, tickets):
+        if not tickets:
+            print("没有查询到符合条件的车次")
+            return
+        
+        from prettytable import PrettyTable
+        table = PrettyTable()
+        table.field_names = ["车次", "出发站", "到达站", "出发时间", "到达时间", "历时", "商务座", "一等座", "二等座", "硬卧", "软卧", "硬座", "无座"]
+        
+        for ticket in tickets:
+            table.add_row([
+                ticket.train_code,
+                self.get_station_name(ticket.from_station),
+                self.get_station_name(ticket.to_station),
+                ticket.departure_time,
+                ticket.arrival_time,
+                ticket.duration,
+            ] + [ticket.seat_text(seat_type) for seat_type in ('商务座', '一等座', '二等座', '硬卧', '软卧', '硬座', '无座')])
+        
+        print(table)
+
+    def query_tickets_from_web(self, from_station, to_station, train_date, train_codes=None, purpose_code='ADULT', strict=False):
+        """从12306网页爬取车票信息，失败时返回 None（strict 为 True 时抛出 QueryError）"""
+        # 获取站点代码
+        from_code = self.get_station_code(from_station)
+        to_code = self.get_station_code(to_station)
+        
+        if not from_code or not to_code:
+            print(f"无法找到站点代码: {from_station} 或 {to_station}")
+            if strict:
+                raise QueryError(f"无法找到站点代码: {from_station} 或 {to_station}")
+            return None
+        
+        # 构建URL
+        url = f"{self.base_url}/leftTicket/init?linktypeid=dc&fs={from_station},{from_code}&ts={to_station},{to_code}&date={train_date}&flag=N,N,Y"
+        
+        try:
+            # CLeftTicketUrl 在各线路间通用，缓存未过期时直接使用，省去加载 init 页面
+            ticket_url = self.left_ticket_url_cache.get()
+            if ticket_url is None:
+                with tracer.span('init_page'):
+                    ticket_url = self.left_ticket_url_cache.load(lambda: self.discover_left_ticket_url(url))
+                if not ticket_url:
+                    raise QueryError("无法从页面获取查询接口")
+            else:
+                print(f"使用缓存的查询接口: {ticket_url}")
+            
+            # 构建API URL
+            api_url = f"{self.base_url}/{ticket_url}?leftTicketDTO.train_date={train_date}&leftTicketDTO.from_station={from_code}&leftTicketDTO.to_station={to_code}&purpose_codes={purpose_code}"
+            
+            print(f"提取到的API URL: {api_url}")
+            
+            # 发送API请求
+            api_response = self.http_get(api_url, 'xhr')
+            
+            # 解析JSON响应
+            try:
+                api_response.raise_for_status()
+                # 响应内容与上次完全相同时直接复用上次的解析结果
+                snapshot_key = (from_code, to_code, str(train_date), purpose_code, tuple(train_codes) if train_codes else None)
+                digest = self.response_digest(api_response)
+                cached = self.response_snapshots.get(snapshot_key)
+                if cached and cached[0] == digest:
+                    CACHE_LOOKUPS.labels('response_body', 'hit').add()
+                    return cached[1]
+                CACHE_LOOKUPS.labels('response_body', 'miss').add()
+                with tracer.span('json_decode'):
+                    data = api_response.json()
+            except (requests.exceptions.HTTPError, ValueError) as e:
+                # 返回错误状态、HTML 或非JSON内容，说明缓存的接口地址可能已失效，下次重新获取
+                self.left_ticket_url_cache.invalidate()
+                if isinstance(e, ValueError):
+                    PARSE_FAILURES.inc()
+                if '<html' in api_response.text.lower():
+                    HTML_RESPONSES.labels(endpoint_label(api_url)).add()
+                    print("API返回了HTML页面，可能需要登录")
+                raise QueryError(str(e), throttled=is_throttled_response(api_response)) from e
+            
+            # 检查API返回的数据结构
+            if 'data' in data and 'result' in data['data']:
+                with tracer.span('parse'):
+                    tickets = parse_ticket_result(data['data']['result'], train_codes)
+                self.response_snapshots[snapshot_key] = (digest, tickets)
+                if not tickets:
+                    print("没有找到符合条件的车次")
+                return tickets
+            else:
+                PARSE_FAILURES.inc()
+                raise QueryError("API返回数据格式不正确")
+                
+        except Exception as e:
+            print(f"从网页爬取车票信息失败: {e}")
+            print(f"错误类型: {type(e).__name__}")
+            response = getattr(e, 'response', None)
+            if response is not None:
+                print(f"响应状态码: {response.status_code}")
+            if not strict:
+                return None
+            if isinstance(e, QueryError):
+                raise
+            raise QueryError(str(e), throttled=response is not None and is_throttled_response(response)) from e
+
+    def discover_left_ticket_url(self, url):
+        """加载 leftTicket/init 页面，提取当前的查询接口路径 CLeftTicketUrl"""
+        print(f"访问网页: {url}")
+        
+        # 发送请求
+        response = self.http_get(url, 'page')
+        response.raise_for_status()
+        
+        # 检查是否需要登录
+        if "请登录" in response.text or "登录名" in response.text:
+            LOGIN_REQUIRED.inc()
+            print("需要登录12306账号才能查询车票")
+            return None
+        
+        # 这个页面不直接包含车票数据，而是通过JavaScript加载
+        # 我们需要提取出查询参数，然后调用API获取数据
+        ticket_url_match = re.search(r"var CLeftTicketUrl = '([^']+)'", response.text)
+        if not ticket_url_match:
+            print("无法从页面提取查询参数")
+            return None
+        return ticket_url_match.group(1)
+
+
+class WatchJob:
+    """一个监控任务：某条线路某天的车次/座位监控参数"""
+    __slots__ = ('name', 'from_station', 'to_station', 'train_date', 'train_codes',
+                 'seat_types', 'seat_mask', 'interval', 'purpose_code', 'hot_windows', 'expand_cities')
+
+    def __init__(self, from_station, to_station, train_date, train_codes=None,
+                 seat_types=None, interval=60, name=None, purpose_code='ADULT', hot_windows=None,
+                 expand_cities=False):
+        self.from_station = from_station
+        self.to_station = to_station
+        self.train_date = str(train_date)
+        self.train_codes = list(train_codes) if train_codes else None
+        self.seat_types = list(seat_types) if seat_types else None
+        self.seat_mask = seat_mask(self.seat_types)
+        self.interval = interval
+        self.name = name or f"{from_station}-{to_station}-{self.train_date}"
+        self.purpose_code = purpose_code
+        self.hot_windows = hot_windows or ()
+        self.expand_cities = expand_cities  # 查询出发/到达城市所有车站的两两组合
+
+    def base_interval(self, now=None):
+        """高频时段之外的查询间隔"""
+        return self.interval
+
+    def next_delay(self, now=None):
+        """距下次查询的秒数：高频时段内使用时段间隔，且不会跳过即将开始的高频时段"""
+        seconds = seconds_of_day(now)
+        delay = self.base_interval(now)
+        for window in self.hot_windows:
+            if window.contains(seconds):
+                delay = min(delay, window.interval)
+            else:
+                delay = min(delay, max(window.seconds_until_start(seconds), window.interval))
+        return delay
+
+    def filter_tickets(self, tickets):
+        """按本任务的车次过滤完整查询结果"""
+        if not self.train_codes:
+            return tickets
+        return [t for t in tickets if t.train_code in self.train_codes]
+
+    def signature(self):
+        """任务参数的元组，配置热重载时据此判断任务是否被修改"""
+        return (self.from_station, self.to_station, self.train_date, tuple(self.train_codes or ()),
+                tuple(self.seat_types or ()), self.interval, self.purpose_code,
+                tuple((w.start, w.end, w.interval) for w in self.hot_windows), self.expand_cities)
+
+    def __repr__(self):
+        return f"WatchJob({self.name!r})"
+
+
+def parse_date(value):
+    """把 '2025-03-16' 或 YAML 解析出的 date 转为 datetime.date"""
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    return datetime.datetime.strptime(str(value).strip(), '%Y-%m-%d').date()
+
+
+class SweepDateJob(WatchJob):
+    """日期区间监控中某一天的任务
+
+    离出发日不超过 near_days 天时按 interval 查询，超过 far_days 天时按 far_interval 查询，
+    中间按天数线性过渡。sweep 为所属区间任务的名称，window 为展开出它的 SweepJob（用于按天重新展开）。
+    """
+    __slots__ = ('sweep', 'window', 'date', 'far_interval', 'near_days', 'far_days')
+
+    def __init__(self, sweep, from_station, to_station, train_date, far_interval=None, near_days=3, far_days=15,
+                 window=None, **kwargs):
+        kwargs.setdefault('name', f"{sweep}@{train_date}")
+        super().__init__(from_station, to_station, train_date, **kwargs)
+        self.sweep = sweep
+        self.window = window
+        self.date = parse_date(train_date)
+        self.far_interval = far_interval or self.interval
+        self.near_days = near_days
+        self.far_days = max(far_days, near_days + 1)
+
+    def days_until(self, now=None):
+        today = datetime.date.fromtimestamp(time.time() if now is None else now)
+        return (self.date - today).days
+
+    def base_interval(self, now=None):
+        days = self.days_until(now)
+        if days <= self.near_days:
+            return self.interval
+        if days >= self.far_days:
+            return self.far_interval
+        ratio = (days - self.near_days) / (self.far_days - self.near_days)
+        return self.interval + ratio * (self.far_interval - self.interval)
+
+    def signature(self):
+        return super().signature() + (self.sweep, self.far_interval, self.near_days, self.far_days)
+
+
+class SweepJob:
+    """日期区间监控：同一线路在 start_date 到 end_date（含）之间、且星期几在 weekdays 中的每一天
+
+    expand() 把它拆成每天一个 SweepDateJob 交给引擎；各天是独立的查询组，
+    由线程池并发查询、共用限速器，变化事件和提醒都带上日期后汇入同一个输出。
+    weekdays 为 1（周一）到 7（周日）的列表，为空表示每天。
+    start_date/end_date 也可以是整数，表示相对当天的天数（如 0 到 14 为今天起的 15 天），
+    这样的区间每天向后滚动；引擎每天用 roll_sweeps 重新展开，去掉过去的日期、加入新进入区间的日期。
+    """
+
+    def __init__(self, name, from_station, to_station, start_date, end_date, weekdays=None,
+                 far_interval=None, near_days=3, far_days=15, **job_options):
+        self.name = name or f"{from_station}-{to_station}-{start_date}~{end_date}"
+        self.from_station = from_station
+        self.to_station = to_station
+        self.start_date = self._parse_bound(start_date)
+        self.end_date = self._parse_bound(end_date)
+        self.weekdays = set(int(day) for day in weekdays) if weekdays else None
+        self.far_interval = far_interval
+        self.near_days = near_days
+        self.far_days = far_days
+        self.job_options = job_options
+
+    @staticmethod
+    def _parse_bound(value):
+        # 整数为相对当天的天数，其余按日期解析
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value
+        return parse_date(value)
+
+    def _resolve(self, bound, today):
+        return today + datetime.timedelta(days=bound) if isinstance(bound, int) else bound
+
+    def dates(self, today=None):
+        """区间内需要监控的日期，已经过去的日期跳过"""
+        today = today or datetime.date.today()
+        day = max(self._resolve(self.start_date, today), today)
+        end_date = self._resolve(self.end_date, today)
+        dates = []
+        while day <= end_date:
+            if self.weekdays is None or day.isoweekday() in self.weekdays:
+                dates.append(day)
+            day += datetime.timedelta(days=1)
+        return dates
+
+    def expand(self, today=None):
+        return [
+            SweepDateJob(self.name, self.from_station, self.to_station, day.isoformat(),
+                         far_interval=self.far_interval, near_days=self.near_days, far_days=self.far_days,
+                         window=self, **self.job_options)
+            for day in self.dates(today)
+        ]
+
+    def __repr__(self):
+        return f"SweepJob({self.name!r})"
+
+
+def roll_sweeps(engine, today=None):
+    """按当天重新展开引擎中的日期区间任务：移除已经过去的日期，加入新进入区间的日期，返回 (加入数, 移除数)
+
+    engine 为 MonitorEngine 或 ShardedEngine，只用到 list_jobs/add_job/remove_job。
+    """
+    windows = {}
+    current = {}
+    for job in engine.list_jobs():
+        window = getattr(job, 'window', None)
+        if window is not None:
+            windows[window.name] = window
+            current.setdefault(window.name, set()).add(job.name)
+    added = removed = 0
+    for name, window in windows.items():
+        expected = {job.name: job for job in window.expand(today)}
+        for job_name in current[name] - set(expected):
+            engine.remove_job(job_name)
+            removed += 1
+        for job_name, job in expected.items():
+            if job_name not in current[name]:
+                engine.add_job(job)
+                added += 1
+    if added or removed:
+        print(f"日期区间任务已按日期更新: 加入 {added} 天，移除 {removed} 天")
+    return added, removed
+
+
+def format_sweep_view(sweep, rows, mask, limit=20):
+    """日期区间任务的合并视图文本：rows 为 (日期, TrainTicket)，列出掩码范围内有票的车次，最多 limit 行"""
+    lines = []
+    for train_date, ticket in rows:
+        seats = ticket.available_seats(mask)
+        if seats:
+            lines.append(f"    {train_date} {ticket.train_code}（{ticket.departure_time} 出发） "
+                         + " ".join(f"{seat}:{ticket.seat_text(seat)}" for seat in seats))
+    header = f"  [{sweep}] 区间内当前有票的车次: {len(lines)} 个"
+    if len(lines) > limit:
+        lines = lines[:limit] + [f"    ……另有 {len(lines) - limit} 个"]
+    return [header] + lines
+
+
+def load_jobs(config):
+    """从配置中读取监控任务列表
+
+    `jobs` 中的每一项与 `query_params` 格式相同，未填写的字段沿用 `query_params` 中的值；
+    没有 `jobs` 时把 `query_params` 当作唯一的任务。
+    填写了 `date_range: [开始日期, 结束日期]` 的项是日期区间任务，展开为区间内每天一个任务；
+    开始、结束也可以是相对今天的天数，运行中每天自动滚动。
+    """
+    defaults = dict(config.get('query_params') or {})
+    entries = config.get('jobs') or [{}]
+    default_windows = parse_hot_windows(defaults.get('hot_windows'))
+    jobs = []
+    for entry in entries:
+        params = dict(defaults)
+        params.update(entry or {})
+        hot_windows = default_windows if 'hot_windows' not in (entry or {}) else parse_hot_windows(entry['hot_windows'])
+        job_options = dict(
+            train_codes=params.get('train_codes'),
+            seat_types=params.get('seat_types'),
+            interval=params.get('interval', 60),
+            purpose_code=params.get('purpose_code', 'ADULT'),
+            hot_windows=hot_windows,
+            expand_cities=params.get('expand_cities', False),
+        )
+        if params.get('date_range') and not (entry or {}).get('train_date'):
+            start_date, end_date = params['date_range']
+            sweep = SweepJob(
+                params.get('name'),
+                params.get('from_station'),
+                params.get('to_station'),
+                start_date,
+                end_date,
+                weekdays=params.get('weekdays'),
+                far_interval=params.get('far_interval'),
+                near_days=params.get('near_days', 3),
+                far_days=params.get('far_days', 15),
+                **job_options
+            )
+            expanded = sweep.expand()
+            if not expanded:
+                print(f"日期区间任务 {sweep.name} 中没有需要监控的日期")
+            jobs.extend(expanded)
+            continue
+        jobs.append(WatchJob(
+            params.get('from_station'),
+            params.get('to_station'),
+            params.get('train_date'),
+            name=params.get('name'),
+            **job_options
+        ))
+    return jobs
+
+
+def is_positive_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0
+
+
+def check_jobs(jobs):
+    """检查任务列表，有问题时返回错误说明，没有问题时返回 None
+
+    除必填字段和任务名外，还检查日期格式、查询间隔和高频时段间隔为正数、座位类型名称有效，
+    避免这类任务启动后查询一次就不再调度，或者永远不会提醒。
+    """
+    names = set()
+    for job in jobs:
+        if not (job.from_station and job.to_station and job.train_date):
+            return f"任务配置不完整，需要 from_station、to_station 和 train_date: {job.name}"
+        if job.name in names:
+            return f"任务名重复: {job.name}"
+        names.add(job.name)
+        try:
+            parse_date(job.train_date)
+        except ValueError:
+            return f"日期格式错误，应为 YYYY-MM-DD: {job.name} 的 {job.train_date}"
+        if not is_positive_number(job.interval):
+            return f"查询间隔必须是正数（秒）: {job.name} 的 interval {job.interval!r}"
+        if not is_positive_number(getattr(job, 'far_interval', 1)):
+            return f"查询间隔必须是正数（秒）: {job.name} 的 far_interval {job.far_interval!r}"
+        for window in job.hot_windows:
+            if not is_positive_number(window.interval):
+                return f"高频时段的查询间隔必须是正数（秒）: {job.name} 的 {window.interval!r}"
+        unknown = [seat for seat in job.seat_types or () if seat not in SEAT_BITS]
+        if unknown:
+            return f"未知的座位类型 {', '.join(unknown)}（可选: {', '.join(SEAT_TYPES)}）: {job.name}"
+    return None
+
+
+# 座位状态变化事件类型
+EVENT_TRAIN_ADDED = 'train_added'
+EVENT_TRAIN_REMOVED = 'train_removed'
+EVENT_AVAILABLE = 'available'  # 无票 -> 有票
+EVENT_SOLD_OUT = 'sold_out'  # 有票 -> 无票
+EVENT_COUNT_CHANGED = 'count_changed'  # 有票，数量变化
+
+
+class SeatEvent:
+    """一次车次/座位状态变化"""
+    __slots__ = ('kind', 'ticket', 'seat_type', 'old_count', 'new_count')
+
+    def __init__(self, kind, ticket, seat_type=None, old_count=0, new_count=0):
+        self.kind = kind
+        self.ticket = ticket
+        self.seat_type = seat_type
+        self.old_count = old_count
+        self.new_count = new_count
+
+    def __repr__(self):
+        if self.seat_type is None:
+            return f"SeatEvent({self.kind}, {self.ticket.train_code})"
+        return f"SeatEvent({self.kind}, {self.ticket.train_code}, {self.seat_type}, {self.old_count}->{self.new_count})"
+
+
+def diff_snapshots(old, new, mask):
+    """比较两次快照（车次 -> TrainTicket），返回掩码范围内的座位状态变化"""
+    events = []
+    for train_code, ticket in new.items():
+        previous = old.get(train_code)
+        if previous is None:
+            events.append(SeatEvent(EVENT_TRAIN_ADDED, ticket))
+            old_counts = None
+        elif previous.seat_counts == ticket.seat_counts:
+            continue
+        else:
+            old_counts = previous.seat_counts
+        for i, seat_type in enumerate(SEAT_TYPES):
+            if not mask >> i & 1:
+                continue
+            new_count = ticket.seat_counts[i]
+            old_count = old_counts[i] if old_counts else 0
+            if new_count == old_count:
+                continue
+            if not old_count:
+                kind = EVENT_AVAILABLE
+            elif not new_count:
+                kind = EVENT_SOLD_OUT
+            else:
+                kind = EVENT_COUNT_CHANGED
+            events.append(SeatEvent(kind, ticket, seat_type, old_count, new_count))
+    for train_code, ticket in old.items():
+        if train_code not in new:
+            events.append(SeatEvent(EVENT_TRAIN_REMOVED, ticket))
+    return events
+
+
+class SnapshotStore:
+    """保存每个任务上一次的余票快照，只输出状态变化
+
+    查询结果是同一个对象（响应内容未变、跳过了解析）时直接判定无变化，不再逐车次比较。
+    """
+
+    def __init__(self):
+        self._snapshots = {}  # 任务名 -> (原始结果列表, {车次: TrainTicket})
+        self._lock = threading.Lock()
+
+    def update(self, job, tickets):
+        """记录新的查询结果，返回相对上一次的变化事件列表"""
+        with self._lock:
+            previous = self._snapshots.get(job.name)
+            if previous is not None and previous[0] is tickets:
+                return []
+            current = {t.train_code: t for t in job.filter_tickets(tickets)}
+            self._snapshots[job.name] = (tickets, current)
+        return diff_snapshots(previous[1] if previous else {}, current, job.seat_mask)
+
+    def get(self, job_name):
+        """任务当前的快照（车次 -> TrainTicket）"""
+        previous = self._snapshots.get(job_name)
+        return previous[1] if previous else {}
+
+    def discard(self, job_name):
+        with self._lock:
+            self._snapshots.pop(job_name, None)
+
+
+def build_alert(job, events, prices=None):
+    """根据状态变化生成提醒，只包含刚变为有票的车次座位；没有时返回 None
+
+    prices 为 price_key -> 票价文本，有对应票价时附在座位后面。
+    """
+    items = {}
+    for event in events:
+        if event.kind != EVENT_AVAILABLE:
+            continue
+        ticket = event.ticket
+        lines = items.setdefault(ticket.train_code, [f"车次: {ticket.train_code}, 出发: {ticket.departure_time}"])
+        line = f"  {event.seat_type}: {ticket.seat_text(event.seat_type)}"
+        price = prices.get(price_key(ticket, event.seat_type)) if prices else None
+        lines.append(f"{line} {price}" if price else line)
+    if not items:
+        return None
+    title = f"12306 车票提醒 - {job.from_station}到{job.to_station}"
+    if getattr(job, 'sweep', None):
+        title += f" {job.train_date}"
+    return Alert(title, job.name, [(code, "\n".join(lines)) for code, lines in items.items()])
+
+
+EVENT_KINDS = (EVENT_TRAIN_ADDED, EVENT_TRAIN_REMOVED, EVENT_AVAILABLE, EVENT_SOLD_OUT, EVENT_COUNT_CHANGED)
+
+
+class HistoryStore:
+    """余票变化历史，保存在 SQLite（WAL 模式）中
+
+    record() 只把事件放入队列；后台线程每攒够 batch_size 条或每隔 flush_interval 秒批量写入一次。
+    座位类型和事件类型按 SEAT_TYPES / EVENT_KINDS 中的下标存为整数，时间存为整数秒。
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS seat_events (
+            ts INTEGER NOT NULL,
+            train_date TEXT NOT NULL,
+            from_code TEXT NOT NULL,
+            to_code TEXT NOT NULL,
+            train_code TEXT NOT NULL,
+            seat INTEGER,
+            kind INTEGER NOT NULL,
+            old_count INTEGER,
+            new_count INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS idx_seat_events_train ON seat_events (train_code, seat, kind, ts);
+        CREATE INDEX IF NOT EXISTS idx_seat_events_ts ON seat_events (ts);
+    """
+
+    def __init__(self, path='ticket_history.db', batch_size=500, flush_interval=2.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        QUEUE_DEPTH.set_function(('history',), self._queue.qsize)
+        conn = self._connect()
+        conn.executescript(self.SCHEMA)
+        conn.close()
+
+    def _connect(self):
+        import sqlite3  # 只有启用历史记录时才需要
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='history-writer', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=10):
+        """写完队列中剩余的记录后停止"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def record(self, job, events, timestamp=None):
+        """记录一个任务的一批状态变化，不阻塞"""
+        ts = int(timestamp or time.time())
+        for event in events:
+            ticket = event.ticket
+            seat = SEAT_TYPES.index(event.seat_type) if event.seat_type else None
+            self._queue.put((ts, job.train_date, ticket.from_station, ticket.to_station, ticket.train_code,
+                             seat, EVENT_KINDS.index(event.kind), event.old_count, event.new_count))
+
+    def _run(self):
+        import sqlite3
+        conn = self._connect()
+        stopping = False
+        while not stopping:
+            rows = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(rows) < self.batch_size:
+                try:
+                    row = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if row is None:
+                    stopping = True
+                    break
+                rows.append(row)
+            if rows:
+                try:
+                    with conn:
+                        conn.executemany("INSERT INTO seat_events VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                    self.written += len(rows)
+                except sqlite3.Error as e:
+                    print(f"写入历史记录失败: {e}")
+        conn.close()
+
+    def availability_by_hour(self, train_code, seat_type, days=30):
+        """最近 days 天内某车次某座位"变为有票"在一天 24 小时中的分布，返回 24 个计数"""
+        since = int(time.time()) - days * 86400
+        # 按本地时区换算到一天中的小时
+        offset = time.localtime().tm_gmtoff
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT ((ts + ?) % 86400) / 3600 AS hour, COUNT(*) FROM seat_events "
+                "WHERE train_code = ? AND seat = ? AND kind = ? AND ts >= ? GROUP BY hour",
+                (offset, train_code, SEAT_TYPES.index(seat_type), EVENT_KINDS.index(EVENT_AVAILABLE), since),
+            ).fetchall()
+        finally:
+            conn.close()
+        counts = [0] * 24
+        for hour, count in rows:
+            counts[hour] = count
+        return counts
+
+    def availability_periods(self, train_code, seat_type, days=30):
+        """最近 days 天内某车次某座位每段有票的时间 (开始, 结束)，仍然有票的结束时间为 None"""
+        since = int(time.time()) - days * 86400
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT ts, train_date, kind FROM seat_events "
+                "WHERE train_code = ? AND seat = ? AND kind IN (?, ?) AND ts >= ? ORDER BY ts",
+                (train_code, SEAT_TYPES.index(seat_type), EVENT_KINDS.index(EVENT_AVAILABLE),
+                 EVENT_KINDS.index(EVENT_SOLD_OUT), since),
+            ).fetchall()
+        finally:
+            conn.close()
+        periods = []
+        opened = {}  # 乘车日期 -> 变为有票的时间
+        for ts, train_date, kind in rows:
+            if EVENT_KINDS[kind] == EVENT_AVAILABLE:
+                opened.setdefault(train_date, ts)
+            elif train_date in opened:
+                periods.append((opened.pop(train_date), ts))
+        periods.extend((start, None) for start in opened.values())
+        periods.sort()
+        return periods
+
+
+# 票价接口返回的各座位价格字段
+PRICE_FIELDS = {
+    '商务座': 'A9',
+    '一等座': 'M',
+    '二等座': 'O',
+    '高级软卧': 'A6',
+    '软卧': 'A4',
+    '动卧': 'F',
+    '硬卧': 'A3',
+    '软座': 'A2',
+    '硬座': 'A1',
+    '无座': 'WZ',
+}
+
+
+def price_key(ticket, seat_type):
+    """票价缓存键 (列车编号, 出发站代码, 到达站代码, 座位类型)"""
+    return (ticket.train_no, ticket.from_station, ticket.to_station, seat_type)
+
+
+class PriceLookup:
+    """提醒前的票价查询阶段
+
+    只为刚变为有票（EVENT_AVAILABLE）的车次座位查票价。submit() 在轮询线程中调用，只查内存缓存：
+    票价都已缓存时直接生成提醒，否则放入队列立即返回，轮询不会多等一次请求。后台线程每次取出
+    batch_window 秒内到达的提醒，按 (出发站, 到达站, 日期) 分组、同一车次只请求一次 queryTicketPrice，
+    然后附上票价发出提醒；票价查询失败时照常发出不带票价的提醒。
+
+    票价很少变化，按 price_key 缓存 ttl 秒（默认 3 天）；车次的 yp_info 变化时视为票价可能变化，重新查询。
+    设置 path 时缓存在启动时读取、停止时写回该 JSON 文件。
+    """
+
+    def __init__(self, monitor, notifier, ttl=3 * 86400, batch_window=0.2, path=None, queue_size=1000):
+        self.monitor = monitor
+        self.notifier = notifier
+        self.ttl = ttl
+        self.batch_window = batch_window
+        self.path = path
+        self.fetches = 0
+        self._cache = {}  # price_key -> (票价文本, 查询时间, yp_info)
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        QUEUE_DEPTH.set_function(('prices',), self._queue.qsize)
+        if path and os.path.exists(path):
+            self._load(path)
+
+    def _load(self, path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"读取票价缓存失败: {e}")
+            return
+        now = time.time()
+        for key, (price, fetched_at, yp_info) in entries.items():
+            if now - fetched_at < self.ttl:
+                self._cache[tuple(key.split('|'))] = (price, fetched_at, yp_info)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='prices', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=10):
+        """处理完队列中剩余的提醒后停止，设置了 path 时写回缓存"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+        if self.path:
+            now = time.time()
+            with self._lock:
+                entries = {'|'.join(key): list(value) for key, value in self._cache.items()
+                           if now - value[1] < self.ttl}
+            write_json_atomic(self.path, entries)
+
+    def cached(self, ticket, seat_type, now=None):
+        """缓存中未过期且 yp_info 未变的票价，没有时返回 None"""
+        with self._lock:
+            entry = self._cache.get(price_key(ticket, seat_type))
+        if entry is None:
+            return None
+        price, fetched_at, yp_info = entry
+        if (time.time() if now is None else now) - fetched_at >= self.ttl or yp_info != ticket.yp_info:
+            return None
+        return price
+
+    def lookup(self, events, record=True):
+        """从缓存中取这些事件里刚变为有票的座位的票价，返回 (price_key -> 票价, 缺少票价的车次列表)"""
+        now = time.time()
+        prices = {}
+        missing = {}
+        for event in events:
+            if event.kind != EVENT_AVAILABLE or event.seat_type not in PRICE_FIELDS:
+                continue
+            price = self.cached(event.ticket, event.seat_type, now)
+            if record:
+                CACHE_LOOKUPS.labels('prices', 'miss' if price is None else 'hit').add()
+            if price is None:
+                missing[event.ticket.train_no] = event.ticket
+            else:
+                prices[price_key(event.ticket, event.seat_type)] = price
+        return prices, list(missing.values())
+
+    def submit(self, job, events):
+        """提交一个任务的状态变化，不阻塞；有刚变为有票的座位时（附上票价后）发出提醒"""
+        if not any(event.kind == EVENT_AVAILABLE for event in events):
+            return
+        detected_at = time.time()
+        prices, missing = self.lookup(events)
+        if missing:
+            try:
+                self._queue.put_nowait((job, events, detected_at))
+                return
+            except queue.Full:
+                print(f"票价查询队列已满，不附票价发出提醒: {job.name}")
+        self._notify(job, events, prices, detected_at)
+
+    def _notify(self, job, events, prices, detected_at):
+        alert = build_alert(job, events, prices)
+        if alert and self.notifier is not None:
+            alert.created_at = detected_at  # 提醒延迟从发现有票算起，包含查票价的时间
+            self.notifier.notify(alert)
+
+    def fetch(self, ticket, train_date):
+        """请求一个车次各座位的票价并写入缓存"""
+        params = urllib.parse.urlencode({
+            'train_no': ticket.train_no,
+            'from_station_no': ticket.from_station_no,
+            'to_station_no': ticket.to_station_no,
+            'seat_types': ticket.seat_type_codes,
+            'train_date': train_date,
+        })
+        response = self.monitor.http_get(f"{self.monitor.base_url}/leftTicket/queryTicketPrice?{params}")
+        response.raise_for_status()
+        data = response.json().get('data') or {}
+        self.fetches += 1
+        now = time.time()
+        with self._lock:
+            for seat_type, field in PRICE_FIELDS.items():
+                if data.get(field):
+                    self._cache[price_key(ticket, seat_type)] = (data[field], now, ticket.yp_info)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.time() + self.batch_window
+            while True:
+                try:
+                    item = self._queue.get(timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._process(batch)
+
+    def _process(self, batch):
+        # 按线路和日期分组，同一车次只查一次（多个任务可能同时关注同一车次）
+        routes = {}
+        for job, events, _ in batch:
+            for ticket in self.lookup(events, record=False)[1]:
+                routes.setdefault((ticket.from_station, ticket.to_station, job.train_date), {})[ticket.train_no] = ticket
+        for (_, _, train_date), tickets in routes.items():
+            for ticket in tickets.values():
+                try:
+                    self.fetch(ticket, train_date)
+                except Exception as e:
+                    print(f"票价查询失败 ({ticket.train_code}): {e}")
+        for job, events, detected_at in batch:
+            self._notify(job, events, self.lookup(events, record=False)[0], detected_at)
+
+
+def merge_ticket_results(results):
+    """合并多个查询结果：按出发时间排序，同一车次只保留一次"""
+    merged = {}
+    for tickets in results:
+        for ticket in tickets:
+            merged.setdefault(ticket.train_code, ticket)
+    return sorted(merged.values(), key=lambda ticket: (ticket.departure_time, ticket.train_code))
+
+
+class QueryCoalescer:
+    """合并相同的余票查询
+
+    12306 的 leftTicket 接口按 (出发站, 到达站, 日期, 乘客类型) 返回全部车次，车次和座位过滤都在本地完成，
+    因此相同键的查询只需请求一次：并发的相同查询只有一个真正发出请求，其余等待并共享结果（包括失败）；
+    max_age 秒内的结果也直接复用。
+    """
+
+    def __init__(self, monitor, pair_workers=4):
+        self.monitor = monitor
+        self.fetches = 0
+        self.hits = 0
+        self.pair_workers = pair_workers
+        self._lock = threading.Lock()
+        self._results = {}  # key -> (查询时间, 车票列表)
+        self._inflight = {}  # key -> _InflightCall
+        self._merged = {}  # 城市组合键 -> ({车站组合: 上次成功的结果}, 合并结果)
+        self._pair_executor = None
+
+    def make_key(self, from_station, to_station, train_date, purpose_code='ADULT'):
+        """生成查询键 (from_code, to_code, date, purpose_code)"""
+        return (self.monitor.get_station_code(from_station), self.monitor.get_station_code(to_station),
+                str(train_date), purpose_code)
+
+    def fetch(self, from_station, to_station, train_date, purpose_code='ADULT', max_age=0):
+        """获取该线路日期的全部车次（未按车次过滤），查询失败时抛出 QueryError"""
+        key = self.make_key(from_station, to_station, train_date, purpose_code)
+        with self._lock:
+            cached = self._results.get(key)
+            if cached and time.time() - cached[0] < max_age:
+                self.hits += 1
+                CACHE_LOOKUPS.labels('coalescer', 'hit').add()
+                return cached[1]
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self._inflight[key] = _InflightCall()
+            else:
+                self.hits += 1
+        CACHE_LOOKUPS.labels('coalescer', 'miss' if leader else 'hit').add()
+
+        if not leader:
+            # 相同的查询正在进行，等它完成后共享结果
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self.monitor.query_tickets(from_station, to_station, train_date, None, purpose_code, strict=True)
+            with self._lock:
+                self.fetches += 1
+                self._results[key] = (time.time(), call.result)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            call.event.set()
+
+    def peek(self, key):
+        """最近一次成功查询的 (查询时间, 车票列表)，没有时返回 None；不发出请求"""
+        return self._results.get(key)
+
+    def fetch_city(self, from_station, to_station, train_date, purpose_code='ADULT', max_age=0):
+        """查询两个城市所有车站的两两组合，合并为一个结果
+
+        各组合并发查询（仍受限速器约束），同一车次出现在多个组合中时只保留一次。
+        某个组合查询失败时沿用它上一次成功的结果，没有上一次结果时整个查询按失败处理（抛出 QueryError），
+        不会因为部分组合失败而把这些组合的车次当作已下架，恢复后又重复提醒。
+        """
+        pairs = self._city_pairs(from_station, to_station)
+        if len(pairs) == 1:
+            return self.fetch(pairs[0][0], pairs[0][1], train_date, purpose_code, max_age)
+        with self._lock:
+            if self._pair_executor is None:
+                self._pair_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.pair_workers, thread_name_prefix='city-pair')
+        futures = [self._pair_executor.submit(self.fetch, a, b, train_date, purpose_code, max_age) for a, b in pairs]
+        key = (from_station, to_station, str(train_date), purpose_code)
+        previous = self._merged.get(key)
+        last_good = previous[0] if previous is not None else {}
+        parts = {}
+        for pair, future in zip(pairs, futures):
+            try:
+                parts[pair] = future.result()
+            except QueryError:
+                if pair not in last_good:
+                    raise
+                parts[pair] = last_good[pair]
+        # 各组合的结果都没变（同一个对象）时复用上次的合并结果，后面的快照比较可以直接跳过
+        if previous is not None and parts.keys() == last_good.keys() and all(parts[p] is last_good[p] for p in parts):
+            return previous[1]
+        merged = merge_ticket_results([parts[pair] for pair in pairs])
+        self._merged[key] = (parts, merged)
+        return merged
+
+    def discard(self, key):
+        """丢弃某个键的缓存结果，连同 monitor 中该键上次响应的解析快照"""
+        with self._lock:
+            self._results.pop(key, None)
+        self.monitor.response_snapshots.pop(key + (None,), None)
+
+    def _city_pairs(self, from_station, to_station):
+        index = self.monitor.station_index()
+        return [(a, b) for a in index.expand_city(from_station) for b in index.expand_city(to_station) if a != b]
+
+    def discard_city(self, from_station, to_station, train_date, purpose_code='ADULT'):
+        """丢弃按城市查询的合并结果，返回各车站组合的查询键（由调用方决定是否一并丢弃）"""
+        with self._lock:
+            self._merged.pop((from_station, to_station, str(train_date), purpose_code), None)
+        return [self.make_key(a, b, train_date, purpose_code) for a, b in self._city_pairs(from_station, to_station)]
+
+
+CACHE_SERVER_REQUESTS = metrics.counter('ticket_monitor_cache_server_requests_total', '查询缓存服务的请求数', ('result',))
+
+
+class QueryCache:
+    """给内部工具用的余票查询缓存，数据来自 QueryCoalescer
+
+    引擎轮询到的结果会直接被复用；每个键有自己的 TTL（默认 ttl，可按线路在 route_ttls 中覆盖）。
+    过期不超过 stale_ttl 秒的结果先原样返回，同时在后台重新查询（stale-while-revalidate）；
+    更旧或没有的结果同步查询。所有上游请求都经过 coalescer，因此受同一个限速器约束，
+    同一线路同时只有一个请求。
+    """
+
+    def __init__(self, coalescer, ttl=30, stale_ttl=300, route_ttls=None):
+        self.coalescer = coalescer
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.route_ttls = dict(route_ttls or {})  # "出发站-到达站" -> 秒
+        self._lock = threading.Lock()
+        self._bodies = {}  # 查询键 -> (车票列表, JSON 响应体, ETag)
+        self._refreshing = set()
+
+    def ttl_for(self, from_station, to_station):
+        return self.route_ttls.get(f"{from_station}-{to_station}", self.ttl)
+
+    def get(self, from_station, to_station, train_date, purpose_code='ADULT'):
+        """返回 (响应体, ETag, 数据时间, 状态)，状态为 hit / stale / miss；查询失败时抛出 QueryError"""
+        key = self.coalescer.make_key(from_station, to_station, train_date, purpose_code)
+        ttl = self.ttl_for(from_station, to_station)
+        cached = self.coalescer.peek(key)
+        now = time.time()
+        if cached is not None and now - cached[0] < ttl:
+            state = 'hit'
+        elif cached is not None and now - cached[0] < ttl + self.stale_ttl:
+            state = 'stale'
+            self._revalidate(key, from_station, to_station, train_date, purpose_code)
+        else:
+            state = 'miss'
+            self.coalescer.fetch(from_station, to_station, train_date, purpose_code, max_age=ttl)
+            cached = self.coalescer.peek(key)
+        fetched_at, tickets = cached
+        body, etag = self._render(key, tickets)
+        return body, etag, fetched_at, state
+
+    def _revalidate(self, key, from_station, to_station, train_date, purpose_code):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                self.coalescer.fetch(from_station, to_station, train_date, purpose_code)
+            except Exception as e:
+                print(f"后台刷新 {from_station}->{to_station} {train_date} 失败: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=refresh, name='cache-revalidate', daemon=True).start()
+
+    def _render(self, key, tickets):
+        # 结果对象没变时复用上次序列化好的响应体；响应体不含查询时间（放在 Age/Last-Modified 响应头中），
+        # 内容相同的结果重新查询后 ETag 也不变
+        cached = self._bodies.get(key)
+        if cached is not None and cached[0] is tickets:
+            return cached[1], cached[2]
+        from_code, to_code, train_date, purpose_code = key
+        index = get_station_index()
+        body = json.dumps({
+            'from_station': from_code,
+            'to_station': to_code,
+            'train_date': train_date,
+            'purpose_code': purpose_code,
+            'trains': [ticket_to_dict(ticket, index) for ticket in tickets],
+        }, ensure_ascii=False).encode('utf-8')
+        etag = '"{}"'.format(hashlib.blake2b(body, digest_size=12).hexdigest())
+        self._bodies[key] = (tickets, body, etag)
+        return body, etag
+
+
+def ticket_to_dict(ticket, index=None):
+    """TrainTicket -> 可序列化为 JSON 的字典"""
+    index = index or get_station_index()
+    return {
+        'train_no': ticket.train_no,
+        'train_code': ticket.train_code,
+        'from_station': ticket.from_station,
+        'from_station_name': index.get_name(ticket.from_station),
+        'to_station': ticket.to_station,
+        'to_station_name': index.get_name(ticket.to_station),
+        'departure_time': ticket.departure_time,
+        'arrival_time': ticket.arrival_time,
+        'duration': ticket.duration,
+        'seats': {seat: text for seat, text in zip(SEAT_TYPES, ticket.seat_texts) if text != '--'},
+        'available': ticket.available_seats(),
+    }
+
+
+class QueryCacheServer:
+    """在本地端口上以 HTTP/JSON 提供 QueryCache
+
+        GET /tickets?from=北京&to=上海&date=2025-03-16[&purpose=ADULT]
+
+    支持 If-None-Match 条件请求（内容未变时返回 304），响应头 X-Cache 为 hit / stale / miss，
+    Age 为数据的秒数，Last-Modified 为数据的查询时间。
+    """
+
+    def __init__(self, cache, host='127.0.0.1', port=9307):
+        import http.server
+        import socketserver
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urllib.parse.urlsplit(self.path)
+                if url.path != '/tickets':
+                    self._send_json(404, {'error': 'not found'})
+                    return
+                params = {k: v[0] for k, v in urllib.parse.parse_qs(url.query).items()}
+                missing = [name for name in ('from', 'to', 'date') if not params.get(name)]
+                if missing:
+                    self._send_json(400, {'error': f"缺少参数: {', '.join(missing)}"})
+                    return
+                if not (cache.coalescer.monitor.get_station_code(params['from'])
+                        and cache.coalescer.monitor.get_station_code(params['to'])):
+                    self._send_json(400, {'error': f"无法找到站点代码: {params['from']} 或 {params['to']}"})
+                    return
+                try:
+                    body, etag, fetched_at, state = cache.get(params['from'], params['to'], params['date'],
+                                                              params.get('purpose', 'ADULT'))
+                except QueryError as e:
+                    CACHE_SERVER_REQUESTS.labels('error').add()
+                    self._send_json(502, {'error': str(e)})
+                    return
+                CACHE_SERVER_REQUESTS.labels(state).add()
+                headers = {
+                    'ETag': etag,
+                    'X-Cache': state,
+                    'Age': str(max(0, int(time.time() - fetched_at))),
+                    'Last-Modified': email.utils.formatdate(fetched_at, usegmt=True),
+                    'Cache-Control': f"max-age={cache.ttl_for(params['from'], params['to'])}",
+                }
+                if self.headers.get('If-None-Match') == etag:
+                    CACHE_SERVER_REQUESTS.labels('not_modified').add()
+                    self._send(304, b'', headers)
+                else:
+                    self._send(200, body, headers)
+
+            def _send_json(self, status, data):
+                self._send(status, json.dumps(data, ensure_ascii=False).encode('utf-8'))
+
+            def _send(self, status, body, headers=None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                if status != 304:
+                    self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+            daemon_threads = True
+
+        self.cache = cache
+        self._httpd = Server((host, port), Handler)
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._httpd.server_address[:2]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='query-cache', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+class _QueryGroup:
+    """引擎内部的调度单位：查询键相同的任务共用一次查询"""
+    __slots__ = ('key', 'jobs', 'next_run', 'cancelled', 'failures')
+
+    def __init__(self, key):
+        self.key = key
+        self.jobs = []
+        self.next_run = 0.0
+        self.cancelled = False
+        self.failures = 0  # 连续失败次数，用于退避
+
+    @property
+    def interval(self):
+        return min(job.interval for job in self.jobs)
+
+    def next_delay(self, now=None):
+        return min(job.next_delay(now) for job in self.jobs)
+
+    @property
+    def label(self):
+        from_code, to_code, train_date, _ = self.key
+        return f"{from_code}-{to_code}-{train_date}"
+
+
+class MonitorEngine:
+    """在一个进程内并发运行多个监控任务
+
+    所有任务共用同一个 TrainTicketMonitor（即同一个 Session 连接池、限速器和站点索引），
+    由固定大小的线程池执行查询，线程数即对12306的全局并发上限。
+    查询键相同的任务合并为一组，每个轮询周期只请求一次，结果再按各任务的车次/座位条件分发。
+    查询失败时该组按指数退避（带抖动）延后，疑似被限流时退避加倍。
+    每个任务只在车次/座位状态发生变化时才调用 on_events(job, events, tickets)。
+    """
+
+    def __init__(self, monitor=None, max_workers=8, on_events=None, max_backoff=600, notifier=None, history=None,
+                 prices=None):
+        self.monitor = monitor or TrainTicketMonitor()
+        self.coalescer = QueryCoalescer(self.monitor)
+        self.max_workers = max_workers
+        self.max_backoff = max_backoff
+        self.on_events = on_events or self.report_events
+        self.snapshots = SnapshotStore()
+        self.notifier = notifier
+        self.prices = prices  # PriceLookup，设置后提醒先经它附上票价再交给 notifier
+        QUEUE_DEPTH.set_function(('scheduled_queries',), lambda: len(self._queue))
+        self.history = history
+        self.jobs = {}
+        self.groups = {}
+        self._queue = []  # (next_run, 序号, group) 小顶堆
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._stopped = threading.Event()
+        self._executor = None
+        # 连接池大小与并发数一致，避免多线程下连接被反复丢弃重建
+        self.monitor.transport.mount(self.monitor.session, pool_maxsize=max_workers)
+
+    def add_job(self, job):
+        """添加任务，所在查询组尚未调度时立即调度"""
+        key = self.job_key(job)
+        with self._cond:
+            if job.name in self.jobs:
+                self._detach(self.jobs[job.name])
+            self.jobs[job.name] = job
+            group = self.groups.get(key)
+            if group is None:
+                group = self.groups[key] = _QueryGroup(key)
+                group.jobs.append(job)
+                self._schedule(group, time.time())
+            else:
+                group.jobs.append(job)
+
+    def list_jobs(self):
+        """当前所有任务的列表副本"""
+        with self._cond:
+            return list(self.jobs.values())
+
+    def job_key(self, job):
+        """任务所属查询组的键；按城市展开的任务单独成组"""
+        if job.expand_cities:
+            return (f"{job.from_station}*", f"{job.to_station}*", job.train_date, job.purpose_code)
+        return self.coalescer.make_key(job.from_station, job.to_station, job.train_date, job.purpose_code)
+
+    def fetch_job(self, job):
+        if job.expand_cities:
+            return self.coalescer.fetch_city(job.from_station, job.to_station, job.train_date, job.purpose_code)
+        return self.coalescer.fetch(job.from_station, job.to_station, job.train_date, job.purpose_code)
+
+    def remove_job(self, name):
+        """移除任务，正在执行的查询完成后不再分发给它"""
+        with self._cond:
+            job = self.jobs.pop(name, None)
+            if job:
+                self._detach(job)
+                self.snapshots.discard(name)
+            return job
+
+    def _detach(self, job):
+        # 调用方需持有 self._cond
+        for key, group in list(self.groups.items()):
+            if job in group.jobs:
+                group.jobs.remove(job)
+                if not group.jobs:
+                    group.cancelled = True
+                    del self.groups[key]
+                    self._release(key)
+                return
+
+    def _release(self, key):
+        # 调用方需持有 self._cond；查询组的最后一个任务移除后释放该查询缓存的结果，
+        # 否则热加载、日期滚动之后内存会随轮询过的键只增不减
+        keys = [key]
+        from_station, to_station, train_date, purpose_code = key
+        if from_station.endswith('*'):
+            # 按城市展开的查询组，见 job_key
+            keys = self.coalescer.discard_city(from_station[:-1], to_station[:-1], train_date, purpose_code)
+        for pair_key in keys:
+            if pair_key not in self.groups:
+                self.coalescer.discard(pair_key)
+
+    def _schedule(self, group, when):
+        # 调用方需持有 self._cond
+        group.next_run = when
+        self._seq += 1
+        heapq.heappush(self._queue, (when, self._seq, group))
+        self._cond.notify()
+
+    def run(self):
+        """运行调度循环，直到调用 stop()"""
+        print(f"监控引擎启动: {len(self.jobs)} 个任务（{len(self.groups)} 个查询）, 最大并发 {self.max_workers}")
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+        sweep_day = datetime.date.today()
+        try:
+            while not self._stopped.is_set():
+                if datetime.date.today() != sweep_day:
+                    sweep_day = datetime.date.today()
+                    roll_sweeps(self, sweep_day)
+                due = []
+                with self._cond:
+                    now = time.time()
+                    while self._queue and self._queue[0][0] <= now:
+                        group = heapq.heappop(self._queue)[2]
+                        if not group.cancelled:
+                            due.append(group)
+                    if not due:
+                        # 最多等一分钟，跨过零点时及时更新日期区间任务
+                        timeout = min(self._queue[0][0] - now, 60) if self._queue else 60
+                        self._cond.wait(timeout)
+                for group in due:
+                    self._executor.submit(self._run_group, group)
+        finally:
+            self._executor.shutdown(wait=True)
+            print("监控引擎已停止")
+
+    def stop(self):
+        """停止调度，等待正在执行的查询结束"""
+        self._stopped.set()
+        with self._cond:
+            self._cond.notify_all()
+
+    def _run_group(self, group):
+        try:
+            self.poll_group(group)
+            group.failures = 0
+        except Exception as e:
+            group.failures += 2 if getattr(e, 'throttled', False) else 1
+            print(f"[{group.label}] 查询出错（连续 {group.failures} 次）: {e}")
+        finally:
+            with self._cond:
+                if not group.cancelled and group.jobs and not self._stopped.is_set():
+                    try:
+                        when = time.time() + self.next_delay(group)
+                    except Exception as e:
+                        # 不能让分组因为算不出间隔而不再被调度
+                        when = time.time() + self.max_backoff
+                        print(f"[{group.label}] 计算下次查询时间出错，{self.max_backoff} 秒后重试: {e}")
+                    self._schedule(group, when)
+                elif group.cancelled and group.key not in self.groups:
+                    # 查询进行中组被移除时，结果在移除之后才写入缓存，这里再释放一次
+                    self._release(group.key)
+
+    def next_delay(self, group):
+        """计算分组下次查询的延迟：正常时按任务间隔和高频时段，失败时指数退避"""
+        if group.failures:
+            return backoff_delay(group.failures, group.next_delay(), self.max_backoff)
+        return group.next_delay()
+
+    def poll_group(self, group):
+        """执行一次分组查询，把结果分发给组内各任务"""
+        with self._cond:
+            jobs = list(group.jobs)
+        if not jobs:
+            return
+        first = jobs[0]
+        with tracer.span('query', {'route': group.label}):
+            tickets = self.fetch_job(first)
+        with tracer.span('dispatch', {'route': group.label, 'jobs': len(jobs)}):
+            for job in jobs:
+                try:
+                    self.poll_job(job, tickets)
+                except Exception as e:
+                    print(f"[{job.name}] 处理查询结果出错: {e}")
+
+    def poll_job(self, job, tickets=None):
+        """与任务上一次的快照比较，有变化时交给 on_events 处理"""
+        if tickets is None:
+            tickets = self.fetch_job(job)
+        events = self.snapshots.update(job, tickets)
+        if not events:
+            return
+        if self.history is not None:
+            self.history.record(job, events)
+        self.on_events(job, events, job.filter_tickets(tickets))
+        if self.prices is not None:
+            self.prices.submit(job, events)
+        elif self.notifier is not None:
+            alert = build_alert(job, events)
+            if alert:
+                self.notifier.notify(alert)
+
+    def sweep_view(self, sweep):
+        """日期区间任务各天的当前余票合并视图：按日期、出发时间排序的 (日期, TrainTicket) 列表"""
+        with self._cond:
+            jobs = [job for job in self.jobs.values() if getattr(job, 'sweep', None) == sweep]
+        rows = []
+        for job in jobs:
+            rows.extend((job.train_date, ticket) for ticket in self.snapshots.get(job.name).values())
+        rows.sort(key=lambda row: (row[0], row[1].departure_time))
+        return rows
+
+    def report_events(self, job, events, tickets):
+        """默认的结果处理：打印状态变化"""
+        current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        # 多线程下先拼好整段再一次性输出，避免不同任务的输出交错
+        lines = [f"[{current_time}] [{job.name}] 余票变化:"]
+        for event in events:
+            ticket = event.ticket
+            if event.kind == EVENT_TRAIN_ADDED:
+                lines.append(f"  + 车次 {ticket.train_code}（{ticket.departure_time} 出发）")
+            elif event.kind == EVENT_TRAIN_REMOVED:
+                lines.append(f"  - 车次 {ticket.train_code}")
+            elif event.kind == EVENT_AVAILABLE:
+                lines.append(f"  有票！车次 {ticket.train_code} {event.seat_type}: {ticket.seat_text(event.seat_type)}")
+            elif event.kind == EVENT_SOLD_OUT:
+                lines.append(f"  车次 {ticket.train_code} {event.seat_type} 已无票")
+            else:
+                old = '有' if event.old_count == TICKETS_PLENTY else event.old_count
+                lines.append(f"  车次 {ticket.train_code} {event.seat_type}: {old} -> {ticket.seat_text(event.seat_type)}")
+        sweep = getattr(job, 'sweep', None)
+        if sweep:
+            # 区间任务附上各天合并后的当前余票，一眼看到整个区间哪天有票
+            lines.extend(format_sweep_view(sweep, self.sweep_view(sweep), job.seat_mask))
+        print("\n".join(lines))
+
+
+# 分片进程需要的配置项，其余（jobs、notify、history 等）只在协调进程中使用
+SHARD_CONFIG_KEYS = ('rate_limit', 'transport', 'station_refresh', 'proxy_pool', 'circuit_breaker', 'max_backoff')
+
+SHARD_JOBS = metrics.gauge('ticket_monitor_shard_jobs', '各分片进程负责的任务数', ('shard',))
+SHARD_RESTARTS = metrics.counter('ticket_monitor_shard_restarts_total', '分片进程异常退出后被重启的次数', ('shard',))
+
+
+def shard_route_key(job):
+    """任务的线路键：会被合并为同一次查询的任务线路键相同，分片时总在同一个进程"""
+    if job.expand_cities:
+        return (f"{job.from_station}*", f"{job.to_station}*", job.train_date, job.purpose_code)
+    return (job.from_station, job.to_station, job.train_date, job.purpose_code)
+
+
+def shard_of(route_key, shards):
+    """线路键的默认分片；用 crc32 而不是 hash()，结果不随进程和 PYTHONHASHSEED 变化"""
+    return zlib.crc32('|'.join(route_key).encode('utf-8')) % shards
+
+
+def _shard_worker(index, conn, config, jobs, max_workers, shares, monitor_options):
+    """分片进程入口：用自己的 TrainTicketMonitor 和 MonitorEngine 运行分到的任务
+
+    状态变化事件通过 conn 发回协调进程；从 conn 接收 ('add', 任务)、('remove', 任务名)、('stop', None)。
+    协调进程退出（管道断开）时本进程也停止。
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C 由协调进程处理
+    monitor = TrainTicketMonitor()
+    monitor.base_url = monitor_options.get('base_url', BASE_URL)
+    monitor.proxies = monitor_options.get('proxies')
+    refresher = configure_monitor(monitor, config, max_workers, shares)
+    send_lock = threading.Lock()
+
+    def on_events(job, events, tickets):
+        # 多个查询线程共用一个管道，发送需要加锁
+        with send_lock:
+            try:
+                conn.send(('events', job.name, events))
+            except (OSError, EOFError):
+                engine.stop()
+
+    engine = MonitorEngine(monitor, max_workers=max_workers, on_events=on_events,
+                           max_backoff=config.get('max_backoff', 600))
+    for job in jobs:
+        engine.add_job(job)
+
+    def read_commands():
+        while True:
+            try:
+                command, argument = conn.recv()
+            except (OSError, EOFError):
+                break
+            if command == 'add':
+                engine.add_job(argument)
+            elif command == 'remove':
+                engine.remove_job(argument)
+            elif command == 'stop':
+                break
+        engine.stop()
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: engine.stop())
+    threading.Thread(target=read_commands, name=f'shard-{index}-commands', daemon=True).start()
+    try:
+        engine.run()
+    finally:
+        refresher.stop()
+
+
+class _Shard:
+    """协调进程中记录的一个分片：进程、管道和分给它的任务"""
+    __slots__ = ('index', 'process', 'conn', 'jobs', 'crashes', 'started_at', 'restart_at')
+
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.conn = None
+        self.jobs = {}  # 任务名 -> 任务，进程重启后按此重新下发
+        self.crashes = 0  # 连续异常退出次数，用于重启退避
+        self.started_at = 0.0
+        self.restart_at = 0.0  # 非 0 表示进程已退出，等待到该时刻重启
+
+
+class ShardedEngine:
+    """把监控任务分到多个进程运行的协调器
+
+    单个进程里解析和 JSON 解码都在同一个 GIL 下，任务到几千个时会占满一个核。
+    任务按线路键哈希分到 processes 个分片进程，每个进程运行自己的 MonitorEngine（max_workers 个并发），
+    会被合并为同一次查询的任务总在同一进程，合并查询照常生效。分片进程只通过管道发回状态变化事件，
+    历史记录、输出和提醒都在协调进程里处理，全局只有一个 Notifier，去重和限流仍然有效。
+
+    每隔 rebalance_interval 秒按各任务的下次查询间隔估算各分片每秒的查询数，最繁忙的分片超过平均值的
+    (1 + tolerance) 倍时，把其上的线路整体迁移到最空闲的分片。分片进程异常退出后按指数退避重启，
+    并重新下发它负责的全部任务。新进程从空快照开始，迁移或重启后任务的第一批事件就是完整的当前状态，
+    协调进程据此与已知状态对账：已经知道的有票状态不重复提醒，期间卖完的座位补发已无票。
+
+    分片进程用 spawn 方式启动：协调进程里已经有提醒、历史记录等后台线程，fork 时可能复制到被这些线程
+    持有的锁，子进程会卡死。限速按 shares 份平分（默认为进程数，协调进程也要发请求时加上它自己那一份）。
+    """
+
+    report_events = MonitorEngine.report_events
+
+    def __init__(self, config, processes=2, max_workers=8, notifier=None, history=None, on_events=None,
+                 rebalance_interval=60, tolerance=0.25, monitor_options=None, prices=None, shares=None):
+        self.config = {key: config[key] for key in SHARD_CONFIG_KEYS if key in config}
+        self.shares = shares or processes
+        import multiprocessing  # 只有多进程模式才需要
+        self._context = multiprocessing.get_context('spawn')
+        self.max_workers = max_workers
+        self.notifier = notifier
+        self.history = history
+        self.prices = prices
+        self.on_events = on_events or self.report_events
+        self.rebalance_interval = rebalance_interval
+        self.tolerance = tolerance
+        self.monitor_options = monitor_options or {}
+        self.shards = [_Shard(i) for i in range(processes)]
+        self.jobs = {}  # 任务名 -> 任务
+        self._job_shard = {}  # 任务名 -> 分片
+        self._placement = {}  # 线路键 -> 分片，迁移过的线路以此为准
+        self._known = {}  # 任务名 -> (车次 -> 最近一次收到的 TrainTicket, 已知有票的 (车次, 座位) 集合)
+        self._resync = set()  # 重启或迁移后等待完整快照的任务名
+        # add_job/remove_job 可能来自其他线程（如配置热重载），与调度循环互斥
+        self._lock = threading.RLock()
+        self._stopped = threading.Event()
+        for shard in self.shards:
+            SHARD_JOBS.set_function((str(shard.index),), lambda s=shard: len(s.jobs))
+
+    def add_job(self, job):
+        """添加任务，分到其线路所在的分片（线路还没有分片时按哈希选择）"""
+        with self._lock:
+            if job.name in self.jobs:
+                self.remove_job(job.name)
+            route = shard_route_key(job)
+            shard = self._placement.get(route)
+            if shard is None:
+                shard = self._placement[route] = self.shards[shard_of(route, len(self.shards))]
+            self.jobs[job.name] = job
+            self._job_shard[job.name] = shard
+            shard.jobs[job.name] = job
+            self._send(shard, ('add', job))
+
+    def remove_job(self, name):
+        """移除任务，返回被移除的任务"""
+        with self._lock:
+            job = self.jobs.pop(name, None)
+            if job is None:
+                return None
+            shard = self._job_shard.pop(name)
+            shard.jobs.pop(name, None)
+            self._known.pop(name, None)
+            self._resync.discard(name)
+            self._send(shard, ('remove', name))
+            route = shard_route_key(job)
+            if not any(shard_route_key(other) == route for other in shard.jobs.values()):
+                self._placement.pop(route, None)
+            return job
+
+    def list_jobs(self):
+        with self._lock:
+            return list(self.jobs.values())
+
+    def _send(self, shard, message):
+        # 进程不在运行时不发送，重启时会带上 shard.jobs 中的全部任务
+        if shard.conn is None:
+            return
+        try:
+            shard.conn.send(message)
+        except (OSError, EOFError):
+            pass
+
+    def _spawn(self, shard):
+        parent_conn, child_conn = self._context.Pipe()
+        shard.process = self._context.Process(
+            target=_shard_worker, name=f'shard-{shard.index}', daemon=True,
+            args=(shard.index, child_conn, self.config, list(shard.jobs.values()), self.max_workers,
+                  self.shares, self.monitor_options))
+        shard.process.start()
+        child_conn.close()
+        shard.conn = parent_conn
+        shard.started_at = time.time()
+        shard.restart_at = 0.0
+
+    def run(self):
+        """启动各分片进程并处理它们发回的事件，直到调用 stop()"""
+        import multiprocessing.connection
+        print(f"多进程监控启动: {len(self.jobs)} 个任务, {len(self.shards)} 个进程, "
+              f"每个进程最大并发 {self.max_workers}")
+        with self._lock:
+            for shard in self.shards:
+                self._spawn(shard)
+        next_rebalance = time.time() + self.rebalance_interval
+        sweep_day = datetime.date.today()
+        try:
+            while not self._stopped.is_set():
+                if datetime.date.today() != sweep_day:
+                    sweep_day = datetime.date.today()
+                    roll_sweeps(self, sweep_day)
+                with self._lock:
+                    conns = {shard.conn: shard for shard in self.shards if shard.conn is not None}
+                for conn in multiprocessing.connection.wait(list(conns), timeout=1.0):
                     try:
-                        data = response.json()
-                        
-                        # 检查API返回的数据结构
-                        if 'data' in data and 'result' in data['data']:
-                            tickets = []
-                            for ticket_info in data['data']['result']:
-                                ticket_data = ticket_info.split('|')
-                                if len(ticket_data) < 34:  # 确保数据完整
-                                    continue
-                                    
-                                train_info = {
-                                    'train_code': ticket_data[3],  # 车次
-                                    'from_station': ticket_data[6],  # 出发站代码
-                                    'to_station': ticket_data[7],  # 到达站代码
-                                    'departure_time': ticket_data[8],  # 出发时间
-                                    'arrival_time': ticket_data[9],  # 到达时间
-                                    'duration': ticket_data[10],  # 历时
-                                    'seats': {
-                                        '商务座': ticket_data[32] or '--',
-                                        '一等座': ticket_data[31] or '--',
-                                        '二等座': ticket_data[30] or '--',
-                                        '高级软卧': ticket_data[21] or '--',
-                                        '软卧': ticket_data[23] or '--',
-                                        '动卧': ticket_data[33] or '--',
-                                        '硬卧': ticket_data[28] or '--',
-                                        '软座': ticket_data[24] or '--',
-                                        '硬座': ticket_data[29] or '--',
-                                        '无座': ticket_data[26] or '--',
-                                    }
-                                }
-                                
-                                # 如果指定了车次，只返回指定车次的信息
-                                if train_codes and train_info['train_code'] not in train_codes:
-                                    continue
-                                    
-                                tickets.append(train_info)
-                            
-                            if tickets:  # 如果找到了票，立即返回
-                                return tickets
-                            else:
-                                print("没有找到符合条件的车次")
-                        else:
-                            print(f"查询失败，返回数据格式不正确")
-                            if 'messages' in data:
-                                print(f"错误信息: {data['messages']}")
-                            elif 'message' in data:
-                                print(f"错误信息: {data['message']}")
-                            
-                    except json.JSONDecodeError:
-                        print("响应不是有效的JSON格式")
-                        # 如果响应包含HTML，可能是重定向到登录页面
-                        if '<html' in response.text.lower():
-                            print("API返回了HTML页面，可能需要登录")
-                        continue
-                        
-                except requests.exceptions.RequestException as e:
-                    print(f"请求异常: {e}")
+                        message = conn.recv()
+                    except (OSError, EOFError):
+                        continue  # 进程已退出，由 _check_processes 处理
+                    if message[0] == 'events':
+                        with self._lock:
+                            self.handle_events(message[1], message[2], conns[conn])
+                now = time.time()
+                with self._lock:
+                    self._check_processes(now)
+                    if self.rebalance_interval and now >= next_rebalance:
+                        self.rebalance(now)
+                        next_rebalance = now + self.rebalance_interval
+        finally:
+            with self._lock:
+                self._shutdown()
+            print("多进程监控已停止")
+
+    def stop(self):
+        self._stopped.set()
+
+    def _shutdown(self, timeout=10):
+        for shard in self.shards:
+            self._send(shard, ('stop', None))
+        deadline = time.time() + timeout
+        for shard in self.shards:
+            if shard.process is None:
+                continue
+            shard.process.join(max(0, deadline - time.time()))
+            if shard.process.is_alive():
+                shard.process.terminate()
+                shard.process.join()
+            if shard.conn is not None:
+                shard.conn.close()
+                shard.conn = None
+
+    def _check_processes(self, now):
+        """发现异常退出的分片进程，退避后用原来的任务重启"""
+        for shard in self.shards:
+            if shard.restart_at:
+                if now >= shard.restart_at:
+                    print(f"重启分片进程 {shard.index}（{len(shard.jobs)} 个任务）")
+                    self._resync.update(shard.jobs)
+                    self._spawn(shard)
+                continue
+            if shard.process is None or shard.process.is_alive():
+                continue
+            if now - shard.started_at > 60:
+                shard.crashes = 0  # 运行了一段时间才退出，不算连续崩溃
+            shard.crashes += 1
+            SHARD_RESTARTS.labels(str(shard.index)).add()
+            shard.conn.close()
+            shard.conn = None
+            shard.restart_at = now + backoff_delay(shard.crashes - 1, 1, 60)
+            print(f"分片进程 {shard.index} 异常退出（退出码 {shard.process.exitcode}），"
+                  f"{shard.restart_at - now:.1f} 秒后重启")
+
+    def handle_events(self, job_name, events, shard=None):
+        """处理分片进程发回的状态变化：去掉已知状态的重复事件后记录历史、输出并提醒
+
+        shard 为发出事件的分片，不是任务当前所在分片时丢弃（迁移前发出的事件）。
+        """
+        job = self.jobs.get(job_name)
+        if job is None or (shard is not None and self._job_shard.get(job_name) is not shard):
+            return  # 任务已移除或已迁移，迁移前发出的事件
+        if job_name in self._resync:
+            self._resync.discard(job_name)
+            fresh = self._reconcile(job_name, events)
+        else:
+            fresh = self._dedupe(job_name, events)
+        if not fresh:
+            return
+        if self.history is not None:
+            self.history.record(job, fresh)
+        tickets = list({event.ticket.train_code: event.ticket for event in fresh}.values())
+        self.on_events(job, fresh, tickets)
+        if self.prices is not None:
+            self.prices.submit(job, fresh)
+        elif self.notifier is not None:
+            alert = build_alert(job, fresh)
+            if alert:
+                self.notifier.notify(alert)
+
+    def _reconcile(self, job_name, events):
+        # 重启或迁移后的第一批事件：新进程从空快照开始，这批事件就是完整的当前状态（新增车次和有票座位），
+        # 用它替换已知状态；只报告与已知状态不同的部分，期间卖完的座位和消失的车次补发事件
+        old_trains, old_available = self._known.get(job_name, ({}, set()))
+        trains = {event.ticket.train_code: event.ticket for event in events}
+        available = {(event.ticket.train_code, event.seat_type) for event in events if event.kind == EVENT_AVAILABLE}
+        fresh = []
+        for event in events:
+            train_code = event.ticket.train_code
+            if event.kind == EVENT_TRAIN_ADDED and train_code in old_trains:
+                continue
+            if event.kind == EVENT_AVAILABLE and (train_code, event.seat_type) in old_available:
+                continue
+            fresh.append(event)
+        for train_code, seat_type in sorted(old_available - available):
+            ticket = trains.get(train_code)
+            if ticket is not None:
+                old_count = old_trains[train_code].seat_count(seat_type) if train_code in old_trains else 0
+                fresh.append(SeatEvent(EVENT_SOLD_OUT, ticket, seat_type, old_count, ticket.seat_count(seat_type)))
+        for train_code, ticket in old_trains.items():
+            if train_code not in trains:
+                fresh.append(SeatEvent(EVENT_TRAIN_REMOVED, ticket))
+        self._known[job_name] = (trains, available)
+        return fresh
+
+    def _dedupe(self, job_name, events):
+        trains, available = self._known.setdefault(job_name, ({}, set()))
+        fresh = []
+        for event in events:
+            train_code = event.ticket.train_code
+            if event.kind == EVENT_TRAIN_REMOVED:
+                trains.pop(train_code, None)
+                available.difference_update([(train_code, seat_type) for seat_type in SEAT_TYPES])
+                fresh.append(event)
+                continue
+            known = train_code in trains
+            trains[train_code] = event.ticket  # 保留最新的余票，供区间任务的合并视图使用
+            if event.kind == EVENT_TRAIN_ADDED:
+                if known:
                     continue
-            
-            print("所有API端点都失败，无法获取车票信息")
-            return []
-                
-        except Exception as e:
-            print(f"查询出错: {e}")
-            print(f"错误类型: {type(e).__name__}")
-            if hasattr(e, 'response') and e.response:
-                print(f"响应状态码: {e.response.status_code}")
-                print(f"响应内容: {e.response.text[:200]}...")  # 只打印前200个字符
-            return []
-    
-    def get_station_code(self, station_name):
-        """获取站点代码"""
-        # 尝试从本地缓存获取站点代码
+            elif event.kind == EVENT_AVAILABLE:
+                if (train_code, event.seat_type) in available:
+                    continue
+                available.add((train_code, event.seat_type))
+            elif event.kind == EVENT_SOLD_OUT:
+                available.discard((train_code, event.seat_type))
+            fresh.append(event)
+        return fresh
+
+    def sweep_view(self, sweep):
+        """日期区间任务各天的当前余票合并视图，按分片进程发回的最新余票拼出，格式同 MonitorEngine.sweep_view"""
+        with self._lock:
+            rows = []
+            for job in self.jobs.values():
+                if getattr(job, 'sweep', None) == sweep:
+                    trains = self._known.get(job.name, ({}, set()))[0]
+                    rows.extend((job.train_date, ticket) for ticket in trains.values())
+        rows.sort(key=lambda row: (row[0], row[1].departure_time))
+        return rows
+
+    def shard_loads(self, now=None):
+        """各分片上每条线路预计每秒的查询次数（按组内最短的下次查询间隔）"""
+        loads = []
+        for shard in self.shards:
+            routes = {}
+            for job in shard.jobs.values():
+                route = shard_route_key(job)
+                routes[route] = max(routes.get(route, 0.0), 1.0 / max(job.next_delay(now), 1))
+            loads.append(routes)
+        return loads
+
+    def rebalance(self, now=None):
+        """把线路从最繁忙的分片迁移到最空闲的分片，直到负载相差在 tolerance 以内，返回迁移的线路数"""
+        loads = self.shard_loads(now)
+        totals = [sum(routes.values()) for routes in loads]
+        average = sum(totals) / len(totals)
+        moved = 0
+        while True:
+            busiest = max(range(len(totals)), key=totals.__getitem__)
+            idlest = min(range(len(totals)), key=totals.__getitem__)
+            if totals[busiest] <= average * (1 + self.tolerance):
+                break
+            # 只迁移负载小于两者差距的线路，迁移后差距一定缩小，不会来回搬动
+            gap = totals[busiest] - totals[idlest]
+            candidates = [(load, route) for route, load in loads[busiest].items() if load < gap]
+            if not candidates:
+                break
+            load, route = max(candidates)
+            self._move_route(route, self.shards[busiest], self.shards[idlest])
+            del loads[busiest][route]
+            loads[idlest][route] = load
+            totals[busiest] -= load
+            totals[idlest] += load
+            moved += 1
+        if moved:
+            print(f"重新分配了 {moved} 条线路，各分片每秒查询数: "
+                  + ", ".join(f"{total:.2f}" for total in totals))
+        return moved
+
+    def _move_route(self, route, source, target):
+        jobs = [job for job in source.jobs.values() if shard_route_key(job) == route]
+        for job in jobs:
+            del source.jobs[job.name]
+            self._send(source, ('remove', job.name))
+            target.jobs[job.name] = job
+            self._job_shard[job.name] = target
+            self._resync.add(job.name)
+            self._send(target, ('add', job))
+        self._placement[route] = target
+
+
+CONFIG_RELOADS = metrics.counter('ticket_monitor_config_reloads_total', '配置文件热重载次数', ('result',))
+
+
+class ConfigWatcher:
+    """监视配置文件，修改后只增删、更新有变化的任务，不重启进程
+
+    按 interval 秒检查文件的修改时间和大小。文件变化后先完整地解析新配置并检查所有任务，
+    任何一处出错（YAML 语法、日期格式、缺少字段、任务名重复）都整体放弃这次修改，继续运行原来的任务，
+    直到文件再次被修改。新旧任务按任务名比较：删除的任务移除，新增的任务加入，参数变化的任务
+    先移除再加入（丢弃旧快照，按新条件重新报告当前余票），未变的任务保留快照不受影响。
+    引擎、Session、接口缓存和站点表都不重建；jobs/query_params 之外的配置修改需要重启才会生效。
+    """
+
+    def __init__(self, path, engine, config=None, interval=5):
+        self.path = path
+        self.engine = engine
+        self.config = config or {}  # 启动时的配置，用于提示哪些修改需要重启
+        self.interval = interval
+        self._stamp = self._stat()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _stat(self):
         try:
-            with open('station_codes.json', 'r', encoding='utf-8') as f:
-                station_codes = json.load(f)
-                if station_name in station_codes:
-                    return station_codes[station_name]
-        except (FileNotFoundError, json.JSONDecodeError):
-            # 如果本地缓存不存在或无效，则从12306获取
+            stat = os.stat(self.path)
+        except OSError:
+            return None  # 编辑器保存时文件可能短暂不存在
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def check(self):
+        """文件有变化时重新加载，返回是否应用了新配置"""
+        stamp = self._stat()
+        if stamp is None or stamp == self._stamp:
+            return False
+        self._stamp = stamp
+        return self.reload()
+
+    def reload(self):
+        """读取配置文件并应用任务的变化；配置有误时不做任何修改并返回 False"""
+        config = load_config(self.path)
+        error = None
+        if not config:
+            error = "无法读取配置文件"
+        else:
             try:
-                print("正在从12306获取站点代码表...")
-                url = "https://kyfw.12306.cn/otn/resources/js/framework/station_name.js"
-                response = self.session.get(url, headers=self.headers)
-                response.raise_for_status()
-                
-                # 解析站点代码
-                station_text = response.text
-                station_text = station_text.split('=')[1].strip("';\n")
-                stations = station_text.split('@')
-                
-                station_codes = {}
-                for station in stations:
-                    if not station:
-                        continue
-                    parts = station.split('|')
-                    if len(parts) >= 5:
-                        station_codes[parts[1]] = parts[2]  # 站名:代码
-                
-                # 保存到本地缓存
-                with open('station_codes.json', 'w', encoding='utf-8') as f:
-                    json.dump(station_codes, f, ensure_ascii=False, indent=2)
-                    
-                if station_name in station_codes:
-                    return station_codes[station_name]
+                jobs = load_jobs(config)
+                error = check_jobs(jobs)
             except Exception as e:
-                print(f"获取站点代码表失败: {e}")
-        
-        # 如果无法从12306获取，则使用内置的简化站点代码表
-        fallback_codes = {
-            '北京': 'BJP', '上海': 'SHH', '广州': 'GZQ', '深圳': 'SZQ',
-            '杭州': 'HZH', '南京': 'NJH', '武汉': 'WHN', '西安': 'XAY',
-            '成都': 'CDW', '重庆': 'CQW', '天津': 'TJP', '长沙': 'CSQ',
-            '郑州': 'ZZF', '济南': 'JNK', '青岛': 'QDK', '大连': 'DLT',
-            '沈阳': 'SYT', '哈尔滨': 'HBB', '长春': 'CCT',
-            '太子城': 'TZC', '清河': 'QIP'
-        }
-        return fallback_codes.get(station_name)
-    
-    def has_available_tickets(self, ticket_info, seat_types=None):
-        """检查是否有可用票"""
-        if not seat_types:
-            seat_types = ['二等座', '一等座', '商务座', '硬卧', '软卧', '硬座']
-            
-        for seat_type in seat_types:
-            if seat_type in ticket_info['seats'] and ticket_info['seats'][seat_type] not in ['--', '无']:
-                return True
-        return False
-    
-    def monitor_tickets(self, from_station, to_station, train_date, train_codes, seat_types=None, interval=60):
-        """监控车票，有票时提醒"""
-        print(f"开始监控 {from_station} 到 {to_station} 在 {train_date} 的车票")
-        print(f"监控车次: {', '.join(train_codes) if train_codes else '所有车次'}")
-        print(f"监控座位类型: {', '.join(seat_types) if seat_types else '所有座位类型'}")
-        print(f"检查间隔: {interval}秒")
-        print("=" * 50)
-        
-        while True:
-            current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            print(f"\n[{current_time}] 正在查询...")
-            
-            tickets = self.query_tickets(from_station, to_station, train_date, train_codes)
-            
-            if tickets:
-                self.display_tickets(tickets)
-                
-                # 检查是否有可用票
-                available_tickets = []
-                for ticket in tickets:
-                    if self.has_available_tickets(ticket, seat_types):
-                        available_tickets.append(ticket)
-                
-                if available_tickets:
-                    print("\n发现有票！")
-                    
-                    # 构建通知消息
-                    notification_title = f"12306 车票提醒 - {from_station}到{to_station}"
-                    notification_message = ""
-                    
-                    for ticket in available_tickets:
-                        ticket_info = f"车次: {ticket['train_code']}, 出发: {ticket['departure_time']}"
-                        print(ticket_info)
-                        notification_message += ticket_info + "\n"
-                        
-                        for seat_type in seat_types if seat_types else ticket['seats'].keys():
-                            if ticket['seats'][seat_type] not in ['--', '无']:
-                                seat_info = f"  {seat_type}: {ticket['seats'][seat_type]}"
-                                print(seat_info)
-                                notification_message += seat_info + "\n"
-                    
-                    # 发出提醒声音（根据不同操作系统）
-                    for _ in range(5):
-                        if system == 'Windows':
-                            winsound.Beep(1000, 500)
-                        else:
-                            play_alert()
-                        time.sleep(0.5)
-                    
-                    # 显示系统通知
-                    if system == 'Darwin' or system == 'Linux':
-                        show_notification(notification_title, notification_message)
-                    
-                    # 询问是否继续监控
-                    choice = input("\n是否继续监控? (y/n): ")
-                    if choice.lower() != 'y':
-                        print("停止监控")
-                        break
-            else:
-                print("没有查询到符合条件的车次")
-            
-            print(f"等待 {interval} 秒后重新查询...")
-            time.sleep(interval)
-    
-    def display_tickets(self, tickets):
-        """显示车票信息"""
-        if not tickets:
-            print("没有查询到符合条件的车次")
+                error = str(e)
+        if error:
+            CONFIG_RELOADS.labels('rejected').add()
+            print(f"配置文件有误，继续使用原来的任务: {error}")
+            return False
+        current = {job.name: job for job in self.engine.list_jobs()}
+        new = {job.name: job for job in jobs}
+        removed = [name for name in current if name not in new]
+        added = [job for name, job in new.items() if name not in current]
+        changed = [job for name, job in new.items()
+                   if name in current and job.signature() != current[name].signature()]
+        for name in removed:
+            self.engine.remove_job(name)
+        for job in changed:
+            self.engine.remove_job(job.name)
+            self.engine.add_job(job)
+        for job in added:
+            self.engine.add_job(job)
+        ignored = sorted(key for key in set(config) | set(self.config)
+                         if key not in ('jobs', 'query_params') and config.get(key) != self.config.get(key))
+        CONFIG_RELOADS.labels('applied').add()
+        print(f"配置已重新加载: 新增 {len(added)} 个任务，修改 {len(changed)} 个，删除 {len(removed)} 个")
+        if ignored:
+            print(f"以下配置项的修改需要重启后生效: {', '.join(ignored)}")
+        return True
+
+    def start(self):
+        if self._thread is None and self.interval:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name='config-watcher', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                print(f"检查配置文件出错: {e}")
+
+
+DASHBOARD_SEAT_TYPES = ('商务座', '一等座', '二等座', '硬卧', '软卧', '硬座', '无座')
+
+
+def display_width(text):
+    """字符串在终端中占的列数，中文等宽字符算两列"""
+    return sum(2 if unicodedata.east_asian_width(c) in ('W', 'F') else 1 for c in text)
+
+
+def pad_cell(text, width):
+    """截断或补空格到正好 width 列"""
+    used = 0
+    out = []
+    for c in text:
+        w = 2 if unicodedata.east_asian_width(c) in ('W', 'F') else 1
+        if used + w > width:
+            break
+        out.append(c)
+        used += w
+    return ''.join(out) + ' ' * (width - used)
+
+
+class Dashboard:
+    """多任务实时看板（curses），适合通过 SSH 长时间查看
+
+    每个任务一组行：标题行加每个车次一行。引擎只在任务有变化时通知看板，看板按 max_fps 限制刷新频率，
+    每次只重写内容变了的单元格；车次增减或终端大小变化时才整屏重画。
+    运行期间的 print 输出进入底部的日志区，同时可写入 log_file。按 q 退出，PgUp/PgDn 翻页。
+    """
+
+    COLUMNS = (('车次', 7), ('出发', 6), ('到达', 6), ('历时', 6)) + tuple((seat, 7) for seat in DASHBOARD_SEAT_TYPES)
+
+    def __init__(self, engine, max_fps=2, log_file=None, log_lines=8):
+        self.engine = engine
+        self.max_fps = max_fps
+        self.log_lines = log_lines
+        self.log_file = log_file
+        self._lock = threading.Lock()
+        self._dirty = set()          # 有变化、等待重画的任务名
+        self._changed_at = {}        # 任务名 -> 最近一次变化的时间
+        self._log = collections.deque(maxlen=max(log_lines, 1) * 4)
+        self._log_dirty = True
+        self._partial = ''
+        self._log_handle = None
+        self._layout = None          # 任务名 -> (起始行, 车次列表)，None 表示需要整屏重画
+        self._cells = {}             # (行, 列) -> (文本, 属性)，屏幕上当前显示的内容
+        self._offset = 0
+        self._attrs = {}
+
+    # 引擎回调
+    def on_events(self, job, events, tickets):
+        with self._lock:
+            self._dirty.add(job.name)
+            self._changed_at[job.name] = time.time()
+
+    # 代替 sys.stdout，接收运行期间的 print 输出
+    def write(self, text):
+        with self._lock:
+            text = self._partial + text
+            lines = text.split('\n')
+            self._partial = lines.pop()
+            for line in lines:
+                if line:
+                    self._log.append(line)
+                    if self._log_handle is not None:
+                        self._log_handle.write(line + '\n')
+            if lines:
+                self._log_dirty = True
+        return len(text)
+
+    def flush(self):
+        if self._log_handle is not None:
+            self._log_handle.flush()
+
+    def run(self):
+        """在当前线程显示看板，引擎在后台线程运行；引擎停止后返回"""
+        try:
+            import curses  # Windows 上需要安装 windows-curses
+        except ImportError:
+            print("当前环境没有 curses 模块，改为普通输出（Windows 可安装 windows-curses）")
+            if self.engine.on_events == self.on_events:
+                # 事件不能再进看板的缓冲区，恢复为打印到标准输出
+                self.engine.on_events = self.engine.report_events
+            self.engine.run()
             return
-            
-        table = PrettyTable()
-        table.field_names = ["车次", "出发时间", "到达时间", "历时", "商务座", "一等座", "二等座", "硬卧", "软卧", "硬座", "无座"]
-        
-        for ticket in tickets:
-            table.add_row([
-                ticket['train_code'],
-                ticket['departure_time'],
-                ticket['arrival_time'],
-                ticket['duration'],
-                ticket['seats']['商务座'],
-                ticket['seats']['一等座'],
-                ticket['seats']['二等座'],
-                ticket['seats']['硬卧'],
-                ticket['seats']['软卧'],
-                ticket['seats']['硬座'],
-                ticket['seats']['无座']
-            ])
-        
-        print(table)
+        import locale
+        locale.setlocale(locale.LC_ALL, '')
+        if self.log_file:
+            self._log_handle = open(self.log_file, 'a', encoding='utf-8')
+        try:
+            curses.wrapper(self._main, curses)
+        finally:
+            if self._log_handle is not None:
+                self._log_handle.close()
+                self._log_handle = None
 
-    def query_tickets_from_web(self, from_station, to_station, train_date, train_codes=None):
-        """从12306网页爬取车票信息"""
-        # 获取站点代码
-        from_code = self.get_station_code(from_station)
-        to_code = self.get_station_code(to_station)
-        
-        if not from_code or not to_code:
-            print(f"无法找到站点代码: {from_station} 或 {to_station}")
-            return []
-        
-        # 构建URL
-        url = f"https://kyfw.12306.cn/otn/leftTicket/init?linktypeid=dc&fs={from_station},{from_code}&ts={to_station},{to_code}&date={train_date}&flag=N,N,Y"
-        
-        print(f"访问网页: {url}")
-        
-        # 添加更多请求头，模拟真实浏览器
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
-            'Accept-Language': 'zh-CN,zh;q=0.9,en;q=0.8',
-            'Referer': 'https://kyfw.12306.cn/otn/index/init',
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1',
-            'sec-ch-ua': '"Google Chrome";v="120", "Chromium";v="120", "Not-A.Brand";v="99"',
-            'sec-ch-ua-mobile': '?0',
-            'sec-ch-ua-platform': '"macOS"',
-            'Sec-Fetch-Dest': 'document',
-            'Sec-Fetch-Mode': 'navigate',
-            'Sec-Fetch-Site': 'same-origin',
-            'Sec-Fetch-User': '?1',
-        }
-        
+    def _main(self, screen, curses):
         try:
-            # 添加随机延迟
-            delay = random.uniform(1, 3)
-            print(f"随机延迟 {delay:.2f} 秒...")
-            time.sleep(delay)
-            
-            # 发送请求
-            response = self.session.get(
-                url, 
-                headers=headers, 
-                timeout=15,
-                proxies=self.proxies,
-                verify=False
-            )
-            response.raise_for_status()
-            
-            # 检查是否需要登录
-            if "请登录" in response.text or "登录名" in response.text:
-                print("需要登录12306账号才能查询车票")
-                return []
-            
-            # 这个页面不直接包含车票数据，而是通过JavaScript加载
-            # 我们需要提取出查询参数，然后调用API获取数据
-            
-            # 从页面中提取查询参数
-            import re
-            
-            # 提取CLeftTicketUrl
-            ticket_url_match = re.search(r"var CLeftTicketUrl = '([^']+)'", response.text)
-            if not ticket_url_match:
-                print("无法从页面提取查询参数")
-                return []
-            
-            ticket_url = ticket_url_match.group(1)
-            
-            # 构建API URL
-            api_url = f"https://kyfw.12306.cn/otn/{ticket_url}?leftTicketDTO.train_date={train_date}&leftTicketDTO.from_station={from_code}&leftTicketDTO.to_station={to_code}&purpose_codes=ADULT"
-            
-            print(f"提取到的API URL: {api_url}")
-            
-            # 添加随机延迟
-            time.sleep(random.uniform(0.5, 1.5))
-            
-            # 发送API请求
-            api_headers = headers.copy()
-            api_headers['Accept'] = '*/*'
-            api_headers['X-Requested-With'] = 'XMLHttpRequest'
-            
-            api_response = self.session.get(
-                api_url,
-                headers=api_headers,
-                timeout=15,
-                proxies=self.proxies,
-                verify=False
-            )
-            api_response.raise_for_status()
-            
-            # 解析JSON响应
-            data = api_response.json()
-            
-            # 检查API返回的数据结构
-            if 'data' in data and 'result' in data['data']:
-                tickets = []
-                for ticket_info in data['data']['result']:
-                    ticket_data = ticket_info.split('|')
-                    if len(ticket_data) < 34:  # 确保数据完整
-                        continue
-                        
-                    train_info = {
-                        'train_code': ticket_data[3],  # 车次
-                        'from_station': ticket_data[6],  # 出发站代码
-                        'to_station': ticket_data[7],  # 到达站代码
-                        'departure_time': ticket_data[8],  # 出发时间
-                        'arrival_time': ticket_data[9],  # 到达时间
-                        'duration': ticket_data[10],  # 历时
-                        'seats': {
-                            '商务座': ticket_data[32] or '--',
-                            '一等座': ticket_data[31] or '--',
-                            '二等座': ticket_data[30] or '--',
-                            '高级软卧': ticket_data[21] or '--',
-                            '软卧': ticket_data[23] or '--',
-                            '动卧': ticket_data[33] or '--',
-                            '硬卧': ticket_data[28] or '--',
-                            '软座': ticket_data[24] or '--',
-                            '硬座': ticket_data[29] or '--',
-                            '无座': ticket_data[26] or '--',
-                        }
-                    }
-                    
-                    # 如果指定了车次，只返回指定车次的信息
-                    if train_codes and train_info['train_code'] not in train_codes:
-                        continue
-                        
-                    tickets.append(train_info)
-                
-                if tickets:
-                    return tickets
-                else:
-                    print("没有找到符合条件的车次")
-                    return []
+            curses.curs_set(0)
+        except curses.error:
+            pass
+        if curses.has_colors():
+            curses.use_default_colors()
+            curses.init_pair(1, curses.COLOR_GREEN, -1)
+            curses.init_pair(2, curses.COLOR_CYAN, -1)
+            self._attrs = {'available': curses.color_pair(1) | curses.A_BOLD, 'header': curses.color_pair(2) | curses.A_BOLD}
+        else:
+            self._attrs = {'available': curses.A_BOLD, 'header': curses.A_REVERSE}
+        screen.timeout(int(1000 / self.max_fps))
+        thread = threading.Thread(target=self.engine.run, name='engine', daemon=True)
+        with contextlib.redirect_stdout(self):
+            thread.start()
+            while thread.is_alive():
+                key = screen.getch()
+                if key in (ord('q'), ord('Q')):
+                    self.engine.stop()
+                elif key in (curses.KEY_NPAGE, curses.KEY_PPAGE):
+                    height = screen.getmaxyx()[0]
+                    step = max(1, height - self.log_lines - 3)
+                    self._offset = max(0, self._offset + (step if key == curses.KEY_NPAGE else -step))
+                    self._layout = None
+                elif key == curses.KEY_RESIZE:
+                    self._layout = None
+                self._draw(screen, curses)
+            thread.join()
+
+    def _job_rows(self, job):
+        """任务当前要显示的车次列表"""
+        snapshot = self.engine.snapshots.get(job.name)
+        return sorted(snapshot.values(), key=lambda ticket: (ticket.departure_time, ticket.train_code))
+
+    def _draw(self, screen, curses):
+        height, width = screen.getmaxyx()
+        body_height = max(1, height - self.log_lines - 2)
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            log_dirty, self._log_dirty = self._log_dirty, False
+            log = list(self._log)[-self.log_lines:]
+        jobs = sorted(self.engine.list_jobs(), key=lambda job: job.name)
+
+        # 某个任务的车次增减了（行数变化）就整屏重新布局
+        if self._layout is not None:
+            names = [job.name for job in jobs]
+            if names != list(self._layout):
+                self._layout = None
             else:
-                print("API返回数据格式不正确")
-                return []
-                
-        except Exception as e:
-            print(f"从网页爬取车票信息失败: {e}")
-            print(f"错误类型: {type(e).__name__}")
-            if hasattr(e, 'response') and e.response:
-                print(f"响应状态码: {e.response.status_code}")
+                for job in jobs:
+                    if job.name in dirty and [t.train_code for t in self._job_rows(job)] != self._layout[job.name][1]:
+                        self._layout = None
+                        break
+        if self._layout is None:
+            screen.erase()
+            self._cells = {}
+            layout = {}
+            row = 1
+            for job in jobs:
+                layout[job.name] = (row, [t.train_code for t in self._job_rows(job)])
+                row += 1 + len(layout[job.name][1])
+            self._layout = layout
+            dirty = set(layout)
+            log_dirty = True
+            heading = ''.join(pad_cell(name, w) for name, w in self.COLUMNS)
+            self._put(screen, 0, 0, pad_cell(heading, width - 1), curses.A_REVERSE)
+
+        for job in jobs:
+            if job.name not in dirty:
+                continue
+            start, codes = self._layout[job.name]
+            changed_at = self._changed_at.get(job.name)
+            stamp = datetime.datetime.fromtimestamp(changed_at).strftime('%H:%M:%S') if changed_at else '--:--:--'
+            title = f"{job.name}  {job.from_station}→{job.to_station} {job.train_date}  更新于 {stamp}"
+            self._put_body(screen, start, 0, pad_cell(title, width - 1), self._attrs['header'], body_height)
+            for i, ticket in enumerate(self._job_rows(job)):
+                x = 0
+                values = [ticket.train_code, ticket.departure_time, ticket.arrival_time, ticket.duration]
+                values += [ticket.seat_text(seat) for seat in DASHBOARD_SEAT_TYPES]
+                for (name, w), value in zip(self.COLUMNS, values):
+                    attr = self._attrs['available'] if name in SEAT_BITS and ticket.seat_count(name) else curses.A_NORMAL
+                    self._put_body(screen, start + 1 + i, x, pad_cell(value, w), attr, body_height)
+                    x += w
+
+        if log_dirty:
+            top = height - self.log_lines - 1
+            self._put(screen, top, 0, pad_cell('─' * width, width - 1), curses.A_DIM)
+            for i in range(self.log_lines):
+                line = log[i] if i < len(log) else ''
+                self._put(screen, top + 1 + i, 0, pad_cell(line, width - 1), curses.A_NORMAL)
+        screen.noutrefresh()
+        curses.doupdate()
+
+    def _put_body(self, screen, row, x, text, attr, body_height):
+        row -= self._offset
+        if 1 <= row < body_height + 1:
+            self._put(screen, row, x, text, attr)
+
+    def _put(self, screen, row, x, text, attr):
+        # 只有内容或属性变了才写入，curses 再只把变化发送到终端
+        if self._cells.get((row, x)) == (text, attr):
+            return
+        self._cells[(row, x)] = (text, attr)
+        try:
+            screen.addstr(row, x, text, attr)
+        except Exception:
+            pass  # 写到屏幕右下角或超出范围时 curses 会报错，忽略
+
+
+# 默认的中转枢纽（城市主站，12306 按城市返回所有车站的车次）
+DEFAULT_TRANSFER_HUBS = ('北京', '上海', '天津', '石家庄', '郑州', '武汉', '济南', '徐州', '南京', '合肥',
+                         '杭州', '长沙', '广州', '西安', '成都', '重庆', '沈阳', '张家口')
+
+
+def clock_minutes(text):
+    """'08:30' -> 510，无法解析时返回 None"""
+    try:
+        hours, minutes = text.split(':')
+        return int(hours) * 60 + int(minutes)
+    except (AttributeError, ValueError):
+        return None
+
+
+class TransferLeg:
+    """中转方案中的一段：车次及其相对出发日 0 点的绝对出发/到达分钟数"""
+    __slots__ = ('ticket', 'train_date', 'depart', 'arrive', 'seats')
+
+    def __init__(self, ticket, train_date, day_offset, mask):
+        self.ticket = ticket
+        self.train_date = train_date
+        self.depart = day_offset * 1440 + clock_minutes(ticket.departure_time)
+        self.arrive = self.depart + clock_minutes(ticket.duration)
+        self.seats = ticket.available_seats(mask)
+
+
+class Itinerary:
+    """两段中转方案"""
+    __slots__ = ('first', 'second', 'hub')
+
+    def __init__(self, first, second, hub):
+        self.first = first
+        self.second = second
+        self.hub = hub
+
+    @property
+    def connection_minutes(self):
+        return self.second.depart - self.first.arrive
+
+    @property
+    def total_minutes(self):
+        return self.second.arrive - self.first.depart
+
+    def __repr__(self):
+        return (f"Itinerary({self.first.ticket.train_code} -> {self.hub} -> {self.second.ticket.train_code}, "
+                f"{self.total_minutes} 分钟)")
+
+
+def join_legs(first_legs, second_legs, min_connection, max_connection):
+    """按换乘站把两段车次连接起来
+
+    两边分别按到达/出发时间排序后做区间归并：第一段到达时间递增，
+    第二段可接续的窗口 [到达+min_connection, 到达+max_connection] 的上下界都只会向后移动。
+    """
+    by_station = {}
+    for leg in second_legs:
+        by_station.setdefault(leg.ticket.from_station, []).append(leg)
+    for legs in by_station.values():
+        legs.sort(key=lambda leg: leg.depart)
+
+    pairs = []
+    first_by_station = {}
+    for leg in first_legs:
+        first_by_station.setdefault(leg.ticket.to_station, []).append(leg)
+    for station, arrivals in first_by_station.items():
+        departures = by_station.get(station)
+        if not departures:
+            continue
+        arrivals.sort(key=lambda leg: leg.arrive)
+        low = high = 0
+        for first in arrivals:
+            earliest = first.arrive + min_connection
+            latest = first.arrive + max_connection
+            while low < len(departures) and departures[low].depart < earliest:
+                low += 1
+            high = max(high, low)
+            while high < len(departures) and departures[high].depart <= latest:
+                high += 1
+            for second in departures[low:high]:
+                pairs.append((first, second))
+    return pairs
+
+
+class TransferSearch:
+    """经中转枢纽的两段换乘查询
+
+    对每个候选枢纽并发查询 出发站->枢纽 和 枢纽->到达站 两段，两段都走 QueryCoalescer，
+    leg_ttl 秒内相同的一段（比如多个目的地共用的第一段）只请求一次。
+    换乘站必须是同一个车站，换乘时间在 [min_connection, max_connection] 分钟之间。
+    先查询所有候选枢纽的第一段，按出发站到枢纽的直达车次数排序（在干线上的枢纽车次多），
+    只对排在前面的 max_hubs 个枢纽查询第二段，为 0 或 None 时不限制。
+    """
+
+    def __init__(self, monitor=None, coalescer=None, hubs=DEFAULT_TRANSFER_HUBS, min_connection=20,
+                 max_connection=240, leg_ttl=300, max_workers=8, max_hubs=6):
+        self.monitor = monitor or TrainTicketMonitor()
+        self.coalescer = coalescer or QueryCoalescer(self.monitor)
+        self.hubs = tuple(hubs)
+        self.min_connection = min_connection
+        self.max_connection = max_connection
+        self.leg_ttl = leg_ttl
+        self.max_workers = max_workers
+        self.max_hubs = max_hubs
+
+    def candidate_hubs(self, from_station, to_station):
+        """排除起终点所在城市和站点表里没有的枢纽"""
+        index = self.monitor.station_index()
+        excluded = {index.station_city.get(name, name) for name in (from_station, to_station)}
+        hubs = []
+        for hub in self.hubs:
+            if hub in index and index.station_city.get(hub, hub) not in excluded:
+                hubs.append(hub)
+        return hubs
+
+    def _fetch(self, from_station, to_station, train_date, purpose_code):
+        try:
+            return self.coalescer.fetch(from_station, to_station, train_date, purpose_code, max_age=self.leg_ttl)
+        except QueryError as e:
+            print(f"查询 {from_station}->{to_station} {train_date} 失败: {e}")
             return []
 
+    def search(self, from_station, to_station, train_date, seat_types=None, purpose_code='ADULT',
+               only_available=True, limit=20):
+        """返回按总耗时、出发时间排序的中转方案；only_available 时只保留两段都有票的方案"""
+        mask = seat_mask(seat_types)
+        train_date = str(train_date)
+        next_date = (parse_date(train_date) + datetime.timedelta(days=1)).isoformat()
+        hubs = self.candidate_hubs(from_station, to_station)
+        itineraries = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            first_futures = [executor.submit(self._fetch, from_station, hub, train_date, purpose_code) for hub in hubs]
+            first_legs = {}
+            for hub, future in zip(hubs, first_futures):
+                legs = self._legs(future.result(), train_date, 0, mask)
+                if legs:
+                    first_legs[hub] = legs
+            # 没有直达第一段的枢纽直接跳过，其余按直达车次数保留前 max_hubs 个（排序稳定，车次数相同时按配置顺序）
+            hubs = sorted(first_legs, key=lambda hub: -len(first_legs[hub]))[:self.max_hubs or None]
+            # 第二段同时查当天和次日，覆盖第一段隔夜到达的情况
+            futures = {}
+            for hub in hubs:
+                futures[hub] = (
+                    executor.submit(self._fetch, hub, to_station, train_date, purpose_code),
+                    executor.submit(self._fetch, hub, to_station, next_date, purpose_code),
+                )
+            for hub in hubs:
+                second_future, next_future = futures[hub]
+                second_legs = (self._legs(second_future.result(), train_date, 0, mask)
+                               + self._legs(next_future.result(), next_date, 1, mask))
+                for first, second in join_legs(first_legs[hub], second_legs, self.min_connection, self.max_connection):
+                    if only_available and not (first.seats and second.seats):
+                        continue
+                    itineraries.append(Itinerary(first, second, hub))
+        itineraries.sort(key=lambda it: (it.total_minutes, it.first.depart, it.connection_minutes))
+        return itineraries[:limit] if limit else itineraries
+
+    @staticmethod
+    def _legs(tickets, train_date, day_offset, mask):
+        legs = []
+        for ticket in tickets:
+            # 停运车次的出发时间/历时为 24:00 / 99:59 之类的占位值
+            if clock_minutes(ticket.departure_time) is None or clock_minutes(ticket.duration) is None:
+                continue
+            if ticket.duration.startswith('99'):
+                continue
+            legs.append(TransferLeg(ticket, train_date, day_offset, mask))
+        return legs
+
+
+def display_itineraries(monitor, itineraries):
+    """以表格形式打印中转方案"""
+    if not itineraries:
+        print("没有找到符合条件的中转方案")
+        return
+
+    from prettytable import PrettyTable
+    table = PrettyTable()
+    table.field_names = ["第一程", "出发", "换乘站", "换乘时间", "第二程", "到达", "总历时", "第一程余票", "第二程余票"]
+    for it in itineraries:
+        first, second = it.first, it.second
+        table.add_row([
+            f"{first.ticket.train_code} {monitor.get_station_name(first.ticket.from_station)}",
+            first.ticket.departure_time,
+            monitor.get_station_name(first.ticket.to_station),
+            f"{it.connection_minutes // 60}:{it.connection_minutes % 60:02d}",
+            f"{second.ticket.train_code}{'（次日）' if second.train_date != first.train_date else ''}",
+            f"{monitor.get_station_name(second.ticket.to_station)} {second.ticket.arrival_time}",
+            f"{it.total_minutes // 60}:{it.total_minutes % 60:02d}",
+            ' '.join(f"{seat}:{first.ticket.seat_text(seat)}" for seat in first.seats) or '无',
+            ' '.join(f"{seat}:{second.ticket.seat_text(seat)}" for seat in second.seats) or '无',
+        ])
+    print(table)
+
+
 def load_config(config_file='config.yaml'):
     """加载配置文件"""
     if os.path.exists(config_file):
         try:
+            import yaml  # 需要安装 pyyaml 库
             with open(config_file, 'r', encoding='utf-8') as f:
                 config = yaml.safe_load(f)
                 print(f"已加载配置文件: {config_file}")
@@ -508,6 +4131,7 @@ def load_config(config_file='config.yaml'):
 def save_config(config, config_file='config.yaml'):
     """保存配置到文件"""
     try:
+        import yaml
         with open(config_file, 'w', encoding='utf-8') as f:
             yaml.dump(config, f, default_flow_style=False, allow_unicode=True)
         print(f"配置已保存到: {config_file}")
@@ -516,23 +4140,257 @@ def save_config(config, config_file='config.yaml'):
         print(f"保存配置失败: {e}")
         return False
 
-def parse_arguments():
+def input_station(monitor, prompt):
+    """交互输入站名：站名不在站点表中时按前缀或拼音查找，列出候选供选择"""
+    name = input(prompt).strip()
+    while True:
+        if name in monitor.station_index():
+            return name
+        matches = monitor.search_stations(name, 10) if name else []
+        if not matches:
+            name = input(f"未找到站点 {name!r}，请重新输入（支持拼音，如 bj）: ").strip()
+            continue
+        if len(matches) == 1:
+            print(f"使用站点: {matches[0]}")
+            return matches[0]
+        print("找到以下站点:")
+        for i, match in enumerate(matches, 1):
+            print(f"  {i}. {match}")
+        choice = input("请输入序号，或重新输入站名: ").strip()
+        if choice.isdigit() and 1 <= int(choice) <= len(matches):
+            return matches[int(choice) - 1]
+        name = choice
+
+def parse_arguments(argv=None):
     """解析命令行参数"""
     parser = argparse.ArgumentParser(description='12306车票查询监控工具')
     parser.add_argument('--config', type=str, default='config.yaml', help='配置文件路径')
     parser.add_argument('--proxy', type=str, help='代理服务器地址，格式: http://host:port')
+    parser.add_argument('--proxy-file', type=str, help='代理列表文件，每行一个代理，启用代理池轮询使用')
     parser.add_argument('--from', dest='from_station', type=str, help='出发站')
     parser.add_argument('--to', dest='to_station', type=str, help='到达站')
     parser.add_argument('--date', type=str, help='出发日期，格式: YYYY-MM-DD')
     parser.add_argument('--trains', type=str, help='车次，多个用逗号分隔')
     parser.add_argument('--seats', type=str, help='座位类型，多个用逗号分隔')
     parser.add_argument('--interval', type=int, default=60, help='查询间隔（秒）')
+    parser.add_argument('--workers', type=int, help='多任务模式下的最大并发查询数')
+    parser.add_argument('--processes', type=int, help='多任务模式下按线路把任务分到多少个进程运行（每个进程 --workers 个并发）')
+    parser.add_argument('--daemon', action='store_true', help='无人值守模式：从配置文件读取任务，不进行任何交互，收到 SIGTERM 后退出')
+    parser.add_argument('--trace', metavar='FILE', help='记录每次查询各阶段耗时，退出时导出 Chrome trace JSON 并打印统计')
+    parser.add_argument('--history-stats', metavar='TRAIN_CODE', help='统计历史记录中该车次各座位类型变为有票的时段分布（配合 --seats 使用）')
+    parser.add_argument('--days', type=int, default=30, help='历史统计的天数')
+    parser.add_argument('--dashboard', action='store_true', help='多任务模式下显示实时看板（curses），按 q 退出')
+    parser.add_argument('--log-file', type=str, help='看板模式下把运行日志同时写入该文件')
+    parser.add_argument('--expand-cities', action='store_true', help='把出发站和到达站展开为所在城市的所有车站，合并查询结果')
+    parser.add_argument('--transfer', action='store_true', help='查询经中转枢纽的两段换乘方案（需要 --from、--to、--date）')
+    parser.add_argument('--serve-cache', type=int, metavar='PORT', help='在该端口上提供本地余票查询缓存服务（HTTP/JSON）')
+    parser.add_argument('--metrics-port', type=int, help='在该端口上提供 Prometheus 格式的 /metrics')
+    parser.add_argument('--metrics-host', type=str, default='127.0.0.1', help='/metrics 监听地址')
     
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
-if __name__ == "__main__":
+def split_rate(options, shares):
+    """把限速参数（rate/burst，未填写时用默认值）平分给 shares 个进程"""
+    options = dict(options)
+    if shares > 1:
+        options['rate'] = options.get('rate', 1.0) / shares
+        options['burst'] = max(1, options.get('burst', 3) // shares)
+    return options
+
+def configure_monitor(monitor, config, max_workers=8, shares=1):
+    """按配置设置限速、HTTP 连接池、代理池和熔断，启动站点表后台刷新，返回所用的 StationRefresher
+
+    shares 为共用这些限速的进程数：按主机和按代理的速率都按进程数平分，各进程合计不超过配置的速率。
+    """
+    if config.get('rate_limit') or shares > 1:
+        monitor.rate_limiter = RateLimiter(**split_rate(config.get('rate_limit') or {}, shares))
+    if config.get('transport'):
+        monitor.transport = Transport(**config['transport']).register_metrics()
+        monitor.session = monitor.transport.make_session()
+    if config.get('station_refresh'):
+        # 定时刷新和遇到未知站名时的刷新用同一个实例，min_retry 等配置对两者都生效
+        monitor.station_refresher = StationRefresher(**config['station_refresh'])
+    refresher = monitor.station_refresher
+    refresher.start(monitor.session, monitor.station_name_js_url, monitor.headers)
+    if config.get('proxy_pool') and monitor.proxy_pool is None:
+        options = dict(split_rate(config['proxy_pool'], shares), transport=monitor.transport)
+        monitor.set_proxy_pool(ProxyPool.from_config(options, max_workers))
+    if config.get('circuit_breaker'):
+        monitor.endpoint_router = EndpointRouter(**config['circuit_breaker']).register_metrics()
+    return refresher
+
+def watch_config(config_file, engine, config):
+    """config_file 不为空且 reload_interval（默认 5 秒）不为 0 时启动配置热重载，返回 ConfigWatcher 或 None"""
+    if not config_file or not config.get('reload_interval', 5):
+        return None
+    return ConfigWatcher(config_file, engine, config, config.get('reload_interval', 5)).start()
+
+def run_sharded(monitor, config, jobs, workers=None, shard_options=None, config_file=None):
+    """把任务分到多个进程运行（见 ShardedEngine），收到 SIGTERM/SIGINT 后停止所有分片进程再退出"""
+    monitor_options = {'base_url': monitor.base_url, 'proxies': monitor.proxies}
+    if monitor.proxy_pool is not None and not config.get('proxy_pool'):
+        # 命令行 --proxy-file 指定的代理池交给各分片进程按同样的代理重建
+        config = dict(config, proxy_pool={'proxies': [endpoint.url for endpoint in monitor.proxy_pool.endpoints],
+                                          'strategy': monitor.proxy_pool.strategy})
+    shard_options = dict(shard_options or {})
+    max_workers = workers or config.get('max_workers', 8)
+    refresher = None
+    prices = None
+    shares = shard_options.get('processes', 2)
+    notifier = build_notifier(config.get('notify')).start()
+    history = HistoryStore(**config['history']).start() if config.get('history') else None
+    if config.get('prices'):
+        # 票价查询在协调进程中进行：协调进程的 monitor 同样按配置设置，并占一份限速
+        shares += 1
+        monitor.set_proxy_pool(None)
+        refresher = configure_monitor(monitor, config, max_workers, shares)
+        prices = PriceLookup(monitor, notifier, **config['prices']).start()
+    engine = ShardedEngine(config, max_workers=max_workers, notifier=notifier, history=history,
+                           monitor_options=monitor_options, prices=prices, shares=shares, **shard_options)
+    for job in jobs:
+        engine.add_job(job)
+    watcher = watch_config(config_file, engine, config)
+    
+    def handle_signal(signum, frame):
+        print(f"收到信号 {signum}，正在停止监控...")
+        engine.stop()
+    
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, handle_signal)
+        signal.signal(signal.SIGINT, handle_signal)
+    try:
+        engine.run()
+    finally:
+        if watcher is not None:
+            watcher.stop()
+        if prices is not None:
+            prices.stop()
+        if refresher is not None:
+            refresher.stop()
+        notifier.stop()
+        if history is not None:
+            history.stop()
+    return 0
+
+def run_engine(monitor, config, workers=None, dashboard=False, log_file=None, cache_port=None, processes=None,
+               config_file=None):
+    """用配置中的任务运行多任务监控引擎，收到 SIGTERM/SIGINT 后处理完进行中的查询再退出
+
+    dashboard 为 True 时以实时看板显示各任务余票，运行期间的输出进入看板日志区（及 log_file）。
+    cache_port 或配置中的 cache_server 会启动本地查询缓存服务，没有任务时只运行该服务。
+    processes（或配置中的 shards.processes）大于 1 时按线路把任务分到多个进程运行。
+    config 读取自 config_file 时监视该文件，修改后的任务在运行中生效（见 ConfigWatcher）。
+    """
+    cache_options = dict(config.get('cache_server') or {})
+    if cache_port is not None:
+        cache_options['port'] = cache_port
+    if cache_options and not (config.get('jobs') or config.get('query_params')):
+        jobs = []
+    else:
+        jobs = load_jobs(config)
+    error = check_jobs(jobs)
+    if error:
+        print(error)
+        return 1
+    
+    shard_options = dict(config.get('shards') or {})
+    if processes is not None:
+        shard_options['processes'] = processes
+    if shard_options.get('processes', 1) > 1:
+        if dashboard or cache_options:
+            print("多进程模式不支持看板和查询缓存服务，改为单进程运行")
+        else:
+            return run_sharded(monitor, config, jobs, workers, shard_options, config_file)
+    
+    refresher = configure_monitor(monitor, config, workers or config.get('max_workers', 8))
+    notifier = build_notifier(config.get('notify')).start()
+    history = HistoryStore(**config['history']).start() if config.get('history') else None
+    prices = PriceLookup(monitor, notifier, **config['prices']).start() if config.get('prices') else None
+    engine = MonitorEngine(monitor, max_workers=workers or config.get('max_workers', 8),
+                           max_backoff=config.get('max_backoff', 600), notifier=notifier, history=history,
+                           prices=prices)
+    for job in jobs:
+        engine.add_job(job)
+    board = None
+    if dashboard:
+        options = dict(config.get('dashboard') or {})
+        if log_file:
+            options['log_file'] = log_file
+        board = Dashboard(engine, **options)
+        engine.on_events = board.on_events
+    watcher = watch_config(config_file, engine, config) if jobs else None
+    cache_server = None
+    if cache_options:
+        host = cache_options.pop('host', '127.0.0.1')
+        port = cache_options.pop('port', 9307)
+        cache_server = QueryCacheServer(QueryCache(engine.coalescer, **cache_options), host, port).start()
+        print(f"查询缓存服务: http://{host}:{cache_server.address[1]}/tickets?from=...&to=...&date=...")
+    
+    def handle_signal(signum, frame):
+        print(f"收到信号 {signum}，正在停止监控...")
+        engine.stop()
+    
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, handle_signal)
+        signal.signal(signal.SIGINT, handle_signal)
+    try:
+        if board is not None:
+            board.run()
+        else:
+            engine.run()
+    finally:
+        if watcher is not None:
+            watcher.stop()
+        if cache_server is not None:
+            cache_server.stop()
+        if prices is not None:
+            prices.stop()
+        notifier.stop()
+        refresher.stop()
+        if history is not None:
+            history.stop()
+        print(f"查询路线状态:\n{monitor.endpoint_router.format_status()}")
+        if monitor.proxy_pool is not None:
+            print(f"代理状态:\n{monitor.proxy_pool.format_status()}")
+    return 0
+
+def print_history_stats(store, train_code, seat_types, days=30):
+    """打印某车次各座位类型变为有票的小时分布"""
+    for seat_type in seat_types:
+        counts = store.availability_by_hour(train_code, seat_type, days)
+        total = sum(counts)
+        print(f"\n{train_code} {seat_type} 最近 {days} 天变为有票 {total} 次:")
+        for hour, count in enumerate(counts):
+            if count:
+                print(f"  {hour:02d}:00-{hour:02d}:59  {count:5d}  {'#' * max(1, count * 40 // total)}")
+
+def main(argv=None):
+    """命令行入口"""
     # 解析命令行参数
-    args = parse_arguments()
+    args = parse_arguments(argv)
+    if args.trace:
+        tracer.enabled = True
+    metrics_server = None
+    if args.metrics_port is not None:
+        metrics_server = MetricsServer(metrics, args.metrics_host, args.metrics_port).start()
+        print(f"指标地址: http://{args.metrics_host}:{metrics_server.address[1]}/metrics")
+    try:
+        return run_command(args)
+    finally:
+        if metrics_server is not None:
+            metrics_server.stop()
+        if args.trace:
+            count = tracer.export_chrome_trace(args.trace)
+            print(f"\n已导出 {count} 个追踪事件到: {args.trace}")
+            print(tracer.format_summary())
+
+def run_command(args):
+    """按命令行参数运行对应的模式"""
+    if args.history_stats:
+        config = load_config(args.config) or {}
+        store = HistoryStore(**(config.get('history') or {}))
+        print_history_stats(store, args.history_stats, args.seats.split(',') if args.seats else ['二等座'], args.days)
+        return 0
     
     # 创建监控器实例
     monitor = TrainTicketMonitor()
@@ -540,6 +4398,34 @@ if __name__ == "__main__":
     # 设置代理（如果提供）
     if args.proxy:
         monitor.set_proxy(args.proxy)
+    if args.proxy_file:
+        monitor.set_proxy_pool(ProxyPool(load_proxy_file(args.proxy_file), pool_size=args.workers or 8))
+    
+    if args.serve_cache is not None and not args.daemon:
+        # 只提供查询缓存服务；配置了 jobs 时同时监控这些任务
+        config = load_config(args.config) or {}
+        if not config.get('jobs'):
+            config = dict(config, query_params=None)
+        return run_engine(monitor, config, args.workers, cache_port=args.serve_cache)
+    
+    if args.daemon:
+        # 无人值守模式：只读取配置文件，不询问任何问题
+        config = load_config(args.config)
+        if not config or not (config.get('jobs') or config.get('query_params')):
+            print(f"无人值守模式需要包含 query_params 或 jobs 的配置文件: {args.config}")
+            return 1
+        return run_engine(monitor, config, args.workers, args.dashboard, args.log_file, args.serve_cache,
+                          args.processes, args.config)
+    
+    if args.transfer:
+        if not (args.from_station and args.to_station and args.date):
+            print("中转查询需要 --from、--to 和 --date")
+            return 1
+        config = load_config(args.config) or {}
+        search = TransferSearch(monitor, **(config.get('transfer') or {}))
+        seat_types = args.seats.split(',') if args.seats else None
+        display_itineraries(monitor, search.search(args.from_station, args.to_station, args.date, seat_types))
+        return 0
     
     # 如果命令行参数提供了完整的查询参数，直接使用
     if args.from_station and args.to_station and args.date:
@@ -550,64 +4436,92 @@ if __name__ == "__main__":
         seat_types = args.seats.split(',') if args.seats else None
         interval = args.interval
         
+        if args.expand_cities:
+            # 按城市展开需要并发查询多个车站组合，交给多任务引擎
+            config = dict(load_config(args.config) or {})
+            config['query_params'] = {
+                'from_station': from_station,
+                'to_station': to_station,
+                'train_date': train_date,
+                'train_codes': train_codes,
+                'seat_types': seat_types,
+                'interval': interval,
+                'expand_cities': True,
+            }
+            config.pop('jobs', None)
+            return run_engine(monitor, config, args.workers, args.dashboard, args.log_file)
+        
         # 开始监控
         monitor.monitor_tickets(from_station, to_station, train_date, train_codes, seat_types, interval)
-    else:
-        # 尝试加载配置文件
-        config = load_config(args.config)
+        return 0
+    
+    # 尝试加载配置文件
+    config = load_config(args.config)
+    
+    if config and config.get('jobs'):
+        # 多任务配置：并发监控所有任务（--processes 大于 1 时分到多个进程）
+        return run_engine(monitor, config, args.workers, args.dashboard, args.log_file, processes=args.processes,
+                          config_file=args.config)
+    
+    if config and 'query_params' in config:
+        # 使用配置文件中的参数
+        params = config['query_params']
+        from_station = params.get('from_station')
+        to_station = params.get('to_station')
+        train_date = params.get('train_date')
+        train_codes = params.get('train_codes')
+        seat_types = params.get('seat_types')
+        interval = params.get('interval', 60)
+        hot_windows = parse_hot_windows(params.get('hot_windows'))
         
-        if config and 'query_params' in config:
-            # 使用配置文件中的参数
-            params = config['query_params']
-            from_station = params.get('from_station')
-            to_station = params.get('to_station')
-            train_date = params.get('train_date')
-            train_codes = params.get('train_codes')
-            seat_types = params.get('seat_types')
-            interval = params.get('interval', 60)
-            
-            # 确认配置信息
-            print("\n当前配置信息:")
-            print(f"出发站: {from_station}")
-            print(f"到达站: {to_station}")
-            print(f"出发日期: {train_date}")
-            print(f"监控车次: {', '.join(train_codes) if train_codes else '所有车次'}")
-            print(f"座位类型: {', '.join(seat_types) if seat_types else '所有类型'}")
-            print(f"查询间隔: {interval}秒")
-            
-            use_config = input("\n是否使用以上配置? (y/n): ")
-            if use_config.lower() != 'y':
-                config = None  # 不使用配置文件，转为手动输入
+        # 确认配置信息
+        print("\n当前配置信息:")
+        print(f"出发站: {from_station}")
+        print(f"到达站: {to_station}")
+        print(f"出发日期: {train_date}")
+        print(f"监控车次: {', '.join(train_codes) if train_codes else '所有车次'}")
+        print(f"座位类型: {', '.join(seat_types) if seat_types else '所有类型'}")
+        print(f"查询间隔: {interval}秒")
         
-        if not config:
-            # 手动输入参数
-            print("\n请输入查询参数:")
-            from_station = input("请输入出发站（如北京）: ")
-            to_station = input("请输入到达站（如上海）: ")
-            train_date = input("请输入出发日期（格式: YYYY-MM-DD）: ")
-            
-            train_codes_input = input("请输入要监控的车次（多个车次用逗号分隔，留空监控所有车次）: ")
-            train_codes = [code.strip() for code in train_codes_input.split(',')] if train_codes_input.strip() else None
-            
-            seat_types_input = input("请输入要监控的座位类型（多个类型用逗号分隔，留空监控所有类型）: ")
-            seat_types = [seat.strip() for seat in seat_types_input.split(',')] if seat_types_input.strip() else None
-            
-            interval = int(input("请输入查询间隔（秒，建议不少于30秒）: ") or "60")
-            
-            # 询问是否保存配置
-            save_config_choice = input("\n是否保存当前配置以便下次使用? (y/n): ")
-            if save_config_choice.lower() == 'y':
-                new_config = {
-                    'query_params': {
-                        'from_station': from_station,
-                        'to_station': to_station,
-                        'train_date': train_date,
-                        'train_codes': train_codes,
-                        'seat_types': seat_types,
-                        'interval': interval
-                    }
-                }
-                save_config(new_config)
+        use_config = input("\n是否使用以上配置? (y/n): ")
+        if use_config.lower() != 'y':
+            config = None  # 不使用配置文件，转为手动输入
+    
+    if not config:
+        # 手动输入参数
+        hot_windows = None
+        print("\n请输入查询参数:")
+        from_station = input_station(monitor, "请输入出发站（如北京，或拼音 bj）: ")
+        to_station = input_station(monitor, "请输入到达站（如上海，或拼音 sh）: ")
+        train_date = input("请输入出发日期（格式: YYYY-MM-DD）: ")
         
-        # 开始监控
-        monitor.monitor_tickets(from_station, to_station, train_date, train_codes, seat_types, interval) 
\ No newline at end of file
+        train_codes_input = input("请输入要监控的车次（多个车次用逗号分隔，留空监控所有车次）: ")
+        train_codes = [code.strip() for code in train_codes_input.split(',')] if train_codes_input.strip() else None
+        
+        seat_types_input = input("请输入要监控的座位类型（多个类型用逗号分隔，留空监控所有类型）: ")
+        seat_types = [seat.strip() for seat in seat_types_input.split(',')] if seat_types_input.strip() else None
+        
+        interval = int(input("请输入查询间隔（秒，建议不少于30秒）: ") or "60")
+        
+        # 询问是否保存配置
+        save_config_choice = input("\n是否保存当前配置以便下次使用? (y/n): ")
+        if save_config_choice.lower() == 'y':
+            new_config = {
+                'query_params': {
+                    'from_station': from_station,
+                    'to_station': to_station,
+                    'train_date': train_date,
+                    'train_codes': train_codes,
+                    'seat_types': seat_types,
+                    'interval': interval
+                }
+            }
+            save_config(new_config)
+    
+    # 开始监控
+    monitor.monitor_tickets(from_station, to_station, train_date, train_codes, seat_types, interval,
+                            hot_windows=hot_windows, max_backoff=(config or {}).get('max_backoff', 600))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())